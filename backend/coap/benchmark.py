@@ -0,0 +1,167 @@
+import argparse
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from payloads import MSG_TYPE
+
+COAP_VERSION = 1
+COAP_NON = 1
+COAP_GET = 1
+COAP_OPTION_URI_PATH = 11
+COAP_OPTION_BLOCK2 = 23
+
+def build_get(path, mid, token, block2=None):
+    # NON GET with a single (short) Uri-Path option, the same as the device sends
+    header = struct.pack('!BBH', (COAP_VERSION << 6) | (COAP_NON << 4) | len(token), COAP_GET, mid)
+    option = bytes([(COAP_OPTION_URI_PATH << 4) | len(path)]) + path
+    if block2 is not None:
+        # block number and szx of small resources fit in 1 or 2 bytes
+        value = block2.to_bytes((block2.bit_length() + 7) // 8, 'big')
+        option += bytes([((COAP_OPTION_BLOCK2 - COAP_OPTION_URI_PATH) << 4) | len(value)]) + value
+
+    return header + token + option
+
+def start_server(port, workers, block_cache=True):
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, 'server.py', '--port', str(port), '--workers', str(workers), '--quiet']
+    if not block_cache:
+        cmd.append('--no-block-cache')
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # the server is up once it answers a request
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.settimeout(0.2)
+    try:
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                probe.sendto(build_get(b'short', 0, b'\x00'), ('127.0.0.1', port))
+                probe.recv(2048)
+                # give the other workers time to bind as well
+                time.sleep(0.5)
+                return proc
+            except OSError:
+                pass
+    finally:
+        probe.close()
+
+    proc.kill()
+    raise RuntimeError(f'CoAP server with {workers} workers did not start on port {port}')
+
+def run_client(host, port, path, szx, sockets, window, duration, timeout, results):
+    # Every socket has its own source port, so SO_REUSEPORT hashes the sockets
+    # over the server workers. Each keeps `window` NON requests in flight.
+    # With szx every request asks for the next Block2 block of the resource.
+    blocks = 0 if szx is None else -(-len(MSG_TYPE[path.decode()]) // 2 ** (szx + 4))
+    selector = selectors.DefaultSelector()
+    pending = {}
+    for _ in range(sockets):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setblocking(False)
+        s.connect((host, port))
+        selector.register(s, selectors.EVENT_READ)
+        pending[s] = [random.randrange(0x10000), 0, time.monotonic()]
+
+    def send(s):
+        state = pending[s]
+        state[0] = (state[0] + 1) & 0xFFFF
+        block2 = None if szx is None else ((state[0] % blocks) << 4) | szx
+        s.send(build_get(path, state[0], struct.pack('!H', state[0]), block2))
+        state[1] += 1
+        state[2] = time.monotonic()
+
+    for s in pending:
+        for _ in range(window):
+            send(s)
+
+    received = 0
+    lost = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        for key, _ in selector.select(timeout):
+            s = key.fileobj
+            try:
+                while True:
+                    s.recv(2048)
+                    received += 1
+                    pending[s][1] -= 1
+                    send(s)
+            except BlockingIOError:
+                pass
+
+        # NON requests are not retransmitted, refill the window of stalled sockets
+        now = time.monotonic()
+        for s, state in pending.items():
+            if now - state[2] > timeout:
+                lost += state[1]
+                state[1] = 0
+                for _ in range(window):
+                    send(s)
+
+    for s in pending:
+        s.close()
+    results.put((received, lost))
+
+def run_load(args):
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=run_client, args=(args.host, args.port, args.path.encode(), args.szx,
+                args.sockets, args.window, args.duration, args.timeout, results))
+               for _ in range(args.clients)]
+
+    for client in clients:
+        client.start()
+    received, lost = 0, 0
+    for _ in clients:
+        r, l = results.get()
+        received += r
+        lost += l
+    for client in clients:
+        client.join()
+
+    return received, lost
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CoAP server throughput benchmark with SO_REUSEPORT workers')
+    parser.add_argument('--workers', type=str, default='1,2,4', help='comma separated worker counts to compare')
+    parser.add_argument('--path', type=str, choices=['short', 'middle', 'long'], default='short')
+    parser.add_argument('--szx', type=int, choices=range(0, 7), help='request Block2 blocks of 2**(szx+4)B')
+    parser.add_argument('--block-cache', type=str, choices=['on', 'off', 'both'], default='on',
+        help='serve blocks from the pre-sliced cache, by slicing per request, or compare both')
+    parser.add_argument('--clients', type=int, default=4, help='load generator processes')
+    parser.add_argument('--sockets', type=int, default=16, help='UDP sockets (source ports) per process')
+    parser.add_argument('--window', type=int, default=4, help='requests in flight per socket')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per run')
+    parser.add_argument('--timeout', type=float, default=1.0, help='seconds before an unanswered request is lost')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=31516)
+    parser.add_argument('--no-spawn', action='store_true', help='benchmark an already running server')
+    args = parser.parse_args()
+
+    block_caches = {'on': [True], 'off': [False], 'both': [False, True]}[args.block_cache]
+    block = '' if args.szx is None else f'[{2 ** (args.szx + 4)}B blocks]'
+
+    baseline = None
+    for workers in [int(w) for w in args.workers.split(',')]:
+        for block_cache in block_caches:
+            proc = None if args.no_spawn else start_server(args.port, workers, block_cache)
+            try:
+                received, lost = run_load(args)
+            finally:
+                if proc is not None:
+                    proc.terminate()
+                    proc.wait()
+
+            throughput = received / args.duration
+            if baseline is None:
+                baseline = throughput
+            print(f'[{workers} workers][GET: /{args.path}]{block}[block cache: {"on" if block_cache else "off"}]'
+                  f'[{args.clients * args.sockets} sockets][{throughput:.0f} req/s][lost: {lost}][x{throughput / baseline:.2f}]')
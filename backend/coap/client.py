@@ -2,42 +2,41 @@ import logging
 import asyncio
 from time import sleep
 import argparse
+import datetime
+import math
+import os
+import sys
+import time
+from collections import Counter
 
 from aiocoap import *
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from payloads import MSG_TYPE
+from stats import percentile
+
 logging.basicConfig(level=logging.DEBUG)
 
 SERVER_IP = '129.242.17.213'
 SERVER_PORT = 31416
 
-MSG_TYPE={
-    'short': b"It is a simple short response.\n",
-    'middle': b"Lorem ipsum dolor sit amet, consectetur adipiscing elit. Integer nisl magna, varius et nunc ut, pharetra posuere ante. "\
-            b"Praesent vestibulum tempor vehicula. Nunc vehicula a elit at rhoncus. Proin luctus ex at sapien pretium, a consequat magna maximus. "\
-            b"Nunc scelerisque nunc et enim pellentesque, eu porta diam aliquet. Mauris mollis congue justo, ac volutpat nibh consequat sit amet. "\
-            b"Vestibulum ante ipsum primis in faucibus orci luctus et ultrices posuere cubilia curae; Curabitur congue nibh ut efficitur est.\n\n",
-    'long': b"Lorem ipsum dolor sit amet, consectetur adipiscing elit. Integer quam nulla, tincidunt nec dolor ut, "\
-            b"convallis finibus est. Aenean pretium nulla eu dolor ultrices maximus. Phasellus laoreet metus et pellentesque ornare. "\
-            b"Praesent ac purus sed quam pulvinar cursus. Suspendisse dictum mollis est non tincidunt. In posuere mauris justo, "\
-            b"nec rhoncus tortor vestibulum at. Aenean in lorem augue. Maecenas ante elit, tempor id ante in, pellentesque congue nisl.\n\n"\
-            b"Curabitur sit amet pulvinar turpis. Suspendisse potenti. Aenean porta, arcu sed sollicitudin commodo, ante dolor suscipit eros, "\
-            b"vitae eleifend velit felis ac risus. Sed vehicula mi sed ultrices ullamcorper. Nulla fringilla ac lacus viverra egestas. "\
-            b"Suspendisse metus ligula, ultricies et egestas in, sodales vitae nunc. Quisque aliquam dolor fringilla venenatis aliquam. "\
-            b"Praesent tellus diam, luctus eu risus in, scelerisque auctor nunc. Donec odio nibh, venenatis eget condimentum eu, tristique "\
-            b"facilisis nunc. Proin arcu ex, congue malesuada consequat a, tempor eu justo. Vivamus sapien magna, venenatis at interdum ut, "\
-            b"eleifend eget velit.\n\n"\
-            b"Sed a efficitur eros. Vestibulum mattis blandit malesuada. Donec leo quam, facilisis ac tortor eu, fringilla tempus neque. "\
-            b"Vestibulum volutpat, diam vel vulputate molestie, nunc velit mollis ipsum, vitae pulvinar urna neque nec leo. Curabitur elit tortor, "\
-            b"venenatis sed malesuada at, efficitur quis risus. Fusce ac tellus et ipsum viverra consequat. Proin pretium commodo lacus, "\
-            b"quis vestibulum nisl consequat eu. Morbi maximus, neque in tempus finibus, lacus odio tempus magna, sit amet pretium libero.\n\n"
-}
-
-async def do_request(r_type, url, m_type):
+def build_request(r_type, url, m_type, host=SERVER_IP, port=SERVER_PORT):
+    uri = f'coap://{host}:{port}/{url}'
     if r_type == 'GET':
-        request = Message(code=GET, mtype=NON if m_type == 'NON' else CON, uri=f'coap://{SERVER_IP}:{SERVER_PORT}/{url}')
+        request = Message(code=GET, mtype=NON if m_type == 'NON' else CON, uri=uri)
         request.opt.block2 = (0, 0, 4)
+    elif r_type == 'PUT':
+        # changes the resource content, which notifies its observers
+        payload = f'{datetime.datetime.now()}: '.encode() + MSG_TYPE[url]
+        request = Message(code=PUT, mtype=NON if m_type == 'NON' else CON, uri=uri, payload=payload)
     else:
-        request = Message(code=POST, mtype=NON if m_type == 'NON' else CON, uri=f'coap://{SERVER_IP}:{SERVER_PORT}/{url}', payload=MSG_TYPE[url])
+        request = Message(code=POST, mtype=NON if m_type == 'NON' else CON, uri=uri, payload=MSG_TYPE[url])
+
+    return request
+
+async def do_request(r_type, url, m_type, host=SERVER_IP, port=SERVER_PORT):
+    request = build_request(r_type, url, m_type, host, port)
 
     protocol = await Context.create_client_context()
 
@@ -52,11 +51,80 @@ async def do_request(r_type, url, m_type):
         print('-----------------------------------------')
         sleep(1)
 
+def print_histogram(latencies):
+    # log2 buckets in ms: <1, 1-2, 2-4, ...
+    buckets = Counter(max(0, int(math.log2(latency * 1000)) + 1) if latency >= 0.001 else 0 for latency in latencies)
+    for bucket in range(max(buckets) + 1 if buckets else 0):
+        low = 0 if bucket == 0 else 2 ** (bucket - 1)
+        count = buckets[bucket]
+        print(f'{low:>6}-{2 ** bucket:<6}ms {count:>8} {"#" * int(60 * count / len(latencies))}')
+
+async def run_load(args):
+    # Contexts are created once and reused for every request. aiocoap sends at most
+    # one outstanding CON request per context and server (NSTART=1), so concurrent
+    # CON requests are spread over a pool of contexts.
+    contexts = [await Context.create_client_context() for _ in range(args.contexts)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = Counter()
+
+    async def one(i, scheduled):
+        # latency counts from the scheduled send time, so waiting for the concurrency
+        # limit is included instead of hiding a slow server (coordinated omission)
+        async with semaphore:
+            request = build_request(args.request_type, args.url, args.msg_type, args.host, args.port)
+            try:
+                response = await asyncio.wait_for(contexts[i % len(contexts)].request(request).response, args.timeout)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+                return
+            if not response.code.is_successful():
+                errors[str(response.code)] += 1
+                return
+            latencies.append(time.monotonic() - scheduled)
+
+    tasks = []
+    start = time.monotonic()
+    for i in range(args.count):
+        # requests are started at a fixed rate, unless the concurrency limit holds them back
+        scheduled = time.monotonic()
+        if args.rate > 0:
+            scheduled = start + i / args.rate
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(one(i, scheduled)))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - start
+
+    for context in contexts:
+        await context.shutdown()
+
+    latencies.sort()
+    print(f'[{args.request_type} {args.msg_type}: /{args.url}][{args.count} requests][concurrency {args.concurrency}][rate {args.rate or "max"}]')
+    print(f'completed: {len(latencies)}, failed: {sum(errors.values())} {dict(errors)}, total time: {elapsed:.2f}s, '
+          f'throughput: {len(latencies) / elapsed:.1f} req/s')
+    print(f'latency p50: {percentile(latencies, 50) * 1000:.1f}ms, p99: {percentile(latencies, 99) * 1000:.1f}ms, '
+          f'p999: {percentile(latencies, 99.9) * 1000:.1f}ms, max: {percentile(latencies, 100) * 1000:.1f}ms')
+    print_histogram(latencies)
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='MQTT publisher')
-    parser.add_argument('request_type', type=str, choices=['GET', 'POST'])
+    parser = argparse.ArgumentParser(description='CoAP client')
+    parser.add_argument('request_type', type=str, choices=['GET', 'POST', 'PUT'])
     parser.add_argument('url', type=str, choices=['short', 'middle', 'long'])
     parser.add_argument('msg_type', type=str, choices=['NON', 'CON'])
+    parser.add_argument('--host', type=str, default=SERVER_IP)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--load', action='store_true', help='load generation mode, reports a latency histogram')
+    parser.add_argument('--count', type=int, default=10000, help='load: number of requests')
+    parser.add_argument('--concurrency', type=int, default=1000, help='load: requests in flight')
+    parser.add_argument('--rate', type=float, default=0, help='load: requests started per second, 0 for no limit')
+    parser.add_argument('--timeout', type=float, default=10.0, help='load: seconds before a request counts as failed')
+    parser.add_argument('--contexts', type=int, default=64, help='load: client contexts, bounds concurrent CON requests')
     args = parser.parse_args()
 
-    asyncio.get_event_loop().run_until_complete(do_request(args.request_type, args.url, args.msg_type))
+    if args.load:
+        logging.getLogger().setLevel(logging.WARNING)
+        asyncio.get_event_loop().run_until_complete(run_load(args))
+    else:
+        asyncio.get_event_loop().run_until_complete(do_request(args.request_type, args.url, args.msg_type, args.host, args.port))
@@ -0,0 +1,78 @@
+import time
+from collections import OrderedDict
+
+# RFC 7252, section 4.8.2: how long a message ID can be repeated by a retransmission
+EXCHANGE_LIFETIME = 247.0
+
+class DedupCache:
+    # Bounded LRU of responses keyed by request identity. A retransmitted CON request
+    # is answered from here instead of running its handler again. Entries expire
+    # after EXCHANGE_LIFETIME and the least recently used ones are evicted once
+    # max_entries or max_bytes (of response payloads) is reached.
+    def __init__(self, max_entries=10000, max_bytes=4 * 1024 * 1024, lifetime=EXCHANGE_LIFETIME, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lifetime = lifetime
+        self.clock = clock
+        # key -> (expiry time, response), oldest first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        self._expire()
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= self.clock():
+            self._remove(key)
+            self.expirations += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, response):
+        if self.max_entries <= 0 or len(response.payload) > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self._remove(key)
+
+        self.entries[key] = (self.clock() + self.lifetime, response)
+        self.size += len(response.payload)
+
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted.payload)
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, response = self.entries.pop(key)
+        self.size -= len(response.payload)
+
+    def _expire(self):
+        # only hits reorder the entries, so expired entries are mostly at the front;
+        # the ones moved back by a hit are checked in get() or evicted later
+        now = self.clock()
+        while len(self.entries) > 0:
+            key, (expiry, _) = next(iter(self.entries.items()))
+            if expiry > now:
+                break
+            self._remove(key)
+            self.expirations += 1
+
+    def stats(self):
+        return {
+            'dedup_hits': self.hits,
+            'dedup_misses': self.misses,
+            'dedup_evictions': self.evictions,
+            'dedup_expirations': self.expirations,
+            'dedup_entries': len(self.entries),
+        }
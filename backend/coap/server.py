@@ -1,48 +1,316 @@
 import datetime
 import logging
+import argparse
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import time
+from collections import Counter, OrderedDict
 
 import asyncio
 
 import aiocoap.resource as resource
 import aiocoap
+from aiocoap.numbers.optionnumbers import OptionNumber
+from aiocoap.optiontypes import BlockOption
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-MSG_TYPE={
-    'short': b"It is a simple short response.\n",
-    'middle': b"Lorem ipsum dolor sit amet, consectetur adipiscing elit. Integer nisl magna, varius et nunc ut, pharetra posuere ante. "\
-            b"Praesent vestibulum tempor vehicula. Nunc vehicula a elit at rhoncus. Proin luctus ex at sapien pretium, a consequat magna maximus. "\
-            b"Nunc scelerisque nunc et enim pellentesque, eu porta diam aliquet. Mauris mollis congue justo, ac volutpat nibh consequat sit amet. "\
-            b"Vestibulum ante ipsum primis in faucibus orci luctus et ultrices posuere cubilia curae; Curabitur congue nibh ut efficitur est.\n\n",
-    'long': b"Lorem ipsum dolor sit amet, consectetur adipiscing elit. Integer quam nulla, tincidunt nec dolor ut, "\
-            b"convallis finibus est. Aenean pretium nulla eu dolor ultrices maximus. Phasellus laoreet metus et pellentesque ornare. "\
-            b"Praesent ac purus sed quam pulvinar cursus. Suspendisse dictum mollis est non tincidunt. In posuere mauris justo, "\
-            b"nec rhoncus tortor vestibulum at. Aenean in lorem augue. Maecenas ante elit, tempor id ante in, pellentesque congue nisl.\n\n"\
-            b"Curabitur sit amet pulvinar turpis. Suspendisse potenti. Aenean porta, arcu sed sollicitudin commodo, ante dolor suscipit eros, "\
-            b"vitae eleifend velit felis ac risus. Sed vehicula mi sed ultrices ullamcorper. Nulla fringilla ac lacus viverra egestas. "\
-            b"Suspendisse metus ligula, ultricies et egestas in, sodales vitae nunc. Quisque aliquam dolor fringilla venenatis aliquam. "\
-            b"Praesent tellus diam, luctus eu risus in, scelerisque auctor nunc. Donec odio nibh, venenatis eget condimentum eu, tristique "\
-            b"facilisis nunc. Proin arcu ex, congue malesuada consequat a, tempor eu justo. Vivamus sapien magna, venenatis at interdum ut, "\
-            b"eleifend eget velit.\n\n"\
-            b"Sed a efficitur eros. Vestibulum mattis blandit malesuada. Donec leo quam, facilisis ac tortor eu, fringilla tempus neque. "\
-            b"Vestibulum volutpat, diam vel vulputate molestie, nunc velit mollis ipsum, vitae pulvinar urna neque nec leo. Curabitur elit tortor, "\
-            b"venenatis sed malesuada at, efficitur quis risus. Fusce ac tellus et ipsum viverra consequat. Proin pretium commodo lacus, "\
-            b"quis vestibulum nisl consequat eu. Morbi maximus, neque in tempus finibus, lacus odio tempus magna, sit amet pretium libero.\n\n"
-}
-
-
-class CoAPResource(resource.Resource):
-    def __init__(self, url):
+from compress import deflate
+from dedup import DedupCache, EXCHANGE_LIFETIME
+from payloads import MSG_TYPE
+
+# Content-Format from the experimental range (RFC 7252, section 12.3) for the
+# deflate (zlib) coded text payloads, requested by clients with the Accept option
+CONTENT_FORMAT_DEFLATE = 65000
+
+# block sizes 16B (szx=0) to 1024B (szx=6), BERT (szx=7) is TCP only
+BLOCK_SZX = range(0, 7)
+
+def slice_blocks(payload):
+    # szx -> [(block payload, Block2 option, Size2 option)], Size2 is only sent with the first block
+    blocks = {}
+    for szx in BLOCK_SZX:
+        size = 2 ** (szx + 4)
+        blocks[szx] = [(payload[start:start + size],
+                        BlockOption.BlockwiseTuple(start // size, start + size < len(payload), szx),
+                        len(payload) if start == 0 else None)
+                       for start in range(0, max(len(payload), 1), size)]
+
+    return blocks
+
+# memory of all Block1 uploads together, of a single upload and how long an
+# incomplete upload is kept without receiving its next block
+BLOCK1_MAX_BYTES = 16 * 1024 * 1024
+BLOCK1_MAX_TRANSFER_BYTES = 64 * 1024
+BLOCK1_TIMEOUT = 60.0
+# options that differ between the blocks of one Block1 upload
+BLOCK1_KEY_IGNORED = (OptionNumber.BLOCK1, OptionNumber.BLOCK2, OptionNumber.SIZE1, OptionNumber.OBSERVE)
+
+class Block1Error(aiocoap.error.ConstructionRenderableError):
+    def __init__(self, code, message, **options):
+        super().__init__(message)
+        self.code = code
+        self.options = options
+
+    def to_message(self):
+        message = super().to_message()
+        for name, value in self.options.items():
+            setattr(message.opt, name, value)
+
+        return message
+
+class Block1Reassembler:
+    # Spools Block1 uploads (RFC 7959) into one buffer per client endpoint and resource.
+    # All buffers together are capped at max_bytes, so many parallel uploads cannot
+    # exhaust the memory, and uploads idle for longer than `timeout` are dropped.
+    # A retransmitted block is acknowledged again, but never appended twice. The
+    # response to the last block is kept for EXCHANGE_LIFETIME, so a retransmitted
+    # last block is answered again after the upload completed.
+    def __init__(self, max_bytes=BLOCK1_MAX_BYTES, max_transfer_bytes=BLOCK1_MAX_TRANSFER_BYTES,
+                 timeout=BLOCK1_TIMEOUT, lifetime=EXCHANGE_LIFETIME, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.max_transfer_bytes = max_transfer_bytes
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.clock = clock
+        # key -> [buffer, time of the last block], least recently active first
+        self.transfers = OrderedDict()
+        # key -> (expiry time, last Block1 option, last payload, response), oldest first
+        self.finished = OrderedDict()
+        self.size = 0
+        self.completed = 0
+        self.duplicates = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    def feed(self, key, block1, payload, size1=None):
+        # Returns the whole payload after the last block, None while more blocks are expected
+        self._expire()
+
+        if (size1 or 0) > self.max_transfer_bytes or block1.start + len(payload) > self.max_transfer_bytes:
+            self._reject(key)
+            raise Block1Error(aiocoap.REQUEST_ENTITY_TOO_LARGE, 'Upload too large', size1=self.max_transfer_bytes)
+
+        if block1.more and len(payload) != block1.size:
+            self._reject(key)
+            raise Block1Error(aiocoap.BAD_REQUEST, 'Block1 payload does not match the block size')
+
+        transfer = self.transfers.get(key)
+        if transfer is not None:
+            buffer = transfer[0]
+            if block1.start + len(payload) <= len(buffer) and buffer[block1.start:block1.start + len(payload)] == payload:
+                self.duplicates += 1
+                transfer[1] = self.clock()
+                return None
+            if block1.block_number == 0:
+                # a different first block starts the upload over
+                self._remove(key)
+                transfer = None
+
+        if transfer is None:
+            if block1.block_number != 0:
+                self.rejected += 1
+                raise Block1Error(aiocoap.REQUEST_ENTITY_INCOMPLETE, 'Unknown Block1 upload')
+            transfer = [bytearray(), 0]
+            self.transfers[key] = transfer
+            self.finished.pop(key, None)
+
+        buffer = transfer[0]
+        if block1.start != len(buffer):
+            self._reject(key)
+            raise Block1Error(aiocoap.REQUEST_ENTITY_INCOMPLETE, 'Missing Block1 block')
+
+        if block1.more and self.size + len(payload) > self.max_bytes:
+            # the client may retry this block once other uploads freed their buffers
+            self.rejected += 1
+            raise Block1Error(aiocoap.SERVICE_UNAVAILABLE, 'Too many uploads in progress', max_age=int(self.timeout))
+
+        if not block1.more:
+            self._remove(key)
+            self.completed += 1
+            return bytes(buffer + payload)
+
+        buffer.extend(payload)
+        self.size += len(payload)
+        transfer[1] = self.clock()
+        self.transfers.move_to_end(key)
+        return None
+
+    def finish(self, key, block1, payload, response):
+        # keeps the response to the last block of a completed upload
+        self.finished.pop(key, None)
+        self.finished[key] = (self.clock() + self.lifetime, block1, payload, response)
+
+    def replay(self, key, block1, payload):
+        # the kept response if this is the last block of a completed upload again
+        self._expire()
+        entry = self.finished.get(key)
+        if entry is None or entry[1] != block1 or entry[2] != payload:
+            return None
+        self.duplicates += 1
+        return entry[3]
+
+    def _remove(self, key):
+        buffer, _ = self.transfers.pop(key)
+        self.size -= len(buffer)
+
+    def _reject(self, key):
+        if key in self.transfers:
+            self._remove(key)
+        self.rejected += 1
+
+    def _expire(self):
+        deadline = self.clock() - self.timeout
+        while len(self.transfers) > 0:
+            key, (_, last) = next(iter(self.transfers.items()))
+            if last > deadline:
+                break
+            self._remove(key)
+            self.timeouts += 1
+
+        now = self.clock()
+        while len(self.finished) > 0 and next(iter(self.finished.values()))[0] <= now:
+            self.finished.popitem(last=False)
+
+    def stats(self):
+        return {
+            'block1_transfers': len(self.transfers),
+            'block1_finished': len(self.finished),
+            'block1_bytes': self.size,
+            'block1_completed': self.completed,
+            'block1_duplicates': self.duplicates,
+            'block1_timeouts': self.timeouts,
+            'block1_rejected': self.rejected,
+        }
+
+class CoAPResource(resource.ObservableResource):
+    def __init__(self, url, stats=None, block_cache=True, dedup=None, block1=None, publish=None):
         super().__init__()
         self.url = url
-        self.content = MSG_TYPE[url]
+        self.stats = stats if stats is not None else Counter()
+        self.block_cache = block_cache
+        self.dedup = dedup
+        self.block1 = block1
+        # publish(url, content) passes a PUT on to the other workers
+        self.publish = publish
+        self.set_content(MSG_TYPE[url])
+
+    def set_content(self, content):
+        self.content = content
+        # compressed once, and only offered where it is smaller than the original
+        deflated = deflate(self.content)
+        self.deflated = deflated if len(deflated) < len(self.content) else None
+        # every block of both variants is sliced once, a Block2 request becomes a lookup
+        self.blocks = {False: slice_blocks(self.content)}
+        if self.deflated is not None:
+            self.blocks[True] = slice_blocks(self.deflated)
+
+    async def needs_blockwise_assembly(self, request):
+        # without the cache aiocoap renders the whole payload and slices the requested block,
+        # without the reassembler it keeps Block1 uploads in memory until they complete
+        if request.code == aiocoap.GET:
+            return not self.block_cache
+        return self.block1 is None
+
+    def update_observation_count(self, count):
+        self.stats[f'observers_{self.url}'] = count
+        logging.getLogger("coap-server").info(f'[coap://{self.url}|OBSERVE][{count} observers]')
+
+    async def render(self, request):
+        # Retransmitted CON requests are answered with the cached response instead of
+        # running the handler again. The key is the full endpoint and the MID, since
+        # NB-IoT devices behind a carrier-grade NAT share the address and their MIDs
+        # may collide. Observations are re-rendered on every change, so they are
+        # never cached.
+        if self.dedup is None or request.mtype != aiocoap.CON or request.opt.observe is not None:
+            return await self.render_blockwise(request)
+
+        key = (request.remote.sockaddr, request.mid, request.token, self.url)
+        response = self.dedup.get(key)
+        if response is not None:
+            logging.getLogger("coap-server").debug(f'[coap://{self.url}|{request.code}][duplicate MID {request.mid}, replayed response]')
+            return response.copy()
+
+        response = await self.render_blockwise(request)
+        self.dedup.put(key, response.copy())
+        return response
+
+    async def render_blockwise(self, request):
+        # Block1 uploads reach the handler only once, with the reassembled payload
+        block1 = request.opt.block1
+        if self.block1 is None or block1 is None or request.code == aiocoap.GET:
+            return await super().render(request)
+
+        # keyed by the full endpoint, NB-IoT devices behind a carrier-grade NAT share the
+        # address, and by the options all blocks of one request share (RFC 7959, 2.4)
+        key = (request.remote.blockwise_key, request.get_cache_key(BLOCK1_KEY_IGNORED))
+        response = self.block1.replay(key, block1, request.payload)
+        if response is not None:
+            return response.copy()
+
+        payload = self.block1.feed(key, block1, request.payload, request.opt.size1)
+        if payload is None:
+            response = aiocoap.Message(mtype=request.mtype, code=aiocoap.CONTINUE)
+        else:
+            response = await super().render(request.copy(payload=payload))
+        response.opt.block1 = block1
+        if payload is not None:
+            self.block1.finish(key, block1, request.payload, response.copy())
+
+        return response
 
     async def render_get(self, request):
+        self.stats['get'] += 1
+        payload = self.content
+        compressed = request.opt.accept == CONTENT_FORMAT_DEFLATE and self.deflated is not None
+        if compressed:
+            payload = self.deflated
+
+        block2 = request.opt.block2 if self.block_cache else None
+        if self.block_cache and block2 is None and len(payload) > request.remote.maximum_payload_size:
+            block2 = BlockOption.BlockwiseTuple(0, False, request.remote.maximum_block_size_exp)
+        size2 = None
+        if block2 is not None:
+            blocks = self.blocks[compressed][min(block2.size_exponent, BLOCK_SZX[-1])]
+            if block2.block_number >= len(blocks):
+                raise aiocoap.error.BadRequest('Block request out of bounds')
+            payload, block2, size2 = blocks[block2.block_number]
+
         if request.mtype == aiocoap.NON:
-            return aiocoap.Message(payload=self.content, mtype=aiocoap.NON)
-        return aiocoap.Message(payload=self.content)
+            response = aiocoap.Message(payload=payload, mtype=aiocoap.NON)
+        else:
+            response = aiocoap.Message(payload=payload)
+
+        if compressed:
+            response.opt.content_format = CONTENT_FORMAT_DEFLATE
+        if block2 is not None:
+            response.opt.block2 = block2
+            response.opt.size2 = size2
+        self.stats['bytes_sent'] += len(payload)
+        return response
+
+    async def render_put(self, request):
+        # every observer gets the new content as a notification (RFC 7641)
+        self.stats['put'] += 1
+        if request.payload != self.content:
+            self.update(request.payload)
+            if self.publish is not None:
+                self.publish(self.url, self.content)
+
+        return aiocoap.Message(mtype=request.mtype, code=aiocoap.CHANGED)
+
+    def update(self, content):
+        self.set_content(content)
+        self.updated_state()
+        logging.getLogger("coap-server").info(f'[coap://{self.url}|PUT][{len(self.content)}B][notified observers]')
 
     async def render_post(self, request):
-        if request.payload == self.content:
+        self.stats['post'] += 1
+        self.stats['bytes_received'] += len(request.payload)
+        if request.payload == MSG_TYPE[self.url]:
             logging.getLogger("coap-server").info(f'[coap://{self.url}|POST][Succesfully received correct payload!]')
             return aiocoap.Message(mtype=request.mtype, code=aiocoap.CREATED)
 
@@ -52,19 +320,149 @@ class CoAPResource(resource.Resource):
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("coap-server").setLevel(logging.DEBUG)
 
-def main():
-    # Resource tree creation
+def build_site(stats, block_cache=True, dedup=None, block1=None, publish=None, resources=None):
+    # Resource tree creation; the CoAP resources are also added to `resources` by URL
     root = resource.Site()
 
     root.add_resource(['.well-known', 'core'],
             resource.WKCResource(root.get_resources_as_linkheader))
-    root.add_resource(['short'], CoAPResource('short'))
-    root.add_resource(['middle'], CoAPResource('middle'))
-    root.add_resource(['long'], CoAPResource('long'))
+    for url in ('short', 'middle', 'long'):
+        coap_resource = CoAPResource(url, stats, block_cache, dedup, block1, publish)
+        root.add_resource([url], coap_resource)
+        if resources is not None:
+            resources[url] = coap_resource
+
+    return root
+
+async def report_stats(worker_id, stats, dedup, block1, stats_queue, interval):
+    while True:
+        await asyncio.sleep(interval)
+        stats_queue.put(('stats', worker_id, dict(stats, **dedup.stats(), **block1.stats())))
+
+async def log_stats(stats, dedup, block1, interval):
+    # the report of a single worker, which has no parent to merge its stats
+    last = Counter()
+    last_time = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        current = Counter(dict(stats, **dedup.stats(), **block1.stats()))
+        requests = current['get'] + current['post'] - last['get'] - last['post']
+        print(f'[coap-server][{dict(current)}][{requests / (now - last_time):.1f} req/s]')
+        last, last_time = current, now
+
+async def apply_updates(resources, update_queue):
+    # PUTs received by the other workers, so their observers are notified as well
+    loop = asyncio.get_event_loop()
+    while True:
+        url, content = await loop.run_in_executor(None, update_queue.get)
+        if resources[url].content != content:
+            resources[url].update(content)
+
+def run_worker(worker_id, args, stats_queue=None, update_queue=None):
+    # Every worker runs its own event loop, aiocoap Context and resource tree. aiocoap
+    # binds the UDP socket with SO_REUSEPORT, so the kernel spreads the clients over
+    # the workers (by address hash, a client always reaches the same worker). A PUT
+    # goes through the parent to the other workers, which update their copy.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    bind = (args.host, args.port)
+    stats = Counter()
+    dedup = DedupCache(args.dedup_entries, args.dedup_bytes, args.dedup_lifetime)
+    block1 = Block1Reassembler(args.block1_bytes, args.block1_transfer_bytes, args.block1_timeout)
+    publish = None
+    if stats_queue is not None:
+        publish = lambda url, content: stats_queue.put(('put', worker_id, (url, content)))
+    resources = {}
+    root = build_site(stats, not args.no_block_cache, dedup if args.dedup_entries > 0 else None, block1, publish, resources)
+    loop.run_until_complete(aiocoap.Context.create_server_context(root, bind=bind))
+    if stats_queue is not None:
+        loop.create_task(report_stats(worker_id, stats, dedup, block1, stats_queue, args.stats_interval))
+    else:
+        loop.create_task(log_stats(stats, dedup, block1, args.stats_interval))
+    if update_queue is not None:
+        loop.create_task(apply_updates(resources, update_queue))
+
+    logging.getLogger("coap-server").info(f'[worker {worker_id}][listening on {bind}]')
+    loop.run_forever()
+
+def merge_stats(worker_stats):
+    merged = Counter()
+    for stats in worker_stats.values():
+        merged.update(stats)
+
+    return merged
+
+def main():
+    parser = argparse.ArgumentParser(description='CoAP server')
+    parser.add_argument('--host', type=str, default='::')
+    parser.add_argument('--port', type=int, default=31416)
+    parser.add_argument('--workers', type=int, default=1, help='number of server processes sharing the port')
+    parser.add_argument('--stats-interval', type=float, default=5.0, help='seconds between merged stats reports')
+    parser.add_argument('--quiet', action='store_true', help='only log warnings')
+    parser.add_argument('--no-block-cache', action='store_true', help='slice Block2 responses per request')
+    parser.add_argument('--dedup-entries', type=int, default=10000, help='responses kept for retransmitted CON requests, 0 disables')
+    parser.add_argument('--dedup-bytes', type=int, default=4 * 1024 * 1024, help='payload bytes kept for retransmitted CON requests')
+    parser.add_argument('--dedup-lifetime', type=float, default=EXCHANGE_LIFETIME, help='seconds a response is kept')
+    parser.add_argument('--block1-bytes', type=int, default=BLOCK1_MAX_BYTES, help='memory of all incomplete Block1 uploads')
+    parser.add_argument('--block1-transfer-bytes', type=int, default=BLOCK1_MAX_TRANSFER_BYTES, help='largest Block1 upload')
+    parser.add_argument('--block1-timeout', type=float, default=BLOCK1_TIMEOUT, help='seconds an incomplete Block1 upload is kept')
+    args = parser.parse_args()
+
+    if args.quiet:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("coap-server").setLevel(logging.WARNING)
+
+    if args.workers == 1:
+        run_worker(0, args)
+        return
+
+    if not aiocoap.defaults.has_reuse_port():
+        parser.error('SO_REUSEPORT is not available, only a single worker can be used!')
+
+    # terminating the parent (e.g. from benchmark.py) must also stop the workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # workers send ('stats', worker id, stats) and ('put', worker id, (url, content)),
+    # PUTs are passed on to the update queues of the other workers
+    stats_queue = multiprocessing.Queue()
+    update_queues = [multiprocessing.Queue() for _ in range(args.workers)]
+    workers = [multiprocessing.Process(target=run_worker, args=(i, args, stats_queue, update_queues[i]), daemon=True)
+               for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+
+    # latest snapshot of every worker, merged into one report
+    worker_stats = {}
+    last = Counter()
+    last_time = time.monotonic()
+    try:
+        while True:
+            try:
+                kind, worker_id, data = stats_queue.get(timeout=args.stats_interval)
+                if kind == 'put':
+                    for i, update_queue in enumerate(update_queues):
+                        if i != worker_id:
+                            update_queue.put(data)
+                else:
+                    worker_stats[worker_id] = data
+            except queue.Empty:
+                pass
 
-    asyncio.Task(aiocoap.Context.create_server_context(root, bind=('::', 31416)))
+            now = time.monotonic()
+            if now - last_time < args.stats_interval:
+                continue
 
-    asyncio.get_event_loop().run_forever()
+            merged = merge_stats(worker_stats)
+            requests = merged['get'] + merged['post'] - last['get'] - last['post']
+            print(f'[coap-server][{len(worker_stats)}/{args.workers} workers][{dict(merged)}][{requests / (now - last_time):.1f} req/s]')
+            last, last_time = merged, now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
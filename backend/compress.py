@@ -0,0 +1,10 @@
+# Compression shared by the HTTP, CoAP and MQTT backends. The device inflates
+# with MicroPython's uzlib, which needs a dictionary of 2**COMPRESS_WBITS bytes,
+# so the small window bounds its memory use.
+import zlib
+
+COMPRESS_WBITS = 10
+
+def deflate(body):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, COMPRESS_WBITS)
+    return compressor.compress(body) + compressor.flush()
@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+import resource
+
+from multipart import FileUpload, MultipartError
+from resources import MSG_TYPE, etag_matches, parse_range, select_variant
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+PORT = 31415
+BACKLOG = 4096
+# NB-IoT devices push the request through 512B AT chunks, so a single request
+# can take tens of seconds to arrive
+READ_TIMEOUT = 120.0
+# how long an idle persistent connection is kept open between requests
+KEEP_ALIVE_TIMEOUT = 75.0
+MAX_HEADER_SIZE = 8192
+# the body is verified while it streams in, so this only bounds the transfer time
+MAX_BODY_SIZE = 16 * 1024 * 1024
+READ_CHUNK_SIZE = 4096
+
+REASONS = {
+    200: 'OK',
+    206: 'Partial Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    408: 'Request Timeout',
+    411: 'Length Required',
+    413: 'Payload Too Large',
+    416: 'Range Not Satisfiable',
+    431: 'Request Header Fields Too Large',
+}
+
+class HTTPError(Exception):
+    def __init__(self, status, body=b'R_ERR', keep_alive=False):
+        super().__init__(status)
+        self.status = status
+        self.body = body
+        # errors raised before the request body was consumed must close the connection
+        self.keep_alive = keep_alive
+
+def build_response(status, body, content_type='text/plain; charset=utf-8', keep_alive=False, headers=()):
+    header = 'HTTP/1.1 {} {}\r\n'.format(status, REASONS[status])
+    if status != 304:
+        header += 'Content-Type: {}\r\nContent-Length: {}\r\n'.format(content_type, len(body))
+    for key, value in headers:
+        header += '{}: {}\r\n'.format(key, value)
+    header += 'Connection: {}\r\n\r\n'.format('keep-alive' if keep_alive else 'close')
+
+    return header.encode('latin-1') + body
+
+def is_keep_alive(version, headers):
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.1':
+        return connection != 'close'
+
+    return connection == 'keep-alive'
+
+async def read_head(reader, timeout=READ_TIMEOUT):
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+    except asyncio.LimitOverrunError:
+        raise HTTPError(431)
+    except asyncio.TimeoutError:
+        raise HTTPError(408)
+
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ', 2)
+    except ValueError:
+        raise HTTPError(400)
+
+    headers = {}
+    for line in lines[1:]:
+        if len(line) == 0:
+            continue
+        key, _, value = line.partition(':')
+        headers[key.strip().lower()] = value.strip()
+
+    return method, target, version, headers
+
+def get_content_length(headers):
+    try:
+        length = int(headers['content-length'])
+    except (KeyError, ValueError):
+        raise HTTPError(411)
+
+    if length < 0:
+        raise HTTPError(400)
+
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(413)
+
+    return length
+
+async def stream_body(reader, length, consumer):
+    remaining = length
+    while remaining > 0:
+        try:
+            chunk = await asyncio.wait_for(reader.read(min(remaining, READ_CHUNK_SIZE)), READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPError(408)
+        if len(chunk) == 0:
+            raise asyncio.IncompleteReadError(b'', remaining)
+        consumer(chunk)
+        remaining -= len(chunk)
+
+class HTTPServer:
+    def __init__(self, quiet=False):
+        self.quiet = quiet
+        self.active = 0
+
+    def log(self, msg):
+        if not self.quiet:
+            print(msg)
+
+    async def handle(self, reader, writer):
+        self.active += 1
+        remote_addr = writer.get_extra_info('peername')[0]
+        timeout = READ_TIMEOUT
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await read_head(reader, timeout)
+                except HTTPError as e:
+                    # an idle persistent connection is closed silently
+                    if e.status == 408 and timeout == KEEP_ALIVE_TIMEOUT:
+                        break
+                    raise
+                except asyncio.IncompleteReadError:
+                    break
+
+                keep_alive = is_keep_alive(head[2], head[3])
+                try:
+                    response = await self.handle_request(reader, remote_addr, head, keep_alive)
+                except HTTPError as e:
+                    keep_alive = keep_alive and e.keep_alive
+                    response = build_response(e.status, e.body, keep_alive=keep_alive)
+
+                writer.write(response)
+                await writer.drain()
+                timeout = KEEP_ALIVE_TIMEOUT
+        except HTTPError as e:
+            writer.write(build_response(e.status, e.body))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.active -= 1
+            writer.close()
+
+    async def handle_request(self, reader, remote_addr, head, keep_alive):
+        method, target, _, headers = head
+        name = target.lstrip('/').split('?', 1)[0]
+        if name not in MSG_TYPE:
+            raise HTTPError(404, keep_alive=method == 'GET')
+
+        if method == 'POST':
+            length = get_content_length(headers)
+            # malformed bodies are not drained, so the connection is closed after the error
+            try:
+                upload = FileUpload(headers.get('content-type', ''), MSG_TYPE[name])
+                await stream_body(reader, length, upload.feed)
+                upload.close()
+            except MultipartError:
+                raise HTTPError(400)
+
+            file_status = 'OK' if upload.ok else 'NOT_OK'
+
+            self.log(f'[{remote_addr}][POST: /{name}][{length}B][{upload.size}B][{file_status}][sha256: {upload.sha256}]')
+
+            if file_status == 'NOT_OK':
+                raise HTTPError(400, keep_alive=True)
+
+            return build_response(200, b'R_OK', keep_alive=keep_alive)
+
+        if method == 'GET':
+            # ETag, 304 and ranges all apply to the selected (possibly compressed) variant
+            body, etag, encoding = select_variant(name, headers.get('accept-encoding'))
+            if etag_matches(headers.get('if-none-match'), etag):
+                self.log(f'[{remote_addr}][GET: /{name}][304][{len(body)}B]')
+                return build_response(304, b'', keep_alive=keep_alive, headers=[('ETag', etag)])
+
+            extra_headers = [('ETag', etag), ('Accept-Ranges', 'bytes'), ('Vary', 'Accept-Encoding')]
+            if encoding is not None:
+                extra_headers.append(('Content-Encoding', encoding))
+            byte_range = None
+            # a range is only applied if the client's copy is still current
+            if 'range' in headers and headers.get('if-range', etag) == etag:
+                try:
+                    byte_range = parse_range(headers['range'], len(body))
+                except ValueError:
+                    self.log(f'[{remote_addr}][GET: /{name}][416][{len(body)}B]')
+                    return build_response(416, b'', keep_alive=keep_alive,
+                        headers=[('Content-Range', f'bytes */{len(body)}')])
+
+            if byte_range is not None:
+                first, last = byte_range
+                extra_headers.append(('Content-Range', f'bytes {first}-{last}/{len(body)}'))
+                self.log(f'[{remote_addr}][GET: /{name}][206][{last - first + 1}B]')
+                return build_response(206, body[first:last + 1], 'text/plain', keep_alive, extra_headers)
+
+            self.log(f'[{remote_addr}][GET: /{name}][200][{len(body)}B]')
+            return build_response(200, body, 'text/plain', keep_alive, extra_headers)
+
+        raise HTTPError(405)
+
+def raise_nofile_limit():
+    # every slow device holds one descriptor for the whole request
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    return hard
+
+async def serve(host, port, quiet=False):
+    http_server = HTTPServer(quiet)
+    server = await asyncio.start_server(http_server.handle, host, port,
+        backlog=BACKLOG, limit=MAX_HEADER_SIZE, reuse_address=True)
+
+    print(f'[async-http][listening on {host}:{port}][uvloop: {uvloop is not None}]')
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Asyncio HTTP server')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--quiet', action='store_true', help='do not log every request')
+    args = parser.parse_args()
+
+    if uvloop is not None:
+        uvloop.install()
+
+    raise_nofile_limit()
+    asyncio.run(serve(args.host, args.port, args.quiet))
@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from resources import MSG_TYPE
+from stats import percentile
+
+BOUNDARY = '------------------------627c1552744e7f41'
+
+def build_request(method, path, host):
+    if method == 'GET':
+        return ('GET /%s HTTP/1.0\r\nHost: %s\r\n\r\n' % (path, host)).encode()
+
+    # same request as send_http_data() in fipy/main.py
+    data = '--%s\r\n'\
+        'Content-Disposition: form-data; name="file"; filename="short.txt"\r\n'\
+        'Content-Type: text/plain\r\n\r\n'\
+        '%s\r\n'\
+        '--%s--\r\n' % (BOUNDARY, MSG_TYPE[path].decode(), BOUNDARY)
+
+    header = 'POST /%s HTTP/1.0\r\n'\
+        'Host: %s\r\nContent-Length: %d\r\n'\
+        'Content-Type: multipart/form-data; boundary=%s\r\n\r\n' % (path, host, len(data), BOUNDARY)
+
+    return (header + data).encode()
+
+def start_server(kind, host, port, workers):
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    if kind == 'async':
+        cmd = [sys.executable, 'async_server.py', '--host', host, '--port', str(port), '--quiet']
+    else:
+        cmd = ['gunicorn', '--workers', str(workers), '--bind', f'{host}:{port}', 'wsgi:app']
+
+    proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+
+    proc.kill()
+    raise RuntimeError(f'{kind} server did not start on {host}:{port}')
+
+async def slow_client(host, port, request, chunk_size, chunk_delay, timeout):
+    start = time.monotonic()
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        # mimics NBIOTTCPSocket.send(), which pushes the request in AT+CSOSEND chunks
+        for i in range(0, len(request), chunk_size):
+            writer.write(request[i:i + chunk_size])
+            await writer.drain()
+            await asyncio.sleep(chunk_delay)
+
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+
+    if not response.startswith(b'HTTP/1.') or response.split(b' ', 2)[1] != b'200':
+        raise RuntimeError(response[:64])
+
+    return time.monotonic() - start
+
+async def run_clients(args, request):
+    results = await asyncio.gather(*[
+        slow_client(args.host, args.port, request, args.chunk_size, args.chunk_delay, args.timeout)
+        for _ in range(args.clients)
+    ], return_exceptions=True)
+
+    latencies = sorted(r for r in results if isinstance(r, float))
+    errors = [r for r in results if not isinstance(r, float)]
+    return latencies, errors
+
+async def download(host, port, path, fail_at, use_range, chunk_size, chunk_delay):
+    # Downloads /path over a throttled link that drops at each offset in fail_at once.
+    # Every drop is followed by a retry, either from byte 0 or with a Range request.
+    failures = sorted(fail_at)
+    body = b''
+    etag = None
+    transferred = 0
+    attempts = 0
+
+    while True:
+        attempts += 1
+        request = 'GET /%s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n' % (path, host)
+        if use_range and len(body) > 0 and etag is not None:
+            request += 'Range: bytes=%d-\r\nIf-Range: %s\r\n' % (len(body), etag)
+
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            writer.write((request + '\r\n').encode())
+            head = await reader.readuntil(b'\r\n\r\n')
+            transferred += len(head)
+
+            lines = head.decode('latin-1').split('\r\n')
+            status = int(lines[0].split(' ')[1])
+            headers = {}
+            for line in lines[1:]:
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            if status == 200:
+                body = b''
+            elif status != 206:
+                raise RuntimeError(f'Unexpected status {status}')
+            etag = headers.get('etag')
+
+            remaining = int(headers['content-length'])
+            dropped = False
+            while remaining > 0:
+                chunk = await reader.read(min(chunk_size, remaining))
+                await asyncio.sleep(chunk_delay)
+                if len(failures) > 0 and len(body) + len(chunk) >= failures[0]:
+                    chunk = chunk[:failures.pop(0) - len(body)]
+                    dropped = True
+                body += chunk
+                transferred += len(chunk)
+                remaining -= len(chunk)
+                if dropped:
+                    break
+        finally:
+            writer.close()
+
+        if not dropped:
+            return body, transferred, attempts
+
+async def run_resume(args):
+    size = len(MSG_TYPE[args.path])
+    fail_at = [int(size * float(f)) for f in args.fail_at.split(',')]
+    results = {}
+    for use_range in (False, True):
+        start = time.monotonic()
+        body, transferred, attempts = await download(args.host, args.port, args.path, fail_at,
+            use_range, args.chunk_size, args.chunk_delay)
+        if body != MSG_TYPE[args.path]:
+            raise RuntimeError('Downloaded body does not match!')
+        results[use_range] = (transferred, time.monotonic() - start, attempts)
+
+    return fail_at, results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTTP server benchmark with simulated slow NB-IoT clients')
+    parser.add_argument('server', type=str, choices=['async', 'flask'])
+    parser.add_argument('--scenario', type=str, choices=['slow-clients', 'resume'], default='slow-clients',
+        help='resume: download with injected mid-transfer failures, restarting vs. Range requests')
+    parser.add_argument('--fail-at', type=str, default='0.5,0.9',
+        help='resume: fractions of the body at which the link drops')
+    parser.add_argument('--method', type=str, choices=['GET', 'POST'], default='POST')
+    parser.add_argument('--path', type=str, choices=['short', 'middle', 'long'], default='long')
+    parser.add_argument('--clients', type=int, default=1000, help='number of concurrent clients')
+    parser.add_argument('--chunk-size', type=int, default=512, help='bytes per write (per read in the resume scenario)')
+    parser.add_argument('--chunk-delay', type=float, default=0.2, help='seconds between writes (reads)')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn sync workers')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=31515)
+    parser.add_argument('--no-spawn', action='store_true', help='benchmark an already running server')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    proc = None if args.no_spawn else start_server(args.server, args.host, args.port, args.workers)
+
+    if args.scenario == 'resume':
+        try:
+            fail_at, results = asyncio.run(run_resume(args))
+        finally:
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+
+        print(f'[{args.server}][GET: /{args.path}][{len(MSG_TYPE[args.path])}B][link drops at {fail_at}B]')
+        for use_range, (transferred, elapsed, attempts) in results.items():
+            print(f'{"range resume" if use_range else "restart":>12}: {transferred}B transferred, '
+                  f'{elapsed:.2f}s, {attempts} attempts')
+        saved_bytes = results[False][0] - results[True][0]
+        saved_time = results[False][1] - results[True][1]
+        print(f'saved: {saved_bytes}B ({saved_bytes * 100 / results[False][0]:.0f}%), {saved_time:.2f}s')
+        sys.exit(0)
+
+    try:
+        request = build_request(args.method, args.path, args.host)
+        start = time.monotonic()
+        latencies, errors = asyncio.run(run_clients(args, request))
+        elapsed = time.monotonic() - start
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    print(f'[{args.server}][{args.method}: /{args.path}][{len(request)}B request][{args.clients} clients]')
+    print(f'completed: {len(latencies)}, failed: {len(errors)}, total time: {elapsed:.2f}s, '
+          f'throughput: {len(latencies) / elapsed:.1f} req/s')
+    print(f'latency p50: {percentile(latencies, 50) * 1000:.0f}ms, p99: {percentile(latencies, 99) * 1000:.0f}ms, '
+          f'max: {percentile(latencies, 100) * 1000:.0f}ms')
+    if len(errors) > 0:
+        print(f'first error: {errors[0]!r}')
@@ -0,0 +1,7 @@
+bind = '0.0.0.0:31415'
+# sync workers close the connection after every response, threaded workers
+# keep it open so devices can send several requests over one TCP connection
+worker_class = 'gthread'
+workers = 4
+threads = 64
+keepalive = 75
@@ -0,0 +1,177 @@
+import hashlib
+
+MAX_PART_HEADER_SIZE = 1024
+
+class MultipartError(Exception):
+    pass
+
+def get_boundary(content_type):
+    _, _, params = content_type.partition(';')
+    for param in params.split(';'):
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'boundary' and len(value) > 0:
+            return value.strip('"')
+
+    raise MultipartError('Missing multipart boundary!')
+
+class MultipartParser:
+    # Incremental multipart/form-data parser. Chunks of any size are passed to
+    # feed() as they arrive from the socket and part bodies are handed to the
+    # callbacks without ever holding a whole part in memory. Only a tail shorter
+    # than the delimiter is kept between feed() calls.
+    PREAMBLE, DELIMITER, HEADERS, BODY, EPILOGUE = range(5)
+
+    def __init__(self, boundary, on_part_begin, on_part_data, on_part_end):
+        self.delimiter = b'--' + boundary.encode('latin-1')
+        self.body_delimiter = b'\r\n' + self.delimiter
+        self.on_part_begin = on_part_begin
+        self.on_part_data = on_part_data
+        self.on_part_end = on_part_end
+        self.state = self.PREAMBLE
+        self.buffer = bytearray()
+
+    def feed(self, chunk):
+        self.buffer.extend(chunk)
+        while self._step():
+            pass
+
+    def close(self):
+        if self.state != self.EPILOGUE:
+            raise MultipartError('Multipart body ended unexpectedly!')
+
+    def _step(self):
+        buffer = self.buffer
+
+        if self.state == self.PREAMBLE:
+            index = buffer.find(self.delimiter)
+            if index < 0:
+                del buffer[:max(0, len(buffer) - len(self.delimiter) + 1)]
+                return False
+            del buffer[:index + len(self.delimiter)]
+            self.state = self.DELIMITER
+            return True
+
+        if self.state == self.DELIMITER:
+            if len(buffer) < 2:
+                return False
+            if buffer[:2] == b'--':
+                self.state = self.EPILOGUE
+            elif buffer[:2] == b'\r\n':
+                self.state = self.HEADERS
+            else:
+                raise MultipartError('Malformed multipart delimiter!')
+            del buffer[:2]
+            return True
+
+        if self.state == self.HEADERS:
+            index = buffer.find(b'\r\n\r\n')
+            if index < 0:
+                if len(buffer) > MAX_PART_HEADER_SIZE:
+                    raise MultipartError('Multipart part headers too large!')
+                return False
+            self.on_part_begin(self._parse_headers(bytes(buffer[:index])))
+            del buffer[:index + 4]
+            self.state = self.BODY
+            return True
+
+        if self.state == self.BODY:
+            index = buffer.find(self.body_delimiter)
+            if index < 0:
+                # the tail might be the beginning of a delimiter split across chunks
+                keep = len(self.body_delimiter) - 1
+                if len(buffer) > keep:
+                    self.on_part_data(bytes(buffer[:-keep]))
+                    del buffer[:-keep]
+                return False
+            if index > 0:
+                self.on_part_data(bytes(buffer[:index]))
+            del buffer[:index + len(self.body_delimiter)]
+            self.on_part_end()
+            self.state = self.DELIMITER
+            return True
+
+        # epilogue is ignored
+        buffer.clear()
+        return False
+
+    def _parse_headers(self, raw):
+        headers = {}
+        for line in raw.decode('latin-1').split('\r\n'):
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        return headers
+
+def get_part_name(headers):
+    for param in headers.get('content-disposition', '').split(';'):
+        key, _, value = param.strip().partition('=')
+        if key == 'name':
+            return value.strip('"')
+
+    return None
+
+class PayloadVerifier:
+    # Compares incoming chunks against the expected payload and hashes them on the
+    # fly, so the received payload never has to be kept.
+    def __init__(self, expected):
+        self.expected = memoryview(expected)
+        self.size = 0
+        self.matches = True
+        self.sha256 = hashlib.sha256()
+
+    def update(self, chunk):
+        self.sha256.update(chunk)
+        end = self.size + len(chunk)
+        if self.matches and (end > len(self.expected) or self.expected[self.size:end] != chunk):
+            self.matches = False
+        self.size = end
+
+    @property
+    def ok(self):
+        return self.matches and self.size == len(self.expected)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+class FileUpload:
+    # Streams a multipart/form-data body and verifies the part named `field`.
+    def __init__(self, content_type, expected, field='file'):
+        self.field = field
+        self.verifier = PayloadVerifier(expected)
+        self.found = False
+        self._current = None
+        self.parser = MultipartParser(get_boundary(content_type),
+            self._on_part_begin, self._on_part_data, self._on_part_end)
+
+    def feed(self, chunk):
+        self.parser.feed(chunk)
+
+    def close(self):
+        self.parser.close()
+        if not self.found:
+            raise MultipartError('Missing "{}" part!'.format(self.field))
+
+    @property
+    def ok(self):
+        return self.verifier.ok
+
+    @property
+    def size(self):
+        return self.verifier.size
+
+    @property
+    def sha256(self):
+        # digest of the received part, logged so uploads can be matched with the device side
+        return self.verifier.hexdigest()
+
+    def _on_part_begin(self, headers):
+        self._current = get_part_name(headers)
+        if self._current == self.field:
+            self.found = True
+
+    def _on_part_data(self, data):
+        if self._current == self.field:
+            self.verifier.update(data)
+
+    def _on_part_end(self):
+        self._current = None
@@ -0,0 +1,93 @@
+import hashlib
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compress import deflate
+from payloads import MSG_TYPE
+
+def make_etag(body):
+    return '"{}"'.format(hashlib.sha256(body).hexdigest()[:16])
+
+# strong validators, computed once since the resources never change at runtime
+ETAGS = {name: make_etag(body) for name, body in MSG_TYPE.items()}
+
+# "deflate" content-coding (zlib format) of each resource, compressed once at
+# startup and only kept where it is smaller than the original
+DEFLATED = {}
+for name, body in MSG_TYPE.items():
+    deflated = deflate(body)
+    if len(deflated) < len(body):
+        DEFLATED[name] = deflated
+
+DEFLATED_ETAGS = {name: make_etag(body) for name, body in DEFLATED.items()}
+
+def accepts_deflate(accept_encoding):
+    if accept_encoding is None:
+        return False
+
+    for coding in accept_encoding.split(','):
+        coding, _, params = coding.partition(';')
+        if coding.strip().lower() not in ('deflate', '*'):
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        return q > 0
+
+    return False
+
+def select_variant(name, accept_encoding):
+    # returns the body, its ETag and its content-coding (None for identity)
+    if name in DEFLATED and accepts_deflate(accept_encoding):
+        return DEFLATED[name], DEFLATED_ETAGS[name], 'deflate'
+
+    return MSG_TYPE[name], ETAGS[name], None
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match uses the weak comparison (RFC 7232, section 3.2)
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+
+    return False
+
+def parse_range(value, length):
+    # Returns (first, last) of a single "bytes=" range, or None if the header should
+    # be ignored and the full body served. Raises ValueError if it cannot be satisfied.
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    first, sep, last = spec.strip().partition('-')
+    if len(sep) == 0 or not (first + last).isdigit():
+        return None
+
+    if len(first) == 0:
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError('Empty suffix range!')
+        return max(0, length - suffix), length - 1
+
+    first = int(first)
+    last = int(last) if len(last) > 0 else length - 1
+    if last < first:
+        return None
+    if first >= length:
+        raise ValueError('Range starts after the end of the resource!')
+
+    return first, min(last, length - 1)
@@ -0,0 +1,384 @@
+import argparse
+import asyncio
+import random
+import struct
+import time
+
+# Minimal MQTT 3.1.1 broker for local benchmarks of the device and backend clients.
+# Supports QoS 0 and 1 (QoS 2 subscriptions are granted QoS 1), retained
+# messages, last will, wildcard subscriptions and username/password auth. Every
+# session is clean: subscriptions and in-flight messages end with the connection.
+# Delivery latency, jitter and loss can be injected to emulate the radio path.
+
+PORT = 31417
+MAX_PACKET_SIZE = 256 * 1024
+# outgoing data buffered for a slow subscriber before its QoS 0 messages are dropped
+MAX_WRITE_BUFFER = 1024 * 1024
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK, \
+    UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = range(1, 15)
+
+CONNACK_ACCEPTED = 0
+CONNACK_UNACCEPTABLE_PROTOCOL = 1
+CONNACK_IDENTIFIER_REJECTED = 2
+CONNACK_BAD_CREDENTIALS = 4
+
+class ProtocolError(Exception):
+    pass
+
+# raised while decoding a truncated or malformed packet body
+DECODE_ERRORS = (struct.error, IndexError, UnicodeDecodeError)
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        encoded.append(byte | 0x80 if length > 0 else byte)
+        if length == 0:
+            return bytes(encoded)
+
+def encode_string(value):
+    return struct.pack('!H', len(value)) + value
+
+def build_packet(packet_type, flags, body):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+def build_publish(topic, payload, qos, retain=False, packet_id=None, dup=False):
+    body = encode_string(topic)
+    if qos > 0:
+        body += struct.pack('!H', packet_id)
+    return build_packet(PUBLISH, dup << 3 | qos << 1 | retain, body + payload)
+
+def topic_matches(topic_filter, topic):
+    # '+' matches one level, '#' the rest; wildcards do not match '$' topics (MQTT 4.7.2)
+    if topic_filter == topic:
+        return True
+    if topic.startswith(b'$') and topic_filter[:1] in (b'+', b'#'):
+        return False
+
+    filter_levels = topic_filter.split(b'/')
+    topic_levels = topic.split(b'/')
+    for i, level in enumerate(filter_levels):
+        if level == b'#':
+            return True
+        if i >= len(topic_levels) or (level != b'+' and level != topic_levels[i]):
+            return False
+
+    return len(filter_levels) == len(topic_levels)
+
+async def read_packet(reader):
+    header = await reader.readexactly(1)
+    length = 0
+    for shift in range(0, 28, 7):
+        byte = (await reader.readexactly(1))[0]
+        length |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+    else:
+        raise ProtocolError('Malformed remaining length')
+
+    if length > MAX_PACKET_SIZE:
+        raise ProtocolError('Packet too large')
+
+    return header[0] >> 4, header[0] & 0x0F, await reader.readexactly(length)
+
+class Session:
+    def __init__(self, broker, writer):
+        self.broker = broker
+        self.writer = writer
+        self.client_id = None
+        self.subscriptions = {}
+        self.will = None
+        self.next_packet_id = 0
+        # packet id -> (time sent, topic, payload) of QoS 1 messages waiting for PUBACK
+        self.inflight = {}
+
+    def allocate_packet_id(self):
+        while True:
+            self.next_packet_id = self.next_packet_id % 0xFFFF + 1
+            if self.next_packet_id not in self.inflight:
+                return self.next_packet_id
+
+    def send(self, packet):
+        if not self.writer.is_closing():
+            self.writer.write(packet)
+
+class Broker:
+    def __init__(self, user=None, password=None, latency=0.0, jitter=0.0, loss=0.0, retry_interval=5.0, quiet=False):
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.retry_interval = retry_interval
+        self.quiet = quiet
+        self.sessions = {}
+        # exact topic -> {session: qos}, wildcard filter -> {session: qos}
+        self.exact = {}
+        self.wildcards = {}
+        self.retained = {}
+        self.stats = {
+            'connections': 0, 'received': 0, 'delivered': 0, 'dropped_loss': 0, 'dropped_slow': 0,
+            'retransmitted': 0, 'bytes_in': 0, 'bytes_out': 0, 'route_ns': 0,
+        }
+
+    def log(self, msg):
+        if not self.quiet:
+            print(msg)
+
+    async def handle(self, reader, writer):
+        session = Session(self, writer)
+        remote_addr = writer.get_extra_info('peername')[0]
+        retry_task = None
+        keep_alive = None
+        try:
+            packet_type, _, body = await asyncio.wait_for(read_packet(reader), 10.0)
+            if packet_type != CONNECT:
+                raise ProtocolError('Expected CONNECT')
+            keep_alive = self.decode(self.connect, session, body)
+            if keep_alive is None:
+                return
+            self.log(f'[{remote_addr}][CONNECT: {session.client_id.decode(errors="replace")}]')
+
+            retry_task = asyncio.ensure_future(self.retry_inflight(session))
+            # a client is disconnected after 1.5 keep alive periods of silence (MQTT 3.1.2.10)
+            timeout = keep_alive * 1.5 if keep_alive > 0 else None
+            while True:
+                packet_type, flags, body = await asyncio.wait_for(read_packet(reader), timeout)
+                self.stats['bytes_in'] += len(body) + 2
+                if packet_type == DISCONNECT:
+                    session.will = None
+                    break
+                self.decode(self.dispatch, session, packet_type, flags, body)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ProtocolError) as e:
+            self.log(f'[{remote_addr}][closed: {type(e).__name__}]')
+        finally:
+            if retry_task is not None:
+                retry_task.cancel()
+            self.disconnect(session)
+            writer.close()
+
+    def decode(self, handler, *args):
+        # a malformed packet closes the connection (MQTT 4.8) instead of ending the task
+        try:
+            return handler(*args)
+        except DECODE_ERRORS as e:
+            raise ProtocolError(f'Malformed packet: {type(e).__name__}: {e}')
+
+    def connect(self, session, body):
+        # returns the keep alive interval, or None if the connection was refused
+        offset = 0
+
+        def read_string():
+            nonlocal offset
+            length, = struct.unpack_from('!H', body, offset)
+            if offset + 2 + length > len(body):
+                raise ProtocolError('Truncated CONNECT')
+            value = body[offset + 2:offset + 2 + length]
+            offset += 2 + length
+            return value
+
+        protocol = read_string()
+        level, flags, keep_alive = struct.unpack_from('!BBH', body, offset)
+        offset += 4
+        if (protocol, level) not in ((b'MQTT', 4), (b'MQIsdp', 3)):
+            session.send(build_packet(CONNACK, 0, bytes([0, CONNACK_UNACCEPTABLE_PROTOCOL])))
+            return None
+
+        session.client_id = read_string()
+        if flags & 0x04:
+            will_topic = read_string()
+            session.will = (will_topic, read_string(), min((flags >> 3) & 0x03, 1), bool(flags & 0x20))
+        user = read_string().decode() if flags & 0x80 else None
+        password = read_string().decode() if flags & 0x40 else None
+
+        if self.user is not None and (user != self.user or password != self.password):
+            session.send(build_packet(CONNACK, 0, bytes([0, CONNACK_BAD_CREDENTIALS])))
+            return None
+
+        if len(session.client_id) == 0:
+            session.client_id = b'anonymous-%d' % id(session)
+
+        # a second connection with the same client id takes over the session (MQTT 3.1.4)
+        old = self.sessions.get(session.client_id)
+        if old is not None:
+            old.writer.close()
+        self.sessions[session.client_id] = session
+        self.stats['connections'] += 1
+
+        session.send(build_packet(CONNACK, 0, bytes([0, CONNACK_ACCEPTED])))
+        return keep_alive
+
+    def disconnect(self, session):
+        for topic_filter in list(session.subscriptions):
+            self.unsubscribe(session, topic_filter)
+        if session.client_id is not None and self.sessions.get(session.client_id) is session:
+            del self.sessions[session.client_id]
+        if session.will is not None:
+            self.publish(*session.will)
+
+    def dispatch(self, session, packet_type, flags, body):
+        if packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            if qos > 1:
+                raise ProtocolError('QoS 2 is not supported')
+            length, = struct.unpack_from('!H', body)
+            topic = body[2:2 + length]
+            offset = 2 + length
+            if qos > 0:
+                packet_id, = struct.unpack_from('!H', body, offset)
+                offset += 2
+            self.stats['received'] += 1
+            self.publish(topic, body[offset:], qos, bool(flags & 0x01))
+            if qos > 0:
+                session.send(build_packet(PUBACK, 0, struct.pack('!H', packet_id)))
+
+        elif packet_type == PUBACK:
+            packet_id, = struct.unpack_from('!H', body)
+            session.inflight.pop(packet_id, None)
+
+        elif packet_type == SUBSCRIBE:
+            packet_id, = struct.unpack_from('!H', body)
+            offset = 2
+            granted = bytearray()
+            topic_filters = []
+            while offset < len(body):
+                length, = struct.unpack_from('!H', body, offset)
+                topic_filter = body[offset + 2:offset + 2 + length]
+                qos = min(body[offset + 2 + length], 1)
+                offset += 3 + length
+                granted.append(qos)
+                topic_filters.append(topic_filter)
+                self.subscribe(session, topic_filter, qos)
+            session.send(build_packet(SUBACK, 0, struct.pack('!H', packet_id) + granted))
+            # retained messages only for the filters of this SUBSCRIBE (again for a repeated one)
+            for topic_filter in topic_filters:
+                self.send_retained(session, topic_filter)
+
+        elif packet_type == UNSUBSCRIBE:
+            packet_id, = struct.unpack_from('!H', body)
+            offset = 2
+            while offset < len(body):
+                length, = struct.unpack_from('!H', body, offset)
+                self.unsubscribe(session, body[offset + 2:offset + 2 + length])
+                offset += 2 + length
+            session.send(build_packet(UNSUBACK, 0, struct.pack('!H', packet_id)))
+
+        elif packet_type == PINGREQ:
+            session.send(build_packet(PINGRESP, 0, b''))
+
+        else:
+            raise ProtocolError(f'Unexpected packet type {packet_type}')
+
+    def subscribe(self, session, topic_filter, qos):
+        index = self.wildcards if b'+' in topic_filter or b'#' in topic_filter else self.exact
+        index.setdefault(topic_filter, {})[session] = qos
+        session.subscriptions[topic_filter] = qos
+
+    def unsubscribe(self, session, topic_filter):
+        session.subscriptions.pop(topic_filter, None)
+        for index in (self.exact, self.wildcards):
+            subscribers = index.get(topic_filter)
+            if subscribers is not None:
+                subscribers.pop(session, None)
+                if len(subscribers) == 0:
+                    del index[topic_filter]
+
+    def send_retained(self, session, topic_filter):
+        for topic, (payload, qos) in self.retained.items():
+            if topic_matches(topic_filter, topic):
+                self.deliver(session, topic, payload, min(qos, session.subscriptions[topic_filter]), True)
+
+    def publish(self, topic, payload, qos, retain):
+        start = time.perf_counter_ns()
+        if retain:
+            if len(payload) == 0:
+                self.retained.pop(topic, None)
+            else:
+                self.retained[topic] = (payload, qos)
+
+        # a session subscribed with several matching filters gets the highest QoS once
+        targets = dict(self.exact.get(topic, {}))
+        for topic_filter, subscribers in self.wildcards.items():
+            if topic_matches(topic_filter, topic):
+                for session, sub_qos in subscribers.items():
+                    targets[session] = max(sub_qos, targets.get(session, 0))
+
+        for session, sub_qos in targets.items():
+            self.deliver(session, topic, payload, min(qos, sub_qos))
+        self.stats['route_ns'] += time.perf_counter_ns() - start
+
+    def deliver(self, session, topic, payload, qos, retain=False):
+        if qos == 0 and session.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            self.stats['dropped_slow'] += 1
+            return
+
+        packet_id = None
+        if qos > 0:
+            packet_id = session.allocate_packet_id()
+            session.inflight[packet_id] = (time.monotonic(), topic, payload)
+        self.stats['delivered'] += 1
+        self.transmit(session, build_publish(topic, payload, qos, retain, packet_id))
+
+    def transmit(self, session, packet):
+        # lost QoS 1 messages are sent again by retry_inflight(), lost QoS 0 ones are gone
+        if self.loss > 0 and random.random() < self.loss:
+            self.stats['dropped_loss'] += 1
+            return
+
+        self.stats['bytes_out'] += len(packet)
+        delay = self.latency + random.uniform(-self.jitter, self.jitter) if self.jitter > 0 else self.latency
+        if delay > 0:
+            asyncio.get_event_loop().call_later(delay, session.send, packet)
+        else:
+            session.send(packet)
+
+    async def retry_inflight(self, session):
+        while True:
+            await asyncio.sleep(self.retry_interval / 2)
+            deadline = time.monotonic() - self.retry_interval
+            for packet_id, (sent, topic, payload) in list(session.inflight.items()):
+                if sent <= deadline:
+                    session.inflight[packet_id] = (time.monotonic(), topic, payload)
+                    self.stats['retransmitted'] += 1
+                    self.transmit(session, build_publish(topic, payload, 1, packet_id=packet_id, dup=True))
+
+    async def report(self, interval):
+        last = dict(self.stats)
+        while True:
+            await asyncio.sleep(interval)
+            stats = dict(self.stats)
+            received = stats['received'] - last['received']
+            route_us = (stats['route_ns'] - last['route_ns']) / 1000 / received if received > 0 else 0.0
+            print(f'[mqtt-broker][{len(self.sessions)} sessions][received: {received / interval:.1f} msg/s]'
+                  f'[delivered: {(stats["delivered"] - last["delivered"]) / interval:.1f} msg/s][routing: {route_us:.1f}us/msg]'
+                  f'[dropped: loss {stats["dropped_loss"]}, slow {stats["dropped_slow"]}][retransmitted: {stats["retransmitted"]}]')
+            last = stats
+
+async def serve(broker, host, port, stats_interval):
+    server = await asyncio.start_server(broker.handle, host, port, reuse_address=True)
+    print(f'[mqtt-broker][listening on {host}:{port}][auth: {broker.user is not None}]'
+          f'[latency: {broker.latency * 1000:.0f}+-{broker.jitter * 1000:.0f}ms][loss: {broker.loss * 100:.1f}%]')
+    if stats_interval > 0:
+        asyncio.ensure_future(broker.report(stats_interval))
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local MQTT 3.1.1 broker for benchmarks')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--user', type=str, help='require this username (and --password)')
+    parser.add_argument('--password', type=str)
+    parser.add_argument('--latency', type=float, default=0.0, help='ms added to every delivery')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+-ms of random delivery latency')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability that a delivery is lost')
+    parser.add_argument('--retry-interval', type=float, default=5.0, help='seconds before unacknowledged QoS 1 messages are resent')
+    parser.add_argument('--stats-interval', type=float, default=10.0, help='seconds between stats reports, 0 disables them')
+    parser.add_argument('--quiet', action='store_true', help='do not log connections')
+    args = parser.parse_args()
+
+    broker = Broker(args.user, args.password, args.latency / 1000, args.jitter / 1000, args.loss,
+                    args.retry_interval, args.quiet)
+    asyncio.run(serve(broker, args.host, args.port, args.stats_interval))
@@ -0,0 +1,168 @@
+import struct
+import time
+
+# Measurement messages start with this header, followed by the regular payload.
+# The send timestamp comes from CLOCK_MONOTONIC, which is only comparable when
+# publisher and subscriber run on the same host, or from the wall clock, which
+# needs both hosts synchronized (NTP/PTP).
+HEADER = struct.Struct('!4sBIQ')
+MAGIC = b'MLAT'
+# Sent once per topic after the last measurement message, with the number of
+# messages sent on the topic, so loss at the end of a run is counted as well.
+END = struct.Struct('!4sI')
+END_MAGIC = b'MEND'
+CLOCK_MONOTONIC = 0
+CLOCK_WALL = 1
+
+MEASURE_TOPIC = '/measure'
+
+def now_ns(clock):
+    return time.monotonic_ns() if clock == CLOCK_MONOTONIC else time.time_ns()
+
+def pack_header(seq, clock=CLOCK_MONOTONIC):
+    return HEADER.pack(MAGIC, clock, seq & 0xFFFFFFFF, now_ns(clock))
+
+def pack_end(count):
+    return END.pack(END_MAGIC, count & 0xFFFFFFFF)
+
+def unpack_end(payload):
+    # number of messages sent on the topic, or None for other messages
+    if len(payload) != END.size or payload[:4] != END_MAGIC:
+        return None
+    return END.unpack(payload)[1]
+
+def unpack_header(payload):
+    # (seq, clock, sent_ns), or None for messages that are not measurements
+    if len(payload) < HEADER.size or payload[:4] != MAGIC:
+        return None
+    _, clock, seq, sent_ns = HEADER.unpack_from(payload)
+    return seq, clock, sent_ns
+
+class Histogram:
+    # Log-linear latency histogram in microseconds: every power of two is split
+    # into 2**SUB_BITS buckets, so percentiles are within ~6% without keeping samples.
+    SUB_BITS = 4
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max_us = 0
+
+    def record(self, latency_us):
+        latency_us = max(0, int(latency_us))
+        self.buckets[self._index(latency_us)] = self.buckets.get(self._index(latency_us), 0) + 1
+        self.count += 1
+        self.max_us = max(self.max_us, latency_us)
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile
+        if self.count == 0:
+            return 0
+        rank = max(1, int(self.count * p / 100 + 0.5))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self._upper(index), self.max_us)
+        return self.max_us
+
+    def log2_counts(self):
+        # counts merged per power of two (in us), for printing
+        counts = {}
+        for index, count in self.buckets.items():
+            exponent = index >> self.SUB_BITS
+            counts[exponent] = counts.get(exponent, 0) + count
+        return sorted(counts.items())
+
+    def _index(self, value):
+        if value < (1 << self.SUB_BITS):
+            return value
+        exponent = value.bit_length() - 1
+        sub = (value >> (exponent - self.SUB_BITS)) & ((1 << self.SUB_BITS) - 1)
+        return ((exponent - self.SUB_BITS + 1) << self.SUB_BITS) | sub
+
+    def _upper(self, index):
+        if index < (1 << self.SUB_BITS):
+            return index
+        exponent = (index >> self.SUB_BITS) + self.SUB_BITS - 1
+        sub = index & ((1 << self.SUB_BITS) - 1)
+        return ((1 << self.SUB_BITS) + sub + 1) << (exponent - self.SUB_BITS)
+
+class SequenceTracker:
+    # Loss and reordering of one stream of sequence numbers. A gap counts its
+    # numbers as lost until they show up late, then they count as reordered.
+    def __init__(self):
+        self.next = None
+        self.missing = set()
+        self.received = 0
+        self.reordered = 0
+        self.duplicates = 0
+
+    def record(self, seq):
+        self.received += 1
+        if self.next is None or seq == self.next:
+            self.next = seq + 1
+        elif seq > self.next:
+            self.missing.update(range(self.next, seq))
+            self.next = seq + 1
+        elif seq in self.missing:
+            self.missing.remove(seq)
+            self.reordered += 1
+        else:
+            # QoS 1 delivers at least once
+            self.duplicates += 1
+
+    def finish(self, count):
+        # the publisher sent sequence numbers 0 to count - 1
+        if self.next is None:
+            self.next = 0
+        if count > self.next:
+            self.missing.update(range(self.next, count))
+            self.next = count
+
+    @property
+    def lost(self):
+        return len(self.missing)
+
+class LatencyTracker:
+    # Latency histograms and sequence tracking per (topic, QoS)
+    def __init__(self):
+        self.streams = {}
+
+    def record(self, topic, qos, payload, received_ns, received_wall_ns):
+        header = unpack_header(payload)
+        if header is None:
+            count = unpack_end(payload)
+            if count is None:
+                return False
+            self._stream(topic, qos)[1].finish(count)
+            return True
+
+        seq, clock, sent_ns = header
+        stream = self._stream(topic, qos)
+
+        received = received_ns if clock == CLOCK_MONOTONIC else received_wall_ns
+        stream[0].record((received - sent_ns) / 1000)
+        stream[1].record(seq)
+        return True
+
+    def _stream(self, topic, qos):
+        stream = self.streams.get((topic, qos))
+        if stream is None:
+            stream = self.streams[(topic, qos)] = (Histogram(), SequenceTracker())
+        return stream
+
+    def report(self, histograms=False):
+        lines = []
+        for (topic, qos), (histogram, sequence) in sorted(list(self.streams.items())):
+            lines.append('[%s][qos %d][received: %d][lost: %d][reordered: %d][duplicates: %d]'
+                         '[p50: %.1fms][p99: %.1fms][p999: %.1fms][max: %.1fms]' % (
+                topic, qos, sequence.received, sequence.lost, sequence.reordered, sequence.duplicates,
+                histogram.percentile(50) / 1000, histogram.percentile(99) / 1000,
+                histogram.percentile(99.9) / 1000, histogram.max_us / 1000))
+            if histograms:
+                for exponent, count in histogram.log2_counts():
+                    low = 0 if exponent == 0 else 2 ** (exponent + Histogram.SUB_BITS - 1)
+                    lines.append('  %8dus+ %8d %s' % (low, count, '#' * int(60 * count / histogram.count)))
+
+        return '\n'.join(lines)
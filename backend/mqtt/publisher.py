@@ -1,43 +1,91 @@
 import paho.mqtt.client as paho
+import sys
 import time
 import argparse
+import os
 
-MSG_TYPE={
-    'short': b"It is a simple short response.\n",
-    'middle': b"Lorem ipsum dolor sit amet, consectetur adipiscing elit. Integer nisl magna, varius et nunc ut, pharetra posuere ante. "\
-            b"Praesent vestibulum tempor vehicula. Nunc vehicula a elit at rhoncus. Proin luctus ex at sapien pretium, a consequat magna maximus. "\
-            b"Nunc scelerisque nunc et enim pellentesque, eu porta diam aliquet. Mauris mollis congue justo, ac volutpat nibh consequat sit amet. "\
-            b"Vestibulum ante ipsum primis in faucibus orci luctus et ultrices posuere cubilia curae; Curabitur congue nibh ut efficitur est.\n\n",
-    'long': b"Lorem ipsum dolor sit amet, consectetur adipiscing elit. Integer quam nulla, tincidunt nec dolor ut, "\
-            b"convallis finibus est. Aenean pretium nulla eu dolor ultrices maximus. Phasellus laoreet metus et pellentesque ornare. "\
-            b"Praesent ac purus sed quam pulvinar cursus. Suspendisse dictum mollis est non tincidunt. In posuere mauris justo, "\
-            b"nec rhoncus tortor vestibulum at. Aenean in lorem augue. Maecenas ante elit, tempor id ante in, pellentesque congue nisl.\n\n"\
-            b"Curabitur sit amet pulvinar turpis. Suspendisse potenti. Aenean porta, arcu sed sollicitudin commodo, ante dolor suscipit eros, "\
-            b"vitae eleifend velit felis ac risus. Sed vehicula mi sed ultrices ullamcorper. Nulla fringilla ac lacus viverra egestas. "\
-            b"Suspendisse metus ligula, ultricies et egestas in, sodales vitae nunc. Quisque aliquam dolor fringilla venenatis aliquam. "\
-            b"Praesent tellus diam, luctus eu risus in, scelerisque auctor nunc. Donec odio nibh, venenatis eget condimentum eu, tristique "\
-            b"facilisis nunc. Proin arcu ex, congue malesuada consequat a, tempor eu justo. Vivamus sapien magna, venenatis at interdum ut, "\
-            b"eleifend eget velit.\n\n"\
-            b"Sed a efficitur eros. Vestibulum mattis blandit malesuada. Donec leo quam, facilisis ac tortor eu, fringilla tempus neque. "\
-            b"Vestibulum volutpat, diam vel vulputate molestie, nunc velit mollis ipsum, vitae pulvinar urna neque nec leo. Curabitur elit tortor, "\
-            b"venenatis sed malesuada at, efficitur quis risus. Fusce ac tellus et ipsum viverra consequat. Proin pretium commodo lacus, "\
-            b"quis vestibulum nisl consequat eu. Morbi maximus, neque in tempus finibus, lacus odio tempus magna, sit amet pretium libero.\n\n"
-}
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from compress import deflate
+from payloads import MSG_TYPE
+from latency import CLOCK_MONOTONIC, CLOCK_WALL, MEASURE_TOPIC, pack_end, pack_header
+
+# MQTT has no content negotiation, so compressed payloads are published on a
+# separate "<topic>/deflate" topic that subscribers opt into.
+# compressed once, and only where it is smaller than the original
+DEFLATED = {}
+for name, body in MSG_TYPE.items():
+    deflated = deflate(body)
+    if len(deflated) < len(body):
+        DEFLATED[name] = deflated
+
+def measure(client, args):
+    # Publishes --count messages at --rate msg/s, round-robin over --topics topics.
+    # Every message carries a per-topic sequence number and its send time.
+    clock = CLOCK_WALL if args.wall_clock else CLOCK_MONOTONIC
+    topics = [f'{MEASURE_TOPIC}/{i}' for i in range(args.topics)]
+    sequence = [0] * len(topics)
+    body = MSG_TYPE[args.type]
+
+    start = time.monotonic()
+    for i in range(args.count):
+        if args.rate > 0:
+            delay = start + i / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        t = i % len(topics)
+        client.publish(topics[t], pack_header(sequence[t], clock) + body, qos=args.qos)
+        sequence[t] += 1
+
+    elapsed = time.monotonic() - start
+    # the message count per topic lets the subscriber count lost trailing messages;
+    # with QoS 0 the end marker can be lost like any other message
+    ends = [client.publish(topic, pack_end(count), qos=args.qos) for topic, count in zip(topics, sequence)]
+    for info in ends:
+        info.wait_for_publish()
+    print(f'[publisher][{args.count} messages][{len(topics)} topics][qos {args.qos}]'
+          f'[{len(body)}B][{elapsed:.2f}s][{args.count / elapsed:.1f} msg/s]')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='MQTT publisher')
     parser.add_argument('type', type=str, choices=['short', 'middle', 'long'])
     parser.add_argument('qos', type=int, choices=[0, 1, 2])
+    parser.add_argument('--deflate', action='store_true', help='publish the compressed payload on /<type>/deflate')
+    parser.add_argument('--host', type=str, default='lmi034-1.cs.uit.no')
+    parser.add_argument('--port', type=int, default=31417)
+    parser.add_argument('--measure', action='store_true', help='latency measurement, see subscriber.py --measure')
+    parser.add_argument('--count', type=int, default=10000, help='measure: number of messages')
+    parser.add_argument('--rate', type=float, default=100.0, help='measure: messages per second, 0 for no limit')
+    parser.add_argument('--topics', type=int, default=10, help='measure: number of topics')
+    parser.add_argument('--wall-clock', action='store_true',
+        help='measure: timestamp with the wall clock, for subscribers on another (synchronized) host')
     args = parser.parse_args()
 
+    topic = f'/{args.type}'
+    payload = MSG_TYPE[args.type]
+    if args.deflate and args.type in DEFLATED:
+        topic = f'/{args.type}/deflate'
+        payload = DEFLATED[args.type]
+
     client = paho.Client()
     client.username_pw_set('username', 'password')
-    client.connect('lmi034-1.cs.uit.no', 31417, 60)
+    if args.measure:
+        # QoS 1/2 messages in flight are not limited by the 20 message default
+        # (paho only accepts this before connecting)
+        client.max_inflight_messages_set(0)
+    client.connect(args.host, args.port, 60)
 
     client.loop_start()
+    if args.measure:
+        measure(client, args)
+        client.disconnect()
+        client.loop_stop()
+        sys.exit(0)
+
     print('PUBLISHING -->')
+    print(f'{topic}: {len(payload)}B')
     print(MSG_TYPE[args.type])
-    infot = client.publish(f'/{args.type}', MSG_TYPE[args.type], qos=args.qos)
+    infot = client.publish(topic, payload, qos=args.qos)
     infot.wait_for_publish()
     client.disconnect()
     time.sleep(5)
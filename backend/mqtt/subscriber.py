@@ -1,31 +1,147 @@
 import paho.mqtt.client as paho
 import datetime
 import argparse
+import queue
+import sqlite3
+import threading
+import time
+import zlib
 
-def get_time():
-    time_object = datetime.datetime.now()
-    timestamp = time_object.strftime("%Y-%m-%d %H:%M:%S")
-    date = time_object.strftime("%Y-%m-%d")
-    return timestamp, date
+from latency import LatencyTracker, MEASURE_TOPIC
 
-def on_message(mosq, obj, msg):
-    timestamp, date = get_time()
-    print("%s: %-20s qos: %d, payload_bytes: %dB, payload: %s" % (timestamp, msg.topic, msg.qos, len(msg.payload), msg.payload))
+class MessageWriter(threading.Thread):
+    # Persists the messages handed over by on_message. The paho network loop only
+    # puts (time, topic, qos, payload) into a bounded queue and never waits: when
+    # the writer falls behind, new messages are dropped and counted instead of
+    # stalling the loop (and, with QoS 1/2, the broker). The writer batch-inserts
+    # into SQLite once flush_size messages are queued or flush_interval elapsed.
+    # Measurement messages from `publisher.py --measure` feed the latency tracker
+    # before the queue, so messages dropped here are not reported as broker loss.
+    # The writer only reads the tracker under latency_lock for its reports.
+    def __init__(self, path, queue_size=10000, flush_size=500, flush_interval=1.0, report_interval=10.0, verbose=False):
+        super().__init__(daemon=True)
+        self.path = path
+        self.queue = queue.Queue(queue_size)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.report_interval = report_interval
+        self.verbose = verbose
+        self.received = 0
+        self.dropped = 0
+        self.written = 0
+        self.decode_errors = 0
+        self.running = True
+        self.latency = LatencyTracker()
+        self.latency_lock = threading.Lock()
+
+    def on_message(self, mosq, obj, msg):
+        self.received += 1
+        received, received_ns = time.time(), time.monotonic_ns()
+        with self.latency_lock:
+            self.latency.record(msg.topic, msg.qos, msg.payload, received_ns, int(received * 1e9))
+        try:
+            self.queue.put_nowait((received, msg.topic, msg.qos, msg.payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        self.running = False
+        self.join()
+
+    def run(self):
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE IF NOT EXISTS messages (received REAL, topic TEXT, qos INTEGER, size INTEGER, payload BLOB)')
+        db.commit()
+
+        batch = []
+        last_flush = last_report = time.monotonic()
+        last_written = 0
+        while self.running or not self.queue.empty():
+            timeout = max(0.0, last_flush + self.flush_interval - time.monotonic())
+            try:
+                batch.append(self.get_row(self.queue.get(timeout=timeout)))
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            if len(batch) >= self.flush_size or (len(batch) > 0 and now - last_flush >= self.flush_interval):
+                db.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?)', batch)
+                db.commit()
+                self.written += len(batch)
+                batch = []
+                last_flush = now
+            elif len(batch) == 0:
+                last_flush = now
+
+            if now - last_report >= self.report_interval:
+                print('[subscriber][received: %d][written: %d][dropped: %d][decode errors: %d][queued: %d][%.1f msg/s]' % (
+                    self.received, self.written, self.dropped, self.decode_errors, self.queue.qsize(),
+                    (self.written - last_written) / (now - last_report)))
+                with self.latency_lock:
+                    if len(self.latency.streams) > 0:
+                        print(self.latency.report())
+                last_written, last_report = self.written, now
+
+        if len(batch) > 0:
+            db.executemany('INSERT INTO messages VALUES (?, ?, ?, ?, ?)', batch)
+            db.commit()
+            self.written += len(batch)
+        db.close()
+
+        with self.latency_lock:
+            if len(self.latency.streams) > 0:
+                print(self.latency.report(histograms=True))
+
+    def get_row(self, message):
+        received, topic, qos, payload = message
+        size = len(payload)
+        if topic.endswith('/deflate'):
+            try:
+                payload = zlib.decompress(payload)
+            except zlib.error:
+                # a malformed payload is stored as received, it must not end the writer
+                self.decode_errors += 1
+
+        if self.verbose:
+            timestamp = datetime.datetime.fromtimestamp(received).strftime("%Y-%m-%d %H:%M:%S")
+            print("%s: %-20s qos: %d, payload_bytes: %dB, payload: %s" % (timestamp, topic, qos, size, payload))
+
+        return received, topic, qos, size, payload
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='MQTT publisher')
+    parser = argparse.ArgumentParser(description='MQTT subscriber')
     parser.add_argument('qos', type=int, choices=[0, 1, 2])
+    parser.add_argument('--db', type=str, default='messages.db', help='SQLite file the messages are stored in')
+    parser.add_argument('--queue-size', type=int, default=10000, help='messages buffered for the writer before dropping')
+    parser.add_argument('--flush-size', type=int, default=500, help='messages per insert batch')
+    parser.add_argument('--flush-interval', type=float, default=1.0, help='seconds before a partial batch is inserted')
+    parser.add_argument('--report-interval', type=float, default=10.0, help='seconds between throughput reports')
+    parser.add_argument('--verbose', action='store_true', help='print every message')
+    parser.add_argument('--measure', action='store_true', help='also subscribe to the latency measurement topics')
+    parser.add_argument('--host', type=str, default='lmi034-1.cs.uit.no')
+    parser.add_argument('--port', type=int, default=31417)
     args = parser.parse_args()
 
+    writer = MessageWriter(args.db, args.queue_size, args.flush_size, args.flush_interval, args.report_interval, args.verbose)
+    writer.start()
+
     client = paho.Client()
     client.enable_logger(logger=None)
     client.username_pw_set('user_name', 'password')
-    client.on_message = on_message
+    client.on_message = writer.on_message
 
-    client.connect("lmi034-1.cs.uit.no", 31417, 60)
+    client.connect(args.host, args.port, 60)
 
-    client.subscribe([("/short", args.qos), ("/middle", args.qos), ("/long", args.qos)])
+    client.subscribe([("/short", args.qos), ("/middle", args.qos), ("/long", args.qos),
+        ("/middle/deflate", args.qos), ("/long/deflate", args.qos)])
+    if args.measure:
+        client.subscribe(f'{MEASURE_TOPIC}/#', args.qos)
 
-    while client.loop() == 0:
+    try:
+        while client.loop() == 0:
+            pass
+    except KeyboardInterrupt:
         pass
+    finally:
+        writer.stop()
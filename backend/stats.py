@@ -0,0 +1,7 @@
+# Helpers shared by the HTTP and CoAP benchmark clients.
+
+def percentile(values, p):
+    # nearest-rank percentile of sorted values
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
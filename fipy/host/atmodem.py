@@ -0,0 +1,550 @@
+# Scriptable emulator of the SIM7000-style NB-IoT modem driven by lib/comm.py,
+# for running the AT stack on a Linux host. Commands are answered with the
+# configured per-command latency; bytes to and from the device take as long as
+# they would on the UART at the given baud rate. Remote ends of sockets, CoAP
+# and MQTT clients are Peer objects that answer after their round-trip time.
+import heapq
+import time
+
+# UART frame: start bit, 8 data bits and stop bit
+BITS_PER_BYTE = 10
+
+class Peer:
+    # Remote end of a socket. receive() gets the bytes sent by the device and
+    # returns the bytes to send back, if any. A peer that sets self.closed
+    # closes the connection after its reply.
+    def __init__(self, rtt=0.1):
+        self.rtt = rtt
+        self.closed = False
+
+    def receive(self, data):
+        return None
+
+class EchoPeer(Peer):
+    def receive(self, data):
+        return data
+
+class HTTPPeer(Peer):
+    # Answers every complete request with body; the connection is closed after
+    # the response unless keep_alive is set.
+    def __init__(self, body=b'', rtt=0.1, keep_alive=False):
+        super().__init__(rtt)
+        self.body = body
+        self.keep_alive = keep_alive
+        self.requests = 0
+        self._request = b''
+
+    def receive(self, data):
+        self._request += data
+        end = self._request.find(b'\r\n\r\n')
+        if end < 0:
+            return None
+
+        length = 0
+        for line in self._request[:end].split(b'\r\n')[1:]:
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                length = int(value)
+        if len(self._request) < end + 4 + length:
+            return None
+
+        self._request = self._request[end + 4 + length:]
+        self.requests += 1
+        self.closed = not self.keep_alive
+        connection = b'keep-alive' if self.keep_alive else b'close'
+        return b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n' % (len(self.body), connection) + self.body
+
+class CoAPPeer(Peer):
+    # Answers GET with the payload of resources[uri path] (2.05, 4.04 if unknown)
+    # and any other method with 2.04. CON requests get a piggybacked ACK.
+    def __init__(self, resources=None, rtt=0.1):
+        super().__init__(rtt)
+        self.resources = resources or {}
+        self._mid = 0
+
+    def receive(self, data):
+        msg_type = (data[0] >> 4) & 0x03
+        tkl = data[0] & 0x0F
+        code = data[1]
+        token = data[4:4 + tkl]
+
+        path = []
+        offset = 4 + tkl
+        number = 0
+        while offset < len(data) and data[offset] != 0xFF:
+            delta, length = data[offset] >> 4, data[offset] & 0x0F
+            offset += 1
+            if delta == 13:
+                delta = data[offset] + 13
+                offset += 1
+            elif delta == 14:
+                delta = (data[offset] << 8 | data[offset + 1]) + 269
+                offset += 2
+            if length == 13:
+                length = data[offset] + 13
+                offset += 1
+            elif length == 14:
+                length = (data[offset] << 8 | data[offset + 1]) + 269
+                offset += 2
+            number += delta
+            if number == 11:
+                path.append(data[offset:offset + length].decode())
+            offset += length
+
+        payload = b''
+        if code == 0x01:
+            payload = self.resources.get('/'.join(path))
+            code = 0x84 if payload is None else 0x45
+            payload = payload or b''
+        else:
+            code = 0x44
+
+        if msg_type == 0:
+            header = bytes([0x60 | tkl, code]) + data[2:4]
+        else:
+            self._mid = (self._mid + 1) & 0xFFFF
+            header = bytes([0x50 | tkl, code, self._mid >> 8, self._mid & 0xFF])
+
+        return header + token + (b'\xff' + payload if len(payload) > 0 else b'')
+
+def t3324_seconds(bits):
+    # 8 bit GPRS timer 2 string, None when deactivated
+    unit, value = int(bits, 2) >> 5, int(bits, 2) & 0x1F
+    step = {0: 2, 1: 60, 2: 360}.get(unit)
+    return None if step is None else step * value
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+            return False
+
+    return len(filter_levels) == len(topic_levels)
+
+class ATModem:
+    def __init__(self, baudrate=None, echo=True, command_latency=0.005, latencies=None, peers=None,
+                 dns=None, rtt=0.1, attach_time=1.0, boot_time=0.5, apn='telenor.iot', operator='24201',
+                 rssi=20, max_send=1024, nmi_size=512, input_commands=4, wake_time=0.1, grant_psm=None,
+                 clock=time.monotonic, sleep=time.sleep):
+        # baudrate None uses the rate the UART is opened with
+        self.baudrate = baudrate
+        self.echo = echo
+        self.command_latency = command_latency
+        # command name ('AT+CSOSEND', ...) -> seconds until its final result
+        self.latencies = latencies or {}
+        # (host, port) -> Peer, None stands for any address without its own peer
+        self.peers = peers or {}
+        # host name -> IP address; unknown names resolve to 10.0.0.1
+        self.dns = dns or {}
+        self.rtt = rtt
+        self.attach_time = attach_time
+        self.boot_time = boot_time
+        self.apn = apn
+        self.operator = operator
+        self.rssi = rssi
+        # longest hex string accepted by AT+CSOSEND
+        self.max_send = max_send
+        # received data is split into +CSONMI notifications of at most nmi_size bytes
+        self.nmi_size = nmi_size
+        # commands the modem buffers while busy, more are answered with ERROR
+        self.input_commands = input_commands
+        # seconds from the power key until a modem in PSM answers again
+        self.wake_time = wake_time
+        # (active time, TAU) the network grants as 8 bit timer strings, None grants what
+        # is requested and False refuses PSM
+        self.grant_psm = grant_psm
+        self.clock = clock
+        self.sleep = sleep
+
+        self.rx_buffer_size = 4096
+        self.powered = True
+        self.cfun = 1
+        self.attached_at = clock() - attach_time
+        self.sockets = {}
+        self.coap_clients = {}
+        self.mqtt_clients = {}
+        # PSM: the modem sleeps active_time seconds after the last command
+        self.psm = False
+        self.active_time = None
+        self.tau = None
+        self.t3324 = None
+        self.edrx = None
+        self.cereg = 0
+        self._last_activity = clock()
+        self._wake_at = 0.0
+
+        self._tx = b''
+        # modem output not yet on the wire: heap of (time, seq, bytes)
+        self._events = []
+        self._seq = 0
+        # bytes on the wire: (time the last byte arrives, bytes)
+        self._wire = []
+        self._wire_free = 0.0
+        self._rx = bytearray()
+        # the modem handles one command at a time: completion times of queued commands
+        self._busy_until = 0.0
+        self._queued = []
+
+        self.stats = {'commands': 0, 'tx_bytes': 0, 'rx_bytes': 0, 'urcs': 0, 'rx_overflow': 0, 'errors': 0,
+                      'psm_wakes': 0, 'psm_seconds': 0.0}
+        self.command_counts = {}
+
+    # UART side
+
+    def attach(self, baudrate, rx_buffer_size):
+        if self.baudrate is None:
+            self.baudrate = baudrate
+        self.rx_buffer_size = rx_buffer_size
+
+    def write(self, data):
+        # blocks for as long as the bytes take on the wire
+        self.sleep(len(data) * BITS_PER_BYTE / self.baudrate)
+        self.stats['tx_bytes'] += len(data)
+        self._tx += data
+        while True:
+            end = self._tx.find(b'\r')
+            if end < 0:
+                break
+            line = self._tx[:end].lstrip(b'\n').decode()
+            self._tx = self._tx[end + 1:]
+            if self.powered and not self.asleep() and len(line) > 0:
+                self._last_activity = self.clock()
+                self._command(line)
+
+        return len(data)
+
+    def any(self):
+        self._receive()
+        return len(self._rx)
+
+    def read(self, nbytes=None):
+        self._receive()
+        if len(self._rx) == 0:
+            return None
+        nbytes = len(self._rx) if nbytes is None else min(nbytes, len(self._rx))
+        data = bytes(self._rx[:nbytes])
+        del self._rx[:nbytes]
+        return data
+
+    def readinto(self, buf, nbytes=None):
+        self._receive()
+        if len(self._rx) == 0:
+            return None
+        nbytes = min(len(buf) if nbytes is None else nbytes, len(self._rx))
+        buf[:nbytes] = self._rx[:nbytes]
+        del self._rx[:nbytes]
+        return nbytes
+
+    def readline(self):
+        self._receive()
+        if len(self._rx) == 0:
+            return None
+        end = self._rx.find(b'\n')
+        end = len(self._rx) if end < 0 else end + 1
+        data = bytes(self._rx[:end])
+        del self._rx[:end]
+        return data
+
+    def asleep(self):
+        # in PSM the UART is off and commands are lost
+        now = self.clock()
+        if now < self._wake_at:
+            return True
+        return self.psm and self.active_time is not None and now - self._last_activity >= self.active_time
+
+    def power_key(self):
+        if self.asleep():
+            # wakes up from PSM, the registration is kept
+            now = self.clock()
+            self.stats['psm_wakes'] += 1
+            self.stats['psm_seconds'] += now - (self._last_activity + self.active_time)
+            self._wake_at = now + self.wake_time
+            self._last_activity = self._wake_at
+            return
+        if not self.powered:
+            self.powered = True
+            self.cfun = 1
+            self.attached_at = self.clock() + self.boot_time + self.attach_time
+            self._emit('RDY', self.boot_time)
+
+    def _emit(self, line, delay=0.0):
+        self._seq += 1
+        heapq.heappush(self._events, (self.clock() + delay, self._seq, b'\r\n' + line.encode() + b'\r\n'))
+
+    def _receive(self):
+        # moves due output onto the wire, then what has arrived into the RX buffer
+        now = self.clock()
+        while len(self._events) > 0 and self._events[0][0] <= now:
+            at, _, data = heapq.heappop(self._events)
+            self._wire_free = max(at, self._wire_free) + len(data) * BITS_PER_BYTE / self.baudrate
+            self._wire.append((self._wire_free, data))
+
+        while len(self._wire) > 0 and self._wire[0][0] <= now:
+            _, data = self._wire.pop(0)
+            space = self.rx_buffer_size - len(self._rx)
+            if len(data) > space:
+                self.stats['rx_overflow'] += len(data) - space
+                data = data[:space]
+            self._rx.extend(data)
+            self.stats['rx_bytes'] += len(data)
+
+    # command side
+
+    def _command(self, line):
+        name, _, args = line.partition('=')
+        if name.endswith('?'):
+            name, args = name[:-1], '?'
+        self.stats['commands'] += 1
+        self.command_counts[name] = self.command_counts.get(name, 0) + 1
+
+        now = self.clock()
+        if self.echo:
+            self._seq += 1
+            heapq.heappush(self._events, (now, self._seq, line.encode() + b'\r\r\n'))
+
+        self._queued = [done for done in self._queued if done > now]
+        if len(self._queued) >= self.input_commands:
+            self.stats['errors'] += 1
+            self._emit('ERROR', self._busy_until - now)
+            return
+
+        self._busy_until = max(now, self._busy_until) + self.latencies.get(name, self.command_latency)
+        self._queued.append(self._busy_until)
+        delay = self._busy_until - now
+
+        handler = getattr(self, '_at_' + name[3:].lower(), None) if name.startswith('AT') else None
+        try:
+            lines = ['OK'] if name == 'AT' else handler(self._split(args), delay)
+        except Exception:
+            lines = None
+
+        if lines is None:
+            self.stats['errors'] += 1
+            lines = ['ERROR']
+        for response in lines:
+            self._emit(response, delay)
+
+    def _split(self, args):
+        return [arg.strip('"') for arg in args.split(',')] if len(args) > 0 else []
+
+    def _attached(self):
+        return self.cfun == 1 and self.clock() >= self.attached_at
+
+    def _peer(self, host, port):
+        peer = self.peers.get((host, port))
+        if peer is None:
+            peer = self.peers.get(None)
+        return peer
+
+    def _urc(self, line, delay):
+        self.stats['urcs'] += 1
+        self._emit(line, delay)
+
+    def _allocate(self, profiles):
+        profile_id = 0
+        while profile_id in profiles:
+            profile_id += 1
+        return profile_id
+
+    def _at_cfun(self, args, delay):
+        if args == ['?']:
+            return ['+CFUN: %d' % self.cfun, 'OK']
+        self.cfun = int(args[0])
+        if self.cfun == 0:
+            self.sockets.clear()
+            return ['OK']
+        self.attached_at = max(self.attached_at, self.clock() + self.attach_time)
+        return ['OK', '+CPIN: READY']
+
+    def _at_mcgdefcont(self, args, delay):
+        if args == ['?']:
+            return ['*MCGDEFCONT: "IP","%s"' % self.apn, 'OK']
+        self.apn = args[1]
+        return ['OK']
+
+    def _at_cgcontrdp(self, args, delay):
+        if not self._attached():
+            return ['OK']
+        return ['+CGCONTRDP: 1,5,"%s","10.0.0.2.255.255.255.0"' % self.apn, 'OK']
+
+    def _at_cops(self, args, delay):
+        return ['+COPS: 0,2,"%s",9' % self.operator, 'OK']
+
+    def _at_csq(self, args, delay):
+        return ['+CSQ: %d,99' % self.rssi, 'OK']
+
+    def _at_cdnsgip(self, args, delay):
+        if not self._attached():
+            return None
+        self._urc('+CDNSGIP: 1,"%s","%s"' % (args[0], self.dns.get(args[0], '10.0.0.1')), delay + self.rtt)
+        return ['OK']
+
+    def _at_cipping(self, args, delay):
+        if not self._attached():
+            return None
+        for i in range(1, int(args[1]) + 1):
+            self._urc('+CIPPING: %d,"%s",%d,64' % (i, args[0], max(1, int(self.rtt * 10))), delay + i * self.rtt)
+        return ['OK']
+
+    def _at_cpsms(self, args, delay):
+        if args == ['?']:
+            return ['+CPSMS: %d,,,"%s","%s"' % (self.psm, self.tau or '', self.t3324 or ''), 'OK']
+        self.psm = int(args[0]) == 1
+        if not self.psm or self.grant_psm is False:
+            self.active_time = None
+            self.tau = None
+            self.t3324 = None
+            return ['OK']
+        if self.grant_psm is None:
+            tau, active_time = args[3], args[4]
+        else:
+            active_time, tau = self.grant_psm
+        self.tau = tau
+        self.t3324 = active_time
+        self.active_time = t3324_seconds(active_time)
+        return ['OK']
+
+    def _at_cedrxs(self, args, delay):
+        self.edrx = args[2] if int(args[0]) == 1 else None
+        return ['OK']
+
+    def _at_cereg(self, args, delay):
+        if args != ['?']:
+            self.cereg = int(args[0])
+            return ['OK']
+        stat = 1 if self._attached() else 2
+        if self.cereg < 4 or self.active_time is None:
+            return ['+CEREG: %d,%d' % (self.cereg, stat), 'OK']
+        return ['+CEREG: %d,%d,"1A2B","0C3D4E5F",9,,,"%s","%s"' % (self.cereg, stat, self.t3324, self.tau), 'OK']
+
+    def _at_cpowd(self, args, delay):
+        self.powered = False
+        self.cfun = 0
+        self.sockets.clear()
+        self.coap_clients.clear()
+        self.mqtt_clients.clear()
+        return ['NORMAL POWER DOWN']
+
+    def _at_csoc(self, args, delay):
+        profile_id = self._allocate(self.sockets)
+        self.sockets[profile_id] = {'type': int(args[1]), 'peer': None}
+        return ['+CSOC: %d' % profile_id, 'OK']
+
+    def _at_csocon(self, args, delay):
+        socket = self.sockets[int(args[0])]
+        if not self._attached():
+            return None
+        socket['peer'] = self._peer(args[2], int(args[1]))
+        if socket['peer'] is None:
+            return None
+        socket['peer'].closed = False
+        if socket['type'] == 1:
+            # the TCP handshake takes a round-trip
+            self._busy_until += socket['peer'].rtt
+            self._queued[-1] = self._busy_until
+            self._emit('OK', delay + socket['peer'].rtt)
+            return []
+        return ['OK']
+
+    def _at_csosend(self, args, delay):
+        profile_id = int(args[0])
+        socket = self.sockets[profile_id]
+        data = args[2]
+        if socket['peer'] is None or len(data) > self.max_send or int(args[1]) != len(data):
+            return None
+
+        peer = socket['peer']
+        response = peer.receive(bytes.fromhex(data))
+        if response:
+            for i in range(0, len(response), self.nmi_size):
+                chunk = response[i:i + self.nmi_size].hex()
+                self._urc('+CSONMI: %d,%d,%s' % (profile_id, len(chunk), chunk), delay + peer.rtt)
+        if peer.closed:
+            socket['peer'] = None
+            self._urc('+CSOERR: %d,4' % profile_id, delay + peer.rtt)
+        return ['OK']
+
+    def _at_csostatus(self, args, delay):
+        # 0 not in use, 1 created, 2 connected
+        socket = self.sockets.get(int(args[0]))
+        status = 0 if socket is None else 1 if socket['peer'] is None else 2
+        return ['+CSOSTATUS: %s,%d' % (args[0], status), 'OK']
+
+    def _at_csocl(self, args, delay):
+        del self.sockets[int(args[0])]
+        return ['OK']
+
+    def _at_ccoapnew(self, args, delay):
+        profile_id = self._allocate(self.coap_clients)
+        peer = self._peer(args[0], int(args[1]))
+        if peer is None:
+            return None
+        self.coap_clients[profile_id] = peer
+        return ['+CCOAPNEW: %d' % profile_id, 'OK']
+
+    def _at_ccoapsend(self, args, delay):
+        profile_id = int(args[0])
+        peer = self.coap_clients[profile_id]
+        response = peer.receive(bytes.fromhex(args[2]))
+        if response:
+            self._urc('+CCOAPNMI: %d,%d,%s' % (profile_id, len(response), response.hex()), delay + peer.rtt)
+        return ['OK']
+
+    def _at_ccoapdel(self, args, delay):
+        del self.coap_clients[int(args[0])]
+        return ['OK']
+
+    def _at_cmqnew(self, args, delay):
+        profile_id = self._allocate(self.mqtt_clients)
+        self.mqtt_clients[profile_id] = {'connected': False, 'subscriptions': {}}
+        return ['+CMQNEW: %d' % profile_id, 'OK']
+
+    def _at_cmqcon(self, args, delay):
+        if not self._attached():
+            return None
+        self.mqtt_clients[int(args[0])]['connected'] = True
+        return ['OK']
+
+    def _at_cmqsub(self, args, delay):
+        self.mqtt_clients[int(args[0])]['subscriptions'][args[1]] = int(args[2])
+        return ['OK']
+
+    def _at_cmqunsub(self, args, delay):
+        self.mqtt_clients[int(args[0])]['subscriptions'].pop(args[1], None)
+        return ['OK']
+
+    def _at_cmqpub(self, args, delay):
+        client = self.mqtt_clients[int(args[0])]
+        topic, qos, retain, length, message = args[1], int(args[2]), int(args[3]), int(args[5]), args[6]
+        if not client['connected'] or length != len(message):
+            return None
+
+        # the broker sends the message back to every client subscribed to the topic
+        for profile_id, other in self.mqtt_clients.items():
+            for topic_filter, sub_qos in other['subscriptions'].items():
+                if other['connected'] and topic_matches(topic_filter, topic):
+                    self._urc('+CMQPUB: %d,"%s",%d,%d,0,%d,"%s"' % (
+                        profile_id, topic, min(qos, sub_qos), retain, len(message), message), delay + self.rtt)
+                    break
+        return ['OK']
+
+    def _at_cmqdiscon(self, args, delay):
+        del self.mqtt_clients[int(args[0])]
+        return ['OK']
+
+_modem = None
+
+def get_modem():
+    # the modem behind UART 1, created with defaults unless set_modem() came first
+    global _modem
+    if _modem is None:
+        _modem = ATModem()
+    return _modem
+
+def set_modem(modem):
+    global _modem
+    _modem = modem
+    return modem
@@ -0,0 +1,168 @@
+# Runs lib/comm.py against the emulated modem and reports the time per
+# operation, the AT commands and the UART traffic it takes. Run from this
+# directory: python3 bench.py tcp --size 4096 --rtt 0.05
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import atmodem
+
+HOST = 'bench.local'
+PORT = 8080
+
+def http_request(method, size):
+    body = bytes(random.getrandbits(8) for _ in range(size)) if method == 'POST' else b''
+    return b'%s /bench HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n\r\n' % (method.encode(), HOST.encode(), len(body)) + body
+
+def read_http_response(s):
+    response = bytearray()
+    while True:
+        data = s.recv(2048)
+        if len(data) == 0:
+            return response
+        response.extend(data)
+        end = response.find(b'\r\n\r\n')
+        if end >= 0:
+            length = int(response[:end].lower().split(b'content-length:')[1].split(b'\r\n')[0])
+            if len(response) >= end + 4 + length:
+                return response
+
+def coap_get(path, mid, con=True):
+    path = path.encode()
+    return bytes([0x40 if con else 0x50, 0x01, mid >> 8, mid & 0xFF, 0xB0 | len(path)]) + path
+
+def run_tcp(comm, nb, args):
+    s = comm.NBIOTTCPSocket(nb, window=args.window)
+    request = http_request(args.method, args.size)
+
+    def op():
+        s.connect((HOST, PORT))
+        s.send(request)
+        read_http_response(s)
+        s.close()
+    return op
+
+def run_pool(comm, nb, args):
+    # HTTP/1.1 keep-alive requests over pooled sockets
+    pool = comm.NBIOTSocketPool(nb)
+    request = http_request(args.method, args.size)
+
+    def op():
+        s, _ = pool.get((HOST, PORT))
+        s.window = args.window
+        s.send(request)
+        read_http_response(s)
+    return op
+
+def run_udp(comm, nb, args):
+    s = comm.NBIOTUDPSocket(nb)
+    data = bytes(args.size)
+
+    def op():
+        s.sendto(data, (HOST, PORT))
+        s.recvfrom(2048)
+    return op
+
+def run_coap(comm, nb, args):
+    s = comm.NBIOTCoAPSocket(nb, HOST, PORT, reusable=True)
+    mid = [0]
+
+    def op():
+        mid[0] = (mid[0] + 1) & 0xFFFF
+        s.sendto(coap_get('bench', mid[0]), (HOST, PORT))
+        s.recvfrom(2048)
+    return op
+
+def run_mqtt(comm, nb, args):
+    client = comm.NBIOTMQTTClient(nb, 'bench', HOST, PORT, 'user', 'password')
+    client.set_callback(lambda topic, msg: None)
+    client.connect()
+    client.subscribe('/bench', args.qos)
+    message = bytes(args.size)
+
+    def op():
+        client.publish('/bench', message, qos=args.qos)
+        client.wait_msg()
+    return op
+
+SCENARIOS = {'tcp': run_tcp, 'pool': run_pool, 'udp': run_udp, 'coap': run_coap, 'mqtt': run_mqtt}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark lib/comm.py against the emulated NB-IoT modem')
+    parser.add_argument('scenario', choices=SCENARIOS.keys())
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--size', type=int, default=256, help='bytes sent per operation (tcp POST, udp, mqtt)')
+    parser.add_argument('--method', choices=['GET', 'POST'], default='POST', help='tcp: HTTP method')
+    parser.add_argument('--response-size', type=int, default=1024, help='bytes of the HTTP/CoAP response body')
+    parser.add_argument('--qos', type=int, choices=[0, 1], default=0, help='mqtt: QoS')
+    parser.add_argument('--baudrate', type=int, default=115200)
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds the modem takes per command')
+    parser.add_argument('--send-latency', type=float, help='seconds the modem takes per AT+CSOSEND (default --latency)')
+    parser.add_argument('--window', type=int, default=1, help='tcp: AT+CSOSEND commands in flight')
+    parser.add_argument('--rtt', type=float, default=0.1, help='network round-trip time in seconds')
+    parser.add_argument('--connect', action='store_true', help='include NBIOT.connect() (power on and attach)')
+    parser.add_argument('--profile', action='store_true', help='print a cProfile of the operations')
+    parser.add_argument('--debug', action='store_true', help='log the AT traffic')
+    args = parser.parse_args()
+
+    body = bytes(random.getrandbits(8) for _ in range(args.response_size))
+    peers = {
+        'tcp': atmodem.HTTPPeer(body, args.rtt),
+        'pool': atmodem.HTTPPeer(body, args.rtt, keep_alive=True),
+        'udp': atmodem.EchoPeer(args.rtt),
+        'coap': atmodem.CoAPPeer({'bench': body}, args.rtt),
+        'mqtt': None,
+    }
+    latencies = {} if args.send_latency is None else {'AT+CSOSEND': args.send_latency}
+    modem = atmodem.set_modem(atmodem.ATModem(args.baudrate, command_latency=args.latency, latencies=latencies,
+                                              rtt=args.rtt, peers={None: peers[args.scenario]}))
+
+    import logging
+    import comm
+    comm._logger.setLevel(logging.DEBUG if args.debug else logging.WARNING)
+
+    nb = comm.NBIOT()
+    if args.connect:
+        start = time.monotonic()
+        nb.connect()
+        print(f'[connect][{(time.monotonic() - start) * 1000:.1f}ms]')
+    else:
+        nb.connected = True
+
+    op = SCENARIOS[args.scenario](comm, nb, args)
+    stats = dict(modem.stats)
+    counts = dict(modem.command_counts)
+
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    times = []
+    for _ in range(args.count):
+        start = time.monotonic()
+        op()
+        times.append((time.monotonic() - start) * 1000)
+
+    if profiler is not None:
+        profiler.disable()
+
+    times.sort()
+    ops = args.count
+    print(f'[{args.scenario}][{ops} ops][{args.size}B][{args.baudrate} baud][rtt: {args.rtt * 1000:.0f}ms]'
+          f'[mean: {sum(times) / ops:.1f}ms][p50: {times[ops // 2]:.1f}ms][max: {times[-1]:.1f}ms]')
+    print(f'[per op][commands: {(modem.stats["commands"] - stats["commands"]) / ops:.1f}]'
+          f'[uart tx: {(modem.stats["tx_bytes"] - stats["tx_bytes"]) / ops:.0f}B][uart rx: {(modem.stats["rx_bytes"] - stats["rx_bytes"]) / ops:.0f}B]'
+          f'[urcs: {(modem.stats["urcs"] - stats["urcs"]) / ops:.1f}][errors: {modem.stats["errors"] - stats["errors"]}]'
+          f'[rx overflow: {modem.stats["rx_overflow"] - stats["rx_overflow"]}B]')
+    print('[commands]' + ''.join(f'[{name}: {count - counts.get(name, 0)}]' for name, count in sorted(modem.command_counts.items())
+                                  if count > counts.get(name, 0)))
+
+    if profiler is not None:
+        import pstats
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
@@ -0,0 +1,90 @@
+# CPython stand-in for the parts of Pycom's machine module used by lib/comm.py.
+# UART 1 is wired to the emulated modem of atmodem.get_modem().
+import time
+
+import atmodem
+
+class Timer:
+    class Chrono:
+        def __init__(self):
+            self._start = None
+            self._elapsed = 0.0
+
+        def start(self):
+            if self._start is None:
+                self._start = time.monotonic()
+
+        def stop(self):
+            if self._start is not None:
+                self._elapsed += time.monotonic() - self._start
+                self._start = None
+
+        def reset(self):
+            self._elapsed = 0.0
+            if self._start is not None:
+                self._start = time.monotonic()
+
+        def read(self):
+            if self._start is None:
+                return self._elapsed
+            return self._elapsed + time.monotonic() - self._start
+
+        def read_ms(self):
+            return self.read() * 1000
+
+        def read_us(self):
+            return self.read() * 1000000
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, id, mode=IN, pull=None, value=None):
+        self.id = id
+        self.mode = mode
+        self._value = 0 if value is None else value
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        previous, self._value = self._value, value
+        # the modem power key is P4: a low pulse switches it on
+        if self.id == 'P4' and previous == 0 and value == 1:
+            atmodem.get_modem().power_key()
+
+    def __call__(self, value=None):
+        return self.value(value)
+
+class UART:
+    def __init__(self, bus, baudrate=9600, pins=None, rx_buffer_size=512, **kwargs):
+        self.bus = bus
+        self.modem = atmodem.get_modem()
+        self.modem.attach(baudrate, rx_buffer_size)
+
+    def any(self):
+        return self.modem.any()
+
+    def read(self, nbytes=None):
+        return self.modem.read(nbytes)
+
+    def readinto(self, buf, nbytes=None):
+        return self.modem.readinto(buf, nbytes)
+
+    def readline(self):
+        return self.modem.readline()
+
+    def write(self, buf):
+        if isinstance(buf, str):
+            buf = buf.encode()
+        return self.modem.write(buf)
+
+    def deinit(self):
+        pass
+
+def idle():
+    time.sleep(0.001)
+
+def reset():
+    raise SystemExit('machine.reset()')
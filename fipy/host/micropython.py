@@ -0,0 +1,11 @@
+# CPython stand-in for MicroPython's micropython module: the code emitters
+# are MicroPython only, so the decorators leave functions unchanged.
+
+def native(f):
+    return f
+
+def viper(f):
+    return f
+
+def const(value):
+    return value
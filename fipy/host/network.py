@@ -0,0 +1,13 @@
+# CPython stand-in for Pycom's network module. Only the NB-IoT modem behind
+# UART 1 is emulated; the built-in LTE and WLAN radios are not available.
+
+class LTE:
+    def __init__(self, *args, **kwargs):
+        raise OSError('LTE is not available on the host')
+
+class WLAN:
+    STA = 0
+    AP = 1
+
+    def __init__(self, *args, **kwargs):
+        raise OSError('WLAN is not available on the host')
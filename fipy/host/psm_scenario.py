@@ -0,0 +1,118 @@
+# Benchmark comparing powering the modem down between experiments (NBIOT.deinit()
+# and connect()) with keeping it registered in PSM through comm.PowerManager, on
+# the emulated modem. It runs in real time (about a minute with the defaults), like
+# bench.py; the asserts only stop it when the emulated modem and the PSM state
+# machine disagree, it is not a unit test.
+# Run from this directory: python3 psm_scenario.py --cycles 3
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import atmodem
+
+HOST = 'bench.local'
+PORT = 8080
+
+def send_report(comm, nb, size):
+    s = comm.NBIOTUDPSocket(nb)
+    s.sendto(bytes(size), (HOST, PORT))
+    s.recvfrom(2048)
+    s.close()
+
+def check_timers(comm):
+    # every value a timer unit holds decodes to what was encoded
+    for units in (comm.T3324_UNITS, comm.T3412_UNITS):
+        for unit, step in units:
+            for value in range(1, 32):
+                seconds = step * value
+                assert comm.decode_timer(comm.encode_timer(seconds, units), units) == seconds, (units, seconds)
+        # other values round up, longer ones than the timer holds are capped
+        longest = units[-1][1] * 31
+        for seconds in (1, 3, 59, 61, 599, 3601, 86400, 10 ** 8):
+            decoded = comm.decode_timer(comm.encode_timer(seconds, units), units)
+            assert decoded >= min(seconds, longest), (units, seconds, decoded)
+        assert comm.decode_timer(comm.encode_timer(None, units), units) is None
+    for value, cycle in comm.EDRX_CYCLES:
+        assert comm.decode_edrx(comm.encode_edrx(cycle)) == cycle, cycle
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of PSM wake-ups versus power down and reconnect on the emulated NB-IoT modem')
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--size', type=int, default=64, help='bytes of the report sent per cycle')
+    parser.add_argument('--attach-time', type=float, default=8.0, help='seconds the network takes to attach the modem')
+    parser.add_argument('--active-time', type=int, default=2, help='requested T3324 in seconds')
+    parser.add_argument('--tau', type=int, default=3600, help='requested T3412 in seconds')
+    parser.add_argument('--edrx', type=float, help='requested eDRX cycle in seconds')
+    parser.add_argument('--rtt', type=float, default=0.1, help='network round-trip time in seconds')
+    parser.add_argument('--debug', action='store_true', help='log the AT traffic')
+    args = parser.parse_args()
+
+    modem = atmodem.set_modem(atmodem.ATModem(attach_time=args.attach_time, rtt=args.rtt,
+                                              peers={None: atmodem.EchoPeer(args.rtt)}))
+
+    import logging
+    import comm
+    comm._logger.setLevel(logging.DEBUG if args.debug else logging.WARNING)
+
+    check_timers(comm)
+
+    nb = comm.NBIOT()
+    nb.connect()
+
+    # powering down loses the registration, every reconnect is a full attach
+    reconnect = []
+    for _ in range(args.cycles):
+        send_report(comm, nb, args.size)
+        nb.deinit()
+        start = time.monotonic()
+        nb.connect()
+        reconnect.append((time.monotonic() - start) * 1000)
+        print(f'[power down][reconnect: {reconnect[-1]:.0f}ms]')
+    assert nb.attach_times.stats['cold'][0] == args.cycles, nb.attach_times.stats
+
+    pm = comm.PowerManager(nb, active_time=args.active_time, tau=args.tau, edrx=args.edrx)
+    assert pm.configure(), 'PSM not granted'
+    print(f'[psm][active time: {pm.active_time}s][tau: {pm.tau}s][edrx: {pm.edrx}s]')
+    for cycle in range(args.cycles + 1):
+        attached_at = modem.attached_at
+        psm_wakes = modem.stats['psm_wakes']
+        with pm:
+            assert pm.state() == comm.PSM_ACTIVE
+            send_report(comm, nb, args.size)
+        if cycle > 0:
+            # woken up from PSM by the power key, without attaching again
+            assert modem.stats['psm_wakes'] == psm_wakes + 1
+            assert modem.attached_at == attached_at
+            assert nb.attach_times.stats['wake'][0] == cycle, nb.attach_times.stats
+            assert nb.attach_times.stats['cold'][0] == args.cycles, nb.attach_times.stats
+        assert pm.state() == comm.PSM_IDLE and not modem.asleep()
+        print(f'[psm][{pm.state()}][next window: {pm.next_window()}s]')
+        time.sleep(pm.active_time + 0.5)
+        assert pm.state() == comm.PSM_SLEEP and modem.asleep()
+        assert 0 < pm.next_window() <= pm.tau
+        print(f'[psm][{pm.state()}][next window: {pm.next_window():.0f}s]')
+    # the modem only takes commands while awake
+    with pm:
+        pm.disable()
+
+    reconnect_ms = int(sum(reconnect) / len(reconnect))
+    assert pm.estimate() is not None
+    saved = pm.estimate(reconnect_ms)
+    print(f'[reconnect: {reconnect_ms}ms avg][wake-up: {pm.wake_ms // pm.wakes}ms avg][saved: {saved}ms per cycle]'
+          f'[modem psm wake-ups: {modem.stats["psm_wakes"]}][in psm: {modem.stats["psm_seconds"]:.1f}s]')
+
+    # a network refusing PSM leaves the modem awake, so it is never power cycled
+    modem.grant_psm = False
+    refused = comm.PowerManager(nb, active_time=args.active_time, tau=args.tau)
+    assert not refused.configure()
+    warm = nb.attach_times.stats['warm'][0]
+    time.sleep(args.active_time + 0.5)
+    with refused:
+        assert refused.state() == comm.PSM_ACTIVE
+        send_report(comm, nb, args.size)
+    assert modem.powered and not modem.asleep()
+    assert refused.wakes == 0 and nb.attach_times.stats['warm'][0] == warm
+    print('[psm refused][modem kept awake]')
@@ -0,0 +1,2 @@
+# CPython stand-in for MicroPython's ubinascii
+from binascii import *
@@ -0,0 +1,2 @@
+# CPython stand-in for MicroPython's usocket
+from socket import *
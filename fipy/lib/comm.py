@@ -1,13 +1,167 @@
 import logging
+import micropython
 from machine import Timer, Pin
 import network
 import time
-import ubinascii
 from machine import UART as serial
-import re
+import resolver
 
 _logger = logging.getLogger("comm", logging.INFO)
 
+# Unsolicited result codes; the first field is the socket/client profile id.
+# They are queued per (prefix, profile id) until the owner asks for them.
+URC_PREFIXES = ('+CSONMI:', '+CSOERR:', '+CCOAPNMI:', '+CMQPUB:')
+SOCKET_URC_PREFIXES = ('+CSONMI:', '+CSOERR:')
+# URCs whose last field is a hex payload, queued decoded as a bytearray
+PAYLOAD_URC_PREFIXES = ('+CSONMI:', '+CCOAPNMI:', '+CMQPUB:')
+_URC_PREFIX_BYTES = tuple((prefix, prefix.encode()) for prefix in URC_PREFIXES)
+# Fields of the AT responses and URCs read by this module, by prefix. Lines are
+# split on commas after the prefix, so a field is picked by its position.
+RESPONSE_FIELDS = {
+    '+CSOC:': ('profile_id',),
+    '+CSONMI:': ('profile_id', 'length', 'data'),
+    '+CSOERR:': ('profile_id', 'error'),
+    '+CSOSTATUS:': ('profile_id', 'status'),
+    '+CCOAPNEW:': ('profile_id',),
+    '+CCOAPNMI:': ('profile_id', 'length', 'data'),
+    '+CMQNEW:': ('profile_id',),
+    '+CMQPUB:': ('profile_id', 'topic', 'qos', 'retained', 'dup', 'length', 'data'),
+    '+CDNSGIP:': ('result', 'host', 'address'),
+    '+CSQ:': ('rssi', 'ber'),
+    '+CIPPING:': ('reply_id', 'address', 'time', 'ttl'),
+    '+CGCONTRDP:': ('cid', 'bearer_id', 'apn', 'address'),
+    '+COPS:': ('mode', 'format', 'operator', 'act'),
+    '+CFUN:': ('fun',),
+    '+CPIN:': ('code',),
+    '*MCGDEFCONT:': ('pdp_type', 'apn'),
+    '+CEREG:': ('n', 'stat', 'tac', 'ci', 'act', 'cause_type', 'reject_cause', 'active_time', 'periodic_tau'),
+}
+_FIELD_INDEX = dict((prefix, dict((name, i) for i, name in enumerate(names))) for prefix, names in RESPONSE_FIELDS.items())
+# oldest URCs of a profile are dropped beyond this, e.g. when nobody reads a socket
+URC_QUEUE_SIZE = 16
+# how long to wait for the UART to receive more data
+POLL_INTERVAL = 0.001
+# size of the UART RX buffer and of the LineReader buffer; longer lines are dropped
+RX_BUFFER_SIZE = 4096
+# payload bytes per AT+CSOSEND, the modem takes at most 1024 hex characters
+SEND_CHUNK = 512
+# AT+CSOSEND commands in flight before waiting for their OK. 1 waits for every
+# OK. Larger windows are opt-in (NBIOTTCPSocket(window=2)): V.250 lets the modem
+# abort a command when more characters arrive, so pipelining is only measured on
+# the emulator so far, and the echoes of all commands in flight (~1 KB each) have
+# to fit in the 4 KB UART RX buffer.
+SEND_WINDOW = 1
+# pooled sockets idle for longer are checked with AT+CSOSTATUS before reuse
+POOL_CHECK_INTERVAL = 30.0
+
+APN = 'telenor.iot'
+NBIOT_OPERATOR = '24201'
+# a warm NB-IoT connect falls back to provisioning when not attached by then
+WARM_ATTACH_TIMEOUT = 30.0
+# a modem in PSM is woken up by a short power key pulse and then polled with AT,
+# instead of waiting out the boot time; it falls back to a power up if it does
+# not answer within WAKE_TIMEOUT seconds
+WAKE_PULSE = 0.1
+WAKE_POLL_TIMEOUT = 0.2
+WAKE_TIMEOUT = 5.0
+HEX_DIGITS = b'0123456789abcdef'
+
+@micropython.native
+def hexlify_into(buf, data):
+    # hex encodes data into buf without allocating, returns the number of characters
+    i = 0
+    for b in data:
+        buf[i] = HEX_DIGITS[b >> 4]
+        buf[i + 1] = HEX_DIGITS[b & 0x0F]
+        i += 2
+    return i
+
+def parse_fields(line, prefix):
+    # fields of an AT response after its prefix, without spaces and quotes
+    return line[len(prefix):].replace(' ', '').replace('"', '').split(',')
+
+def pick_fields(fields, prefix, names):
+    # values of the named fields of a parsed response, None for missing ones
+    index = _FIELD_INDEX[prefix]
+    return [fields[index[name]] if index[name] < len(fields) else None for name in names]
+
+@micropython.native
+def find_byte(buf, value, start, end):
+    # index of the first value in buf[start:end], or -1
+    i = start
+    while i < end:
+        if buf[i] == value:
+            return i
+        i += 1
+    return -1
+
+@micropython.native
+def unhexlify_into(buf, data):
+    # decodes the hex characters of data into buf without allocating, returns the number of bytes
+    n = len(data) // 2
+    for i in range(n):
+        hi = data[2 * i]
+        lo = data[2 * i + 1]
+        hi = hi - 48 if hi < 58 else (hi | 32) - 87
+        lo = lo - 48 if lo < 58 else (lo | 32) - 87
+        buf[i] = (hi << 4) | lo
+    return n
+
+class LineReader:
+    # Reads the UART in bulk with readinto() and hands out the lines as
+    # memoryviews of its buffer, without the line ending. A line is only valid
+    # until the next readline(). The buffer is compacted when it runs out of
+    # room, which moves at most one partial line.
+    def __init__(self, uart, size=RX_BUFFER_SIZE):
+        self.uart = uart
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        # unread data is _buf[_start:_end], _buf[_start:_scan] has no line ending
+        self._start = 0
+        self._scan = 0
+        self._end = 0
+        # the rest of an overlong line is dropped
+        self._skip = False
+
+    def readline(self):
+        # next non-empty line, or None if no complete line has been received yet
+        while True:
+            i = find_byte(self._buf, 10, self._scan, self._end)
+            if i < 0:
+                self._scan = self._end
+                if not self._fill():
+                    return None
+                continue
+
+            start = self._start
+            self._start = self._scan = i + 1
+            if self._skip:
+                self._skip = False
+                continue
+            while i > start and self._buf[i - 1] == 13:
+                i -= 1
+            if i > start:
+                return self._view[start:i]
+
+    def _fill(self):
+        if self._start == self._end:
+            self._start = self._scan = self._end = 0
+        elif self._end == len(self._buf):
+            if self._start == 0:
+                _logger.warning('Line longer than {} bytes, dropping it'.format(len(self._buf)))
+                self._start = self._scan = self._end = 0
+                self._skip = True
+            else:
+                n = self._end - self._start
+                self._buf[:n] = self._buf[self._start:self._end]
+                self._start, self._scan, self._end = 0, self._scan - self._start, n
+
+        n = self.uart.readinto(self._view[self._end:])
+        if not n:
+            return False
+        self._end += n
+        return True
+
 class TimeoutError(Exception):
     pass
 
@@ -23,6 +177,9 @@ class NBIOTHTTPSocketError(Exception):
 class NBIOTTCPSocketError(Exception):
     pass
 
+class NBIOTSocketPoolError(Exception):
+    pass
+
 class MQTTClientError(Exception):
     pass
 
@@ -48,12 +205,33 @@ class TimedStep(object):
         else:
             self.logger.info("%s OK (%f ms)", self.desc, elapsed)
 
+class AttachTimes:
+    # Time connect() took on the cold path (full provisioning) and on the warm
+    # path (registration and PDP context of an earlier connect reused)
+    def __init__(self, name):
+        self.name = name
+        # wake: woken up from PSM with the registration kept (NB-IoT only)
+        self.stats = {'cold': [0, 0, 0], 'warm': [0, 0, 0], 'wake': [0, 0, 0]}
+
+    def record(self, path, elapsed):
+        entry = self.stats[path]
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = elapsed
+        _logger.info("%s attach (%s): %d ms", self.name, path, elapsed)
+
+    def summary(self):
+        return ', '.join('{}: {} x {} ms avg'.format(path, count, total // count if count > 0 else 0)
+                         for path, (count, total, _) in sorted(self.stats.items()))
+
 class LTE:
-    def __init__(self):
+    def __init__(self, apn=APN):
         self._lte = None
         self._sql = None
         self.connected = False
         self.type = 'RADIO_LTE'
+        self.apn = apn
+        self.attach_times = AttachTimes('LTE')
 
     def connect(self):
         def send_at_cmd_pretty(cmd):
@@ -70,12 +248,32 @@ class LTE:
 
         tschrono = Timer.Chrono()
         tschrono.start()
+        attach_chrono = Timer.Chrono()
+        attach_chrono.start()
 
         with TimedStep("LTE object init", logger=_logger):
             # network.LTE.reconnect_uart()
             self._lte = network.LTE()
             # self._lte.reconnect_uart()
 
+        # warm path: the modem is still attached with our APN, e.g. after a reboot
+        # of the FiPy, so reset, init and provisioning can be skipped
+        if self._lte.isattached():
+            response = send_at_cmd_pretty('AT+CGDCONT?')
+            if response is not None and response.find('"{}"'.format(self.apn)) >= 0:
+                with TimedStep("LTE warm connect", logger=_logger):
+                    if not self._lte.isconnected():
+                        self._lte.connect()
+                    while not self._lte.isconnected():
+                        if tschrono.read_ms() > 120 * 1000:
+                            self.deinit()
+                            raise TimeoutError("Timeout during LTE connect")
+                        time.sleep_ms(250)
+
+                self.connected = True
+                self.attach_times.record('warm', attach_chrono.read_ms())
+                return
+
         with TimedStep("LTE reset", logger=_logger):
             self._lte.reset()
         #     self._lte.send_at_cmd('AT^RESET')
@@ -87,7 +285,7 @@ class LTE:
             send_at_cmd_pretty('AT+CFUN=0')
             # lte.send_at_cmd('AT!="clearscanconfig"')
             # lte.send_at_cmd("AT!=\"RRC::addscanfreq band=8 dl-earfcn=3740\"")
-            send_at_cmd_pretty('AT+CGDCONT=1,"IP","%s"' % 'telenor.iot')
+            send_at_cmd_pretty('AT+CGDCONT=1,"IP","%s"' % self.apn)
             send_at_cmd_pretty('AT+CFUN=1')
             send_at_cmd_pretty('AT+CSQ')
 
@@ -126,6 +324,8 @@ class LTE:
                 
                 time.sleep_ms(250)
 
+        self.attach_times.record('cold', attach_chrono.read_ms())
+
     def deinit(self):
         self._sql = None
         self.connected = False
@@ -166,116 +366,176 @@ class LTE:
 
 class NBIOTTCPSocket:
 
-    def __init__(self, nb: NBIOT, timeout=120.0):
+    def __init__(self, nb: 'NBIOT', timeout=120.0, window=SEND_WINDOW):
         self.nb = nb
         self.host = None
         self.port = None
         self.profile_id = 0
         self.timeout = timeout
-        self.response_received = False
+        self.window = window
+        self.rx_buffer = bytearray()
+        self.peer_closed = False
+        self.pool = None
         if self.nb.connected is False:
             self.nb.connect()
 
-    def connect(self, address: Tuple[str, int]):
-        self.response_received = False
+    def connect(self, address: 'Tuple[str, int]'):
+        self.rx_buffer = bytearray()
+        self.peer_closed = False
         if self.host is None:
             self.host, self.port = address
 
-        client_pattern = '\+CSOC: ([0-9]+)'
-        status, data = self.nb.execute_cmd('AT+CSOC=1,1,1', client_pattern, [1])
+        status, data = self.nb.execute_cmd('AT+CSOC=1,1,1', '+CSOC:', ['profile_id'])
         if not status:
             raise NBIOTTCPSocketError('Error while creating TCP socket!')
 
         self.profile_id = int(data[0])
-        status, _ = self.nb.execute_cmd('AT+CSOCON={},{},"{}"'.format(self.profile_id, self.port, self.host))
+        status, _ = self.nb.execute_cmd('AT+CSOCON={},{},"{}"'.format(self.profile_id, self.port, self.nb.resolve(self.host)))
         if not status:
             raise NBIOTTCPSocketError('Error while establishing connection!')
 
+    # With a window above 1 chunks are pipelined: up to self.window AT+CSOSEND
+    # commands are sent before the OK of the oldest one is read, so the UART never
+    # idles for a round-trip.
     def send(self, data: bytes, flags: int = ...):
-        data = ubinascii.hexlify(data)
-        data = data.decode()
-        data_len = len(data)
-        if data_len > 1024:
-            data = [data[i:i+1024] for i in range(0, data_len, 1024)]
-            for part in data:
-                status, _ = self.nb.execute_cmd('AT+CSOSEND={},{},{}'.format(self.profile_id, len(part), part))
-                if not status:
-                    raise NBIOTTCPSocketError('Socket error!')
-        else:
-            status, _ = self.nb.execute_cmd('AT+CSOSEND={},{},{}'.format(self.profile_id, len(data), data))
+        data = memoryview(data)
+        in_flight = 0
+        try:
+            for i in range(0, len(data), SEND_CHUNK):
+                if in_flight >= self.window:
+                    in_flight -= 1
+                    if not self.nb.read_result():
+                        self._send_failed()
+
+                part = data[i:i + SEND_CHUNK]
+                self.nb.send_hex_cmd('AT+CSOSEND={},{},'.format(self.profile_id, 2 * len(part)), part)
+                in_flight += 1
+
+            while in_flight > 0:
+                in_flight -= 1
+                if not self.nb.read_result():
+                    self._send_failed()
+        finally:
+            # results of commands still in flight after an error must not be
+            # mistaken for the results of the next commands; a modem that does
+            # not answer them must not hide the original error
+            try:
+                while in_flight > 0:
+                    in_flight -= 1
+                    self.nb.read_result()
+            except TimeoutError:
+                pass
 
-        if status:
-            return data_len / 2
-        
-        return 0
+        return len(data)
+
+    def _send_failed(self):
+        # the connection is gone, so a pool hands out a new socket next time
+        self.peer_closed = True
+        raise NBIOTTCPSocketError('Socket error!')
 
+    # Returns data of the next +CSONMI notification (at most bufsize bytes), so the
+    # caller can stop reading once a response is complete instead of waiting for
+    # the server to close the connection. Empty data means closed or timed out.
     def recv(self, bufsize: int, flags: int = ...):
-        data = bytearray()
-        if not self.response_received:
+        if len(self.rx_buffer) == 0 and not self.peer_closed:
             try:
-                status, response = self._read_detached_response('+CSONMI:')
+                prefix, fields = self.nb.wait_urc([('+CSONMI:', self.profile_id), ('+CSOERR:', self.profile_id)])
             except TimeoutError:
-                return data
-
-            if status:
-                for r in response:
-                    data.extend(ubinascii.unhexlify(r))
-                self.response_received = True
-        
-        return data
+                return bytearray()
 
-    def close(self):
-        self.response_received = False
-        self.nb.execute_cmd('AT+CSOCL={}'.format(self.profile_id))
-
-    def _read_detached_response(self, expected_prefix, timeout=30.0):
-        expected_line = None
-        status = False
+            if prefix == '+CSONMI:':
+                # the payload is already decoded into its own bytearray
+                self.rx_buffer = fields[2]
+            else:
+                self.peer_closed = True
 
-        tschrono = Timer.Chrono()
-        tschrono.start()
-        expected_response = []
+        if len(self.rx_buffer) <= bufsize:
+            data = self.rx_buffer
+            self.rx_buffer = bytearray()
+            return data
 
-        while True:
-            x = self.nb.serial.readline()
+        data = self.rx_buffer[:bufsize]
+        self.rx_buffer = self.rx_buffer[bufsize:]
 
-            if tschrono.read_ms() > timeout * 1000: 
-                raise TimeoutError("NBIOT _read_response timeout!")
+        return data
 
-            if x is None:
-                continue
+    def close(self):
+        self.rx_buffer = bytearray()
+        self.peer_closed = False
+        self.nb.execute_cmd('AT+CSOCL={}'.format(self.profile_id))
+        self.nb.discard_urcs(SOCKET_URC_PREFIXES, self.profile_id)
+        if self.pool is not None:
+            self.pool.remove(self)
 
-            try:
-                x = x.decode()
-            except UnicodeError:
-                continue
+    def is_connected(self):
+        # asks the modem, status 2 is a connected socket
+        status, data = self.nb.execute_cmd('AT+CSOSTATUS={}'.format(self.profile_id), '+CSOSTATUS:', ['profile_id', 'status'])
 
-            x = x.replace('\r', '').replace('\n', '')
+        return status and int(data[0]) == self.profile_id and int(data[1]) == 2
 
-            if len(x) == 0:
-                time.sleep(0.1)
-                continue
+class NBIOTSocketPool:
+    # Keeps modem TCP socket profiles open per (host, port), so AT+CSOC, AT+CSOCON
+    # and AT+CSOCL are paid once per session instead of once per request. Closing
+    # a pooled socket removes it from the pool.
+    def __init__(self, nb: 'NBIOT', timeout=120.0, check_interval=POOL_CHECK_INTERVAL):
+        self.nb = nb
+        self.timeout = timeout
+        self.check_interval = check_interval
+        # (host, port) -> [socket, Timer.Chrono of the time since last use]
+        self.sockets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, address: 'Tuple[str, int]'):
+        # Returns (socket, reused) with a connected socket for address
+        address = tuple(address)
+        entry = self.sockets.get(address)
+        if entry is not None:
+            s, idle = entry
+            if self._is_alive(s, idle):
+                idle.reset()
+                self.hits += 1
+                return s, True
+
+            s.close()
+
+        s = NBIOTTCPSocket(self.nb, self.timeout)
+        s.connect(address)
+        s.pool = self
+        idle = Timer.Chrono()
+        idle.start()
+        self.sockets[address] = [s, idle]
+        self.misses += 1
+
+        return s, False
+
+    def remove(self, s):
+        address = (s.host, s.port)
+        entry = self.sockets.get(address)
+        if entry is not None and entry[0] is s:
+            del self.sockets[address]
+        s.pool = None
 
-            # it prints only 75 characters read from serial
-            _logger.debug("<-- {}".format((x[:75]) + '..' if len(x) > 75 else x))
-            # _logger.debug("<-- {}".format(x))
-            tschrono.reset()
+    def close(self):
+        for s, _ in list(self.sockets.values()):
+            s.close()
+        _logger.info('[NBIOTSocketPool] {} sockets reused, {} opened'.format(self.hits, self.misses))
 
-            if x.find(expected_prefix) >= 0:
-                expected_line = x.replace(' ', '').replace('"', '')
-                expected_line = expected_line.split(',')
-                expected_response.append(expected_line[2])
-                status = True
-                continue
+    def _is_alive(self, s, idle):
+        # a +CSOERR received meanwhile is free to check, the modem is only asked
+        # after the socket was idle for a while
+        self.nb.poll_urcs()
+        if s.peer_closed or self.nb.has_urc('+CSOERR:', s.profile_id):
+            return False
 
-            if x.find('+CSOERR:') >= 0:
-                break
+        if idle.read_ms() > self.check_interval * 1000:
+            return s.is_connected()
 
-        return status, expected_response
+        return True
 
 class NBIOTUDPSocket:
 
-    def __init__(self, nb: NBIOT, timeout=10.0):
+    def __init__(self, nb: 'NBIOT', timeout=10.0):
         self.nb = nb
         self.address = None
         self.profile_id = -1
@@ -284,33 +544,28 @@ class NBIOTUDPSocket:
         if self.nb.connected is False:
             self.nb.connect()
 
-    def sendto(self, data: bytes, address: Tuple[str, int]):
+    def sendto(self, data: bytes, address: 'Tuple[str, int]'):
         self.address = address
         if self.profile_id < 0:
             self._connect(address)
 
-        data = ubinascii.hexlify(data)
-        data = data.decode()
-        data_len = len(data)
-        status, _ = self.nb.execute_cmd('AT+CSOSEND={},{},{}'.format(self.profile_id, len(data), data), timeout=self.timeout)
+        status, _ = self.nb.execute_hex_cmd('AT+CSOSEND={},{},'.format(self.profile_id, 2 * len(data)), data, timeout=self.timeout)
 
         if status:
-            return data_len / 2
-        
+            return len(data)
+
         return 0
 
     def recvfrom(self, bufsize: int, flags: int = ...):
-        data = bytearray()
         try:
-            status, response = self._read_detached_response('+CSONMI:', self.timeout)
+            prefix, fields = self.nb.wait_urc([('+CSONMI:', self.profile_id), ('+CSOERR:', self.profile_id)], self.timeout)
         except TimeoutError:
-            return data, self.address
+            return bytearray(), self.address
 
-        if status:
-            for r in response:
-                data.extend(ubinascii.unhexlify(r))
-        
-        return data, self.address
+        if prefix == '+CSONMI:':
+            return fields[2], self.address
+
+        return bytearray(), self.address
 
     def setblocking(self, flag: bool):
         pass
@@ -318,70 +573,25 @@ class NBIOTUDPSocket:
     def close(self):
         self.response_received = False
         self.nb.execute_cmd('AT+CSOCL={}'.format(self.profile_id))
+        self.nb.discard_urcs(SOCKET_URC_PREFIXES, self.profile_id)
         self.profile_id = -1
         self.address = None
 
-    def _connect(self, address: Tuple[str, int]):
+    def _connect(self, address: 'Tuple[str, int]'):
         self.response_received = False
 
-        client_pattern = '\+CSOC: ([0-9]+)'
-        status, data = self.nb.execute_cmd('AT+CSOC=1,2,1', client_pattern, [1])
+        status, data = self.nb.execute_cmd('AT+CSOC=1,2,1', '+CSOC:', ['profile_id'])
         if not status:
             raise NBIOTUDPSocketError('Error while creating UDP socket!')
 
         self.profile_id = int(data[0])
-        status, _ = self.nb.execute_cmd('AT+CSOCON={},{},"{}"'.format(self.profile_id, self.address[1], self.address[0]))
+        status, _ = self.nb.execute_cmd('AT+CSOCON={},{},"{}"'.format(self.profile_id, self.address[1], self.nb.resolve(self.address[0])))
         if not status:
             raise NBIOTUDPSocketError('Error while establishing connection!')
 
-    def _read_detached_response(self, expected_prefix, timeout=30.0):
-        expected_line = None
-        status = False
-
-        tschrono = Timer.Chrono()
-        tschrono.start()
-        expected_response = []
-
-        while True:
-            x = self.nb.serial.readline()
-
-            if tschrono.read_ms() > timeout * 1000: 
-                raise TimeoutError("NBIOT _read_response timeout!")
-
-            if x is None:
-                continue
-
-            try:
-                x = x.decode()
-            except UnicodeError:
-                continue
-
-            x = x.replace('\r', '').replace('\n', '')
-
-            if len(x) == 0:
-                time.sleep(0.1)
-                continue
-
-            # it prints only 75 characters read from serial
-            _logger.debug("<-- {}".format((x[:75]) + '..' if len(x) > 75 else x))
-            # _logger.debug("<-- {}".format(x))
-            tschrono.reset()
-
-            if x.find(expected_prefix) >= 0:
-                expected_line = x.replace(' ', '').replace('"', '')
-                expected_line = expected_line.split(',')
-                expected_response.append(expected_line[2])
-                status = True
-                break
-
-            if x.find('+CSOERR:') >= 0:
-                break
-
-        return status, expected_response
-
 class NBIOTCoAPSocket:
 
-    def __init__(self, nb: NBIOT, host_ip, host_port, timeout=10.0, reusable=False):
+    def __init__(self, nb: 'NBIOT', host_ip, host_port, timeout=10.0, reusable=False):
         self.nb = nb
         self.host_ip = host_ip
         self.host_port = host_port
@@ -394,23 +604,18 @@ class NBIOTCoAPSocket:
         
         self._create_client()
     
-    def sendto(self, data: bytes, address: Tuple[str, int]):
+    def sendto(self, data: bytes, address: 'Tuple[str, int]'):
         self.response_data = bytearray()
-        msg_pattern = '\+CCOAPNMI: {},([0-9]+),(.*)'.format(self.coap_profile_id)
-        data = ubinascii.hexlify(data)
-        data = data.decode()
-        status, response = self.nb.execute_cmd('AT+CCOAPSEND={},{},"{}"'.format(
-            # self.coap_profile_id, int(len(data) / 2), data), msg_pattern, timeout=20.0
-            self.coap_profile_id, int(len(data) / 2), data), msg_pattern, timeout=self.timeout
+        status, _ = self.nb.execute_hex_cmd('AT+CCOAPSEND={},{},"'.format(self.coap_profile_id, len(data)), data, '"',
+            timeout=self.timeout
         )
-        if status and response is not None:
-            _logger.debug('[NBIOTCoAPSocket] Sent {} bytes!'.format(int(len(data) / 2)))
-            r_data = response[2]
-            r_data = r_data.encode()
-            r_data = ubinascii.unhexlify(r_data)
-            self.response_data = r_data
+        if status:
+            # the response arrives as +CCOAPNMI after OK
+            _, response = self.nb.wait_urc([('+CCOAPNMI:', self.coap_profile_id)], self.timeout)
+            _logger.debug('[NBIOTCoAPSocket] Sent {} bytes!'.format(len(data)))
+            self.response_data = response[2]
 
-            return int(len(data) / 2)
+            return len(data)
 
         raise NBIOTCoAPSocketError
 
@@ -428,17 +633,17 @@ class NBIOTCoAPSocket:
     def close(self):
         if not self.reusable:
             self.nb.execute_cmd('AT+CCOAPDEL={}'.format(self.coap_profile_id))
+            self.nb.discard_urcs(['+CCOAPNMI:'], self.coap_profile_id)
 
     def _create_client(self):
-        coapnew_pattern = '\+CCOAPNEW: ([0-9]+)'
-        status, response = self.nb.execute_cmd('AT+CCOAPNEW="{}",{},{}'.format(self.host_ip, self.host_port, self.coap_profile_id), coapnew_pattern, expected_index=[1])
+        status, response = self.nb.execute_cmd('AT+CCOAPNEW="{}",{},{}'.format(self.host_ip, self.host_port, self.coap_profile_id), '+CCOAPNEW:', ['profile_id'])
         if not status:
             raise NBIOTCoAPSocketError('CoAP client creation failed!')
             
         self.coap_profile_id = int(response[0])
 
 class NBIOTMQTTClient:
-    def __init__(self, nb: NBIOT, client_id, host_ip, host_port, user = None, password = None):
+    def __init__(self, nb: 'NBIOT', client_id, host_ip, host_port, user = None, password = None):
         self.nb = nb
         self.host_ip = host_ip
         self.host_port = host_port
@@ -467,12 +672,11 @@ class NBIOTMQTTClient:
         if not self.connected:
             raise MQTTClientError('connect() has to be called first!')
 
-        msg = ubinascii.hexlify(msg)
-        msg = msg.decode()
+        if isinstance(msg, str):
+            msg = msg.encode()
         retain = 0 if not retain else 1
-        # cmqpub_pattern = '\+CMQPUB:'
-        cmd = 'AT+CMQPUB={},"{}",{},{},0,{},"{}"'.format(self.mqtt_profile_id, topic, qos, retain, len(msg), msg)
-        status, _ = self.nb.execute_cmd(cmd, timeout=30.0)
+        cmd = 'AT+CMQPUB={},"{}",{},{},0,{},"'.format(self.mqtt_profile_id, topic, qos, retain, 2 * len(msg))
+        status, _ = self.nb.execute_hex_cmd(cmd, msg, '"', timeout=30.0)
         if not status:
             raise MQTTClientError('Publish failed!')
 
@@ -496,14 +700,15 @@ class NBIOTMQTTClient:
         if not self.connected:
             raise MQTTClientError('connect() has to be called first!')
 
-        status, response = self.nb._read_detached_response('+CMQPUB', timeout=60.0)
-        self.cb(response[1], ubinascii.unhexlify(response[6]))
+        _, response = self.nb.wait_urc([('+CMQPUB:', self.mqtt_profile_id)], timeout=60.0)
+        self.cb(response[1], response[6])
 
     def disconnect(self):
         if not self.connected:
             raise MQTTClientError('connect() has to be called first!')
 
         self.nb.execute_cmd('AT+CMQDISCON={}'.format(self.mqtt_profile_id))
+        self.nb.discard_urcs(['+CMQPUB:'], self.mqtt_profile_id)
         self.connected = False
         self.mqtt_profile_id = -1
 
@@ -513,56 +718,63 @@ class NBIOTMQTTClient:
     def _create_client(self):
         if self.mqtt_profile_id < 0:
             # create new MQTT profile
-            cmqnew_pattern = '\+CMQNEW: (\d+)'
-            status, response = self.nb.execute_cmd('AT+CMQNEW="{}",{},60000,1024'.format(self.host_ip, self.host_port), cmqnew_pattern, [1])
+            status, response = self.nb.execute_cmd('AT+CMQNEW="{}",{},60000,1024'.format(self.host_ip, self.host_port), '+CMQNEW:', ['profile_id'])
             if not status:
                 raise MQTTClientError('MQTT profile creation failed!')
 
             self.mqtt_profile_id = int(response[0])
 
 class NBIOT:
-    def __init__(self):
+    def __init__(self, apn=APN, operator=NBIOT_OPERATOR):
         self._sql = None
         self.connected = False
         self.type = 'RADIO_NBIOT'
-        self.serial = serial(1, baudrate=115200, pins=('P3', 'P8'), rx_buffer_size=4096)
+        self.apn = apn
+        self.operator = operator
+        self.attach_times = AttachTimes('NBIOT')
+        self.serial = serial(1, baudrate=115200, pins=('P3', 'P8'), rx_buffer_size=RX_BUFFER_SIZE)
         self.power_pin = Pin('P4', mode=Pin.OUT, pull=Pin.PULL_UP)
         self._cmd = None
+        self._reader = LineReader(self.serial)
+        self._urcs = {}
+        self._hex_buffer = bytearray(2 * SEND_CHUNK)
+        self._hex_view = memoryview(self._hex_buffer)
 
-    def connect(self):
-        while True:
-            try:
-                status, error = self._enable()
-                if status is True:
-                    break
-            except TimeoutError:
-                time.sleep(2)
-                continue
-        # set radio to minimum functionality state in order to set APN
-        self.execute_cmd('AT+CFUN=0')
-        # set APN
-        self.execute_cmd('AT*MCGDEFCONT="IP","telenor.iot')
-        # set back full radio functionality
-        cfun_pattern = '\+CPIN: READY'
-        self.execute_cmd('AT+CFUN=1', cfun_pattern)
-        # attach to the operator
-        attach_pattern = '\+CGCONTRDP:.*\"telenor.iot\",\"([0-9]+.[0-9]+.[0-9]+.[0-9]+.[0-9]+.[0-9]+.[0-9]+.[0-9]+)\".*'
-        while True:
+    def connect(self, wake=False):
+        tschrono = Timer.Chrono()
+        tschrono.start()
+
+        # The modem keeps its APN in NVRAM, so re-provisioning is only needed when
+        # the APN changed. The power key toggles the modem, so it is only pulsed
+        # when the modem does not answer (off or in PSM). The attach is recorded as
+        # warm only if the modem answered and was still attached, and as a wake-up
+        # if it was woken from PSM (wake=True) with its registration; after a power
+        # up the modem attaches again, which is recorded as cold.
+        powered = self._is_powered(WAKE_POLL_TIMEOUT if wake else 1.0)
+        if not powered and not (wake and self._wake()):
+            self._power_on()
+        provisioned = self._is_provisioned()
+        attached = provisioned and (powered or wake) and self._is_attached()
+        path = 'cold'
+        if attached:
+            path = 'warm' if powered else 'wake'
+
+        if provisioned:
             try:
-                self.execute_cmd('AT+CGCONTRDP', attach_pattern, timeout=2.0)
-                break
+                self._wait_attach(WARM_ATTACH_TIMEOUT)
             except TimeoutError:
-                continue
+                _logger.info('NBIOT attach with the kept APN failed, provisioning')
+                provisioned = False
+                path = 'cold'
 
-        # check COPS
-        cops_pattern = '\+COPS: 0,2,\"24201\",9'
-        self.execute_cmd('AT+COPS?', cops_pattern)
+        if not provisioned:
+            self._provision()
+            self._wait_attach()
+
+        self.attach_times.record(path, tschrono.read_ms())
         # check DNS
         dns_check_domain = 'www.google.no'
-        dns_pattern = '\+CDNSGIP:.*,\"{}",\"([0-9]+.[0-9]+.[0-9]+.[0-9]+)\"'.format(dns_check_domain.replace('.', '\.'))
-        dns_status, dns_data = self.execute_cmd('AT+CDNSGIP="{}"'.format(dns_check_domain), dns_pattern)
-        if dns_status:
-            _logger.info('[{}]: {}'.format(dns_data[1], dns_data[2]))
+        _logger.info('[{}]: {}'.format(dns_check_domain, self.resolve(dns_check_domain)))
         # check signal quality
         sqn = self.get_signal_strength()
         _logger.info('Signal quality: {}dbm'.format(sqn[2]))
@@ -572,9 +784,85 @@ class NBIOT:
         self.execute_cmd('AT+CPOWD=1', last_line='NORMAL POWER DOWN')
         self.connected = False
 
+    def _is_powered(self, timeout=1.0):
+        try:
+            status, _ = self.execute_cmd('AT', timeout=timeout)
+        except TimeoutError:
+            return False
+
+        return status
+
+    def _wake(self):
+        # the modem keeps running in PSM, so it answers as soon as it is awake
+        self.power_pin.value(0)
+        time.sleep(WAKE_PULSE)
+        self.power_pin.value(1)
+        tschrono = Timer.Chrono()
+        tschrono.start()
+        while tschrono.read() < WAKE_TIMEOUT:
+            if self._is_powered(WAKE_POLL_TIMEOUT):
+                return True
+
+        _logger.info('NBIOT did not wake up, powering it up')
+        return False
+
+    def _is_provisioned(self):
+        try:
+            status, data = self.execute_cmd('AT+CFUN?', '+CFUN:', ['fun'])
+            if not status or data[0] != '1':
+                return False
+
+            status, data = self.execute_cmd('AT*MCGDEFCONT?', '*MCGDEFCONT:', ['apn'])
+        except TimeoutError:
+            return False
+
+        return status and data[0] == self.apn
+
+    def _power_on(self):
+        while True:
+            try:
+                status, error = self._enable()
+                if status is True:
+                    return
+            except TimeoutError:
+                time.sleep(2)
+                continue
+
+    def _provision(self):
+        # set radio to minimum functionality state in order to set APN
+        self.execute_cmd('AT+CFUN=0')
+        # set APN
+        self.execute_cmd('AT*MCGDEFCONT="IP","{}"'.format(self.apn))
+        # set back full radio functionality, the SIM has to be usable without a PIN
+        status, data = self.execute_cmd('AT+CFUN=1', '+CPIN:', ['code'])
+        if not status or data[0] != 'READY':
+            raise TimeoutError('NBIOT SIM not ready: {}!'.format(data[0] if data else None))
+
+    def _is_attached(self):
+        try:
+            # the modem answers with OK alone until the PDP context is active
+            status, data = self.execute_cmd('AT+CGCONTRDP', '+CGCONTRDP:', ['apn', 'address'], timeout=2.0)
+        except TimeoutError:
+            return False
+
+        return status and data[0] == self.apn and bool(data[1])
+
+    def _wait_attach(self, timeout=None):
+        # attach to the operator
+        tschrono = Timer.Chrono()
+        tschrono.start()
+        while not self._is_attached():
+            if timeout is not None and tschrono.read_ms() > timeout * 1000:
+                raise TimeoutError('NBIOT attach timeout!')
+
+        # check COPS
+        status, data = self.execute_cmd('AT+COPS?', '+COPS:', ['operator'])
+        if not status or data[0] != self.operator:
+            raise TimeoutError('NBIOT not registered to {}!'.format(self.operator))
+
     def ping(self, host, count=5, timeout=20.0):
         def _read_ping_response(number=4, timeout=20.0):
-            ping_prefix = '+CIPPING: '
+            ping_prefix = '+CIPPING:'
             status = False
             cmd_line = False
             reply_time = []
@@ -584,27 +872,11 @@ class NBIOT:
             tschrono.start()
 
             while True:
-                x = self.serial.readline()
-
-                if tschrono.read_ms() > timeout * 1000: 
-                    raise TimeoutError("NBIOT _read_response timeout!")
-
+                x = self._read_line(tschrono, timeout)
                 if x is None:
                     continue
 
-                try:
-                    x = x.decode()
-                except UnicodeError:
-                    continue
-
-                x = x.replace('\r', '').replace('\n', '')
-
-                if len(x) == 0:
-                    time.sleep(0.1)
-                    continue
-
                 tschrono.reset()
-                _logger.debug("<-- %s" % x)
 
                 if x == 'OK':
                     status = True
@@ -618,11 +890,10 @@ class NBIOT:
                     cmd_line = True
                     continue
 
-                if x.find(ping_prefix) >= 0:
-                    x = x.replace(ping_prefix, '')
-                    tmp_ping = x.split(',')
-                    reply_nr = int(tmp_ping[0])
-                    reply_time.append('icmp_seq={}, ttl={}, time={} ms'.format(reply_nr, tmp_ping[3], int(tmp_ping[2])*100))
+                if x.startswith(ping_prefix):
+                    reply_id, reply_ms, ttl = pick_fields(parse_fields(x, ping_prefix), ping_prefix, ['reply_id', 'time', 'ttl'])
+                    reply_nr = int(reply_id)
+                    reply_time.append('icmp_seq={}, ttl={}, time={} ms'.format(reply_nr, ttl, int(reply_ms)*100))
                     _logger.debug('Reply nr: {}' .format(reply_nr))
 
                 if reply_nr == number:
@@ -631,13 +902,12 @@ class NBIOT:
             return status and cmd_line, reply_time
 
         # check DNS
-        dns_pattern = '\+CDNSGIP:.*,\"{}",\"([0-9]+.[0-9]+.[0-9]+.[0-9]+)\"'.format(host.replace('.', '\.'))
-        dns_status, dns_data = self.execute_cmd('AT+CDNSGIP="{}"'.format(host), dns_pattern)
-        if not dns_status:
+        address = self.resolve(host)
+        if address is None:
             return
-        
-        _logger.info('[{}]: {}'.format(dns_data[1], dns_data[2]))
-        ping_cmd = 'AT+CIPPING={},{},32,{}'.format(dns_data[2], count, int(timeout * 10))
+
+        _logger.info('[{}]: {}'.format(host, address))
+        ping_cmd = 'AT+CIPPING="{}",{},32,{}'.format(address, count, int(timeout * 10))
         self._send_cmd(ping_cmd)
         self._cmd = ping_cmd
         status, ping_response = _read_ping_response(count, timeout)
@@ -645,12 +915,27 @@ class NBIOT:
             return
 
         for ping in ping_response:
-            _logger.info('64 bytes from {}: {}'.format(dns_data[2], ping))
+            _logger.info('64 bytes from {}: {}'.format(address, ping))
+
+    def resolve(self, host):
+        # IP address of host from the process-wide DNS cache, looked up with
+        # AT+CDNSGIP on a miss; None if the lookup fails
+        return resolver.resolve(host, self._lookup_dns)
+
+    def _lookup_dns(self, host):
+        try:
+            dns_status, dns_data = self.execute_cmd('AT+CDNSGIP="{}"'.format(host), '+CDNSGIP:', ['result', 'host', 'address'])
+        except TimeoutError:
+            return None
+
+        if not dns_status or dns_data[0] != '1' or dns_data[1] != host or not resolver.is_ip(dns_data[2] or ''):
+            return None
+
+        return dns_data[2]
 
     def get_signal_strength(self):
         # check signal quality
-        csq_pattern = '\+CSQ: ([0-9]+),([0-9]+)'
-        status, signal_search = self.execute_cmd('AT+CSQ', csq_pattern, expected_index=[1,2])
+        status, signal_search = self.execute_cmd('AT+CSQ', '+CSQ:', ['rssi', 'ber'])
         if status:
             rssi_raw, ber_raw = signal_search[0], signal_search[1]
 
@@ -665,14 +950,48 @@ class NBIOT:
 
         return 0, 0, 0
 
-    def execute_cmd(self, cmd, expected_line=None, expected_index=None, last_line='OK', timeout=5.0):
+    def execute_cmd(self, cmd, expected=None, fields=None, last_line='OK', timeout=5.0):
+        # Sends cmd and waits for its result. With expected, a response prefix of
+        # RESPONSE_FIELDS, it also waits for that response and returns the values of
+        # its named fields, or all of its fields when fields is None.
         self._cmd = cmd
         self._send_cmd(cmd)
-        status, expected_value = self._read_response(expected_line, expected_index, last_line, timeout)
-        _logger.info("<--- %s\n" % 'CMD_OK' if status else 'CMD_ERROR')
+        status, expected_value = self._read_response(expected, fields, last_line, timeout)
+        _logger.info("<--- %s\n" % ('CMD_OK' if status else 'CMD_ERROR'))
 
         return status, expected_value
 
+    def execute_hex_cmd(self, cmd, data, cmd_suffix='', expected=None, fields=None, last_line='OK', timeout=5.0):
+        self.send_hex_cmd(cmd, data, cmd_suffix)
+        status, expected_value = self._read_response(expected, fields, last_line, timeout)
+        _logger.info("<--- %s\n" % ('CMD_OK' if status else 'CMD_ERROR'))
+
+        return status, expected_value
+
+    def send_hex_cmd(self, cmd, data, cmd_suffix=''):
+        # Sends cmd, data hex encoded and cmd_suffix as one command without waiting
+        # for the result. The hex string is streamed to the UART through a reusable
+        # buffer instead of being built.
+        self._cmd = cmd
+        _logger.info("---> {}<{} bytes>{}".format(cmd[:75], len(data), cmd_suffix))
+        self.serial.write(cmd)
+        data = memoryview(data)
+        for i in range(0, len(data), SEND_CHUNK):
+            self.serial.write(self._hex_view[:hexlify_into(self._hex_buffer, data[i:i + SEND_CHUNK])])
+        self.serial.write("%s\r\n" % cmd_suffix)
+
+    def read_result(self, timeout=5.0):
+        # Result of the oldest command sent with send_hex_cmd(): True for OK, False
+        # for ERROR. Results arrive in the order the commands were sent.
+        tschrono = Timer.Chrono()
+        tschrono.start()
+
+        while True:
+            x = self._read_line(tschrono, timeout)
+            if x == 'OK' or x == 'ERROR':
+                _logger.info("<--- %s" % ('CMD_OK' if x == 'OK' else 'CMD_ERROR'))
+                return x == 'OK'
+
     def _enable(self):
         def power_on():
             self.power_pin.value(0)
@@ -689,43 +1008,21 @@ class NBIOT:
 
         self.serial.write(full_cmd)
 
-    def _read_response(self, expected_pattern=None, expected_index=None, last_line='OK', timeout=5.0):
+    def _read_response(self, expected=None, fields=None, last_line='OK', timeout=5.0):
         expected_line = None
         last_line_found = False
         status = False
-        pattern = None
         cmd_line = False
         executed_cmd = self._cmd[:75] if len(self._cmd) > 75 else self._cmd
 
         tschrono = Timer.Chrono()
         tschrono.start()
 
-        if expected_pattern is not None:
-            pattern = re.compile(expected_pattern)
-
         while not last_line_found or not cmd_line or not status:
-            x = self.serial.readline()
-
-            if tschrono.read_ms() > timeout * 1000: 
-                raise TimeoutError("NBIOT _read_response timeout!")
-
+            x = self._read_line(tschrono, timeout)
             if x is None:
                 continue
 
-            try:
-                x = x.decode()
-            except UnicodeError:
-                continue
-
-            x = x.replace('\r', '').replace('\n', '')
-
-            if len(x) == 0:
-                time.sleep(0.1)
-                continue
-
-            # it prints only 75 characters read from serial
-            _logger.debug("<-- {}".format((x[:75]) + '..' if len(x) > 75 else x))
-
             if x == 'OK':
                 status = True
                 # print('STATUS: OK')
@@ -741,80 +1038,290 @@ class NBIOT:
                 cmd_line = True
                 # print('CMD_LINE: OK')
 
-            if expected_line is None and expected_pattern is not None:
-                # string might be too big to process
-                # @see: https://github.com/micropython/micropython/issues/2451
-                try:
-                    search = pattern.match(x)
-                except RuntimeError:
-                    _logger.warning('re is not able to process given input. Handling special case!')
-                    lines = [x[i:i+100] for i in range(0, len(x), 100)]
-                    for line in lines:
-                        search = pattern.match(line)
-                        if search is not None and len(search.group(0)) > 0:
-                            expected_line = x.split(',')
-                            last_line_found = True
-                            status = True
-
-
-                if search is None:
-                    continue
+            if expected_line is None and expected is not None and x.startswith(expected):
+                expected_line = parse_fields(x, expected)
+                if fields is not None:
+                    expected_line = pick_fields(expected_line, expected, fields)
+                last_line_found = True
 
-                if len(search.group(0)) > 0:
-                    expected_line = []
-                    if expected_index is not None:
-                        for i in expected_index:
-                            expected_line.append(search.group(i))
-                    else:
-                        expected_line = x.split(',')
-                    last_line_found = True
-                    # status = True
-
-            if expected_pattern is None and x.find(last_line) >= 0:
+            if expected is None and x.find(last_line) >= 0:
                 last_line_found = True
                 status = True
                 # print('STATUS & LAST_LINE: OK')
 
         return status, expected_line
 
-    def _read_detached_response(self, expected_prefix, timeout=30.0):
-        expected_line = None
-        status = False
-
+    def wait_urc(self, keys, timeout=30.0):
+        # Returns (prefix, fields) of the oldest URC queued for one of the
+        # (prefix, profile id) keys, reading the UART until one arrives
         tschrono = Timer.Chrono()
         tschrono.start()
 
         while True:
-            x = self.serial.readline()
+            for prefix, profile_id in keys:
+                queue = self._urcs.get((prefix, profile_id))
+                if queue:
+                    return prefix, queue.pop(0)
 
-            if tschrono.read_ms() > timeout * 1000: 
-                raise TimeoutError("NBIOT _read_response timeout!")
+            x = self._read_line(tschrono, timeout)
+            if x is not None:
+                _logger.debug("Unexpected line: {}".format(x[:75]))
 
+    def has_urc(self, prefix, profile_id):
+        return len(self._urcs.get((prefix, profile_id), ())) > 0
+
+    def poll_urcs(self):
+        # queues the URCs already received without waiting for more
+        tschrono = Timer.Chrono()
+        tschrono.start()
+        while True:
+            x = self._read_line(tschrono, 5.0)
             if x is None:
-                continue
+                return
+            _logger.debug("Unexpected line: {}".format(x[:75]))
+
+    def discard_urcs(self, prefixes, profile_id):
+        # profile ids are reused by the modem, so URCs left for a closed profile must go
+        for prefix in prefixes:
+            self._urcs.pop((prefix, profile_id), None)
+
+    def _read_line(self, tschrono, timeout):
+        # Returns the next non-empty line that is not an URC, or None if there is none
+        # yet. URCs are queued for wait_urc(), so commands and notifications of all
+        # sockets and clients can share the UART without losing data.
+        while True:
+            if tschrono.read_ms() > timeout * 1000:
+                raise TimeoutError("NBIOT _read_response timeout!")
+
+            line = self._reader.readline()
+            if line is None:
+                time.sleep(POLL_INTERVAL)
+                return None
 
             try:
-                x = x.decode()
-            except UnicodeError:
+                if line[0] == 43 and self._dispatch(line):
+                    continue
+                x = str(line, 'utf-8')
+            except (UnicodeError, ValueError, IndexError):
                 continue
 
-            x = x.replace('\r', '').replace('\n', '')
+            # it prints only 75 characters read from serial
+            _logger.debug("<-- {}".format((x[:75]) + '..' if len(x) > 75 else x))
+            return x
+
+    def _dispatch(self, line):
+        # queues line if it is an URC; hex payloads are decoded straight from the
+        # line buffer, the other fields are split as strings
+        head = bytes(line[:12])
+        for prefix, prefix_bytes in _URC_PREFIX_BYTES:
+            if head.startswith(prefix_bytes):
+                if prefix in PAYLOAD_URC_PREFIXES:
+                    end = len(line)
+                    comma = end - 1
+                    while comma > 0 and line[comma] != 44:
+                        comma -= 1
+                    fields = parse_fields(str(line[:comma], 'utf-8'), prefix)
+                    start = comma + 1
+                    if line[start] == 34:
+                        start += 1
+                    if line[end - 1] == 34:
+                        end -= 1
+                    payload = bytearray((end - start) // 2)
+                    unhexlify_into(payload, line[start:end])
+                    fields.append(payload)
+                    _logger.debug("<-- {}{} <{} bytes>".format(prefix, ','.join(fields[:-1])[:75], len(payload)))
+                else:
+                    fields = parse_fields(str(line, 'utf-8'), prefix)
+                    _logger.debug("<-- {}{}".format(prefix, ','.join(fields)[:75]))
+                try:
+                    profile_id = int(fields[0])
+                except ValueError:
+                    return False
+
+                queue = self._urcs.setdefault((prefix, profile_id), [])
+                if len(queue) >= URC_QUEUE_SIZE:
+                    _logger.warning("URC queue of {}{} full, dropping the oldest".format(prefix, profile_id))
+                    queue.pop(0)
+                queue.append(fields)
+                return True
 
-            if len(x) == 0:
-                time.sleep(0.1)
-                continue
+        return False
+
+# 3GPP TS 24.008 GPRS timer units: (unit bits, seconds per step), the value is 5 bits
+T3412_UNITS = ((3, 2), (4, 30), (5, 60), (0, 600), (1, 3600), (2, 36000), (6, 1152000))
+T3324_UNITS = ((0, 2), (1, 60), (2, 360))
+# eDRX cycle lengths of NB-S1 mode in seconds, by 4 bit value (TS 24.008, 10.5.5.32)
+EDRX_CYCLES = ((2, 20.48), (3, 40.96), (5, 81.92), (9, 163.84), (10, 327.68), (11, 655.36),
+               (12, 1310.72), (13, 2621.44), (14, 5242.88), (15, 10485.76))
+# AcT of AT+CEDRXS for NB-IoT
+EDRX_ACT_NBIOT = 5
+
+PSM_OFF = 'OFF'
+PSM_ACTIVE = 'ACTIVE'
+PSM_IDLE = 'IDLE'
+PSM_SLEEP = 'PSM'
+
+def _bits(value, length):
+    return ''.join('1' if value & (1 << i) else '0' for i in range(length - 1, -1, -1))
+
+def encode_timer(seconds, units):
+    # shortest unit that holds seconds in 5 bits, rounded up; '111xxxxx' deactivates
+    if seconds is None:
+        return '11100000'
+    for unit, step in units:
+        value = -(-int(seconds) // step)
+        if value <= 31:
+            return _bits(unit << 5 | value, 8)
+    unit, step = units[-1]
+    return _bits(unit << 5 | 31, 8)
+
+def decode_timer(bits, units):
+    # seconds of an 8 bit timer string, None if deactivated or unknown
+    value = int(bits, 2)
+    for unit, step in units:
+        if unit == value >> 5:
+            return step * (value & 0x1F)
+    return None
+
+def encode_edrx(seconds):
+    # shortest cycle of at least seconds
+    for value, cycle in EDRX_CYCLES:
+        if cycle >= seconds:
+            return _bits(value, 4)
+    return _bits(EDRX_CYCLES[-1][0], 4)
+
+def decode_edrx(bits):
+    value = int(bits, 2)
+    for v, cycle in EDRX_CYCLES:
+        if v == value:
+            return cycle
+    return None
+
+class PowerManager:
+    # Keeps the NB-IoT modem registered between experiments with PSM and eDRX
+    # instead of powering it down with NBIOT.deinit(), which forces a full attach.
+    # After traffic the modem stays reachable (IDLE, paged every eDRX cycle) for
+    # the active time T3324, then sleeps in PSM until the next periodic TAU
+    # (T3412) or until it is woken up for uplink traffic.
+    def __init__(self, nb: 'NBIOT', active_time=60, tau=3600, edrx=None):
+        self.nb = nb
+        self.active_time = active_time
+        self.tau = tau
+        self.edrx = edrx
+        self.enabled = False
+        self.in_traffic = False
+        self.wakes = 0
+        self.wake_ms = 0
+        self._idle = Timer.Chrono()
+
+    def configure(self):
+        # requests the timers and reads back what the network granted
+        status, _ = self.nb.execute_cmd('AT+CPSMS=1,,,"{}","{}"'.format(
+            encode_timer(self.tau, T3412_UNITS), encode_timer(self.active_time, T3324_UNITS)))
+        if not status:
+            return False
 
-            # it prints only 75 characters read from serial
-            # _logger.debug("<-- {}".format((x[:75]) + '..' if len(x) > 75 else x))
-            _logger.debug("<-- {}".format(x))
+        if self.edrx is not None:
+            self.nb.execute_cmd('AT+CEDRXS=1,{},"{}"'.format(EDRX_ACT_NBIOT, encode_edrx(self.edrx)))
 
-            if x.find(expected_prefix) >= 0:
-                expected_line = x.replace(' ', '').replace('"', '')
-                expected_line = expected_line.split(',')
-                status = True
-                break
+        # n=4 only for this query: unsolicited +CEREG lines lack <n>, so they must
+        # not be mistaken for the response to a later query
+        self.nb.execute_cmd('AT+CEREG=4')
+        try:
+            status, data = self.nb.execute_cmd('AT+CEREG?', '+CEREG:', ['n', 'active_time', 'periodic_tau'])
+        except TimeoutError:
+            status = False
+        self.nb.execute_cmd('AT+CEREG=0')
+        # without granted timers the network refused PSM and the modem stays awake,
+        # so the requested timers are kept but never used to guess the state
+        self.enabled = bool(status and data[0] == '4' and data[1] and data[2])
+        if self.enabled:
+            self.active_time = decode_timer(data[1], T3324_UNITS)
+            self.tau = decode_timer(data[2], T3412_UNITS)
+            _logger.info('PSM granted: active time {}s, TAU {}s, eDRX {}s'.format(self.active_time, self.tau, self.edrx))
+        else:
+            _logger.warning('PSM not granted by the network')
+
+        self._idle.start()
+        self._idle.reset()
+        return self.enabled
+
+    def disable(self):
+        self.nb.execute_cmd('AT+CPSMS=0')
+        if self.edrx is not None:
+            self.nb.execute_cmd('AT+CEDRXS=0')
+        self.enabled = False
+
+    def state(self):
+        if not self.nb.connected:
+            return PSM_OFF
+        if self.in_traffic or not self.enabled:
+            return PSM_ACTIVE
+        if self._idle.read() < self.active_time:
+            return PSM_IDLE
+        return PSM_SLEEP
+
+    def next_window(self):
+        # seconds until the modem can receive downlink data
+        state = self.state()
+        if state == PSM_ACTIVE or state == PSM_OFF:
+            return 0
+        idle = self._idle.read()
+        if state == PSM_IDLE:
+            if self.edrx is None:
+                return 0
+            return self.edrx - idle % self.edrx
+        if self.tau is None:
+            return None
+        return self.tau - idle % self.tau
+
+    def wake(self):
+        # uplink traffic can start at any time, but in PSM the modem has to be
+        # woken up first; its registration is kept, so there is no attach
+        if self.state() != PSM_SLEEP:
+            return
+        tschrono = Timer.Chrono()
+        tschrono.start()
+        # state() only guesses from the timers, so the power key is left to
+        # connect(), which pulses it only when the modem does not answer
+        self.nb.connect(wake=True)
+        elapsed = tschrono.read_ms()
+        self.wakes += 1
+        self.wake_ms += elapsed
+        _logger.info('PSM wake-up: {} ms'.format(elapsed))
+
+    def start_traffic(self):
+        # traffic until end_traffic() runs in one wake window
+        self.wake()
+        self.in_traffic = True
+
+    def end_traffic(self):
+        # the active time T3324 starts after the last traffic
+        self.in_traffic = False
+        self._idle.reset()
 
-        return status, expected_line
+    def __enter__(self):
+        # with power_manager: ... groups traffic into one wake window
+        self.start_traffic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end_traffic()
+
+    def estimate(self, reconnect_ms=None):
+        # ms saved per wake cycle compared to powering down and connecting again,
+        # which takes reconnect_ms (by default the average cold attach)
+        if reconnect_ms is None:
+            cold = self.nb.attach_times.stats['cold']
+            if cold[0] == 0:
+                return None
+            reconnect_ms = cold[1] // cold[0]
+        if self.wakes == 0:
+            return None
+        saved = reconnect_ms - self.wake_ms // self.wakes
+        _logger.info('PSM: {} wake-ups, {} ms avg; reconnect {} ms; saved {} ms per wake cycle'.format(
+            self.wakes, self.wake_ms // self.wakes, reconnect_ms, saved))
+        return saved
 
 class WLAN:
     def __init__(self):
@@ -67,11 +67,19 @@ COAP_RESPONSE_CODE = enum(
     COAP_PROXYING_NOT_SUPPORTED=CoapResponseCode.encode(5, 5)
 )
 
+# values of the Observe option in a GET request (rfc7641 #2)
+COAP_OBSERVE_REGISTER = 0
+COAP_OBSERVE_DEREGISTER = 1
+# a notification arriving this long after the last one is newer, whatever its
+# sequence number (rfc7641 #3.4)
+COAP_OBSERVE_FRESHNESS_MS = 128000
+
 COAP_OPTION_NUMBER = enum(
     COAP_IF_MATCH=1,
     COAP_URI_HOST=3,
     COAP_E_TAG=4,
     COAP_IF_NONE_MATCH=5,
+    COAP_OBSERVE=6,
     COAP_URI_PORT=7,
     COAP_LOCATION_PATH=8,
     COAP_URI_PATH=11,
@@ -16,6 +16,7 @@ from microcoapy.coap_writer import writePacketOptions
 from microcoapy.coap_writer import writePacketPayload
 
 import binascii
+import resolver
 
 class Coap:
     TRANSMISSION_STATE = macros.enum(
@@ -33,6 +34,8 @@ class Coap:
         self.state = self.TRANSMISSION_STATE.STATE_IDLE
         self.isCustomSocket = False
         self.packet = None
+        # token -> [callback, last observe sequence number, ticks_ms it arrived]
+        self.observations = {}
 
         #beta flags
         self.discardRetransmissions = False
@@ -94,7 +97,7 @@ class Coap:
         try:
             sockaddr = (ip, port)
             try:
-                sockaddr = socket.getaddrinfo(ip, port)[0][-1]
+                sockaddr = resolver.sockaddr(ip, port)
             except Exception as e:
                 pass
 
@@ -168,6 +171,83 @@ class Coap:
     def postNonConf(self, ip, port, url, payload=bytearray(), query_option=None, content_format=macros.COAP_CONTENT_FORMAT.COAP_NONE, token=bytearray()):
         return self.send(ip, port, url, macros.COAP_TYPE.COAP_NONCON, macros.COAP_METHOD.COAP_POST, token, payload, content_format, query_option)
 
+    # Register an observation of a resource (rfc7641). Instead of polling, every
+    # notification about a change of the resource arrives in loop() and is
+    # passed to callback(packet, remoteAddress). The token identifies the
+    # observation and must not be empty.
+    def observe(self, ip, port, url, callback, token, type=macros.COAP_TYPE.COAP_CON):
+        self.observations[bytes(token)] = [callback, -1, 0]
+        return self.sendObserve(ip, port, url, type, token, macros.COAP_OBSERVE_REGISTER)
+
+    # Deregister an observation, the response arrives through resposeCallback
+    def cancelObserve(self, ip, port, url, token, type=macros.COAP_TYPE.COAP_CON):
+        self.observations.pop(bytes(token), None)
+        return self.sendObserve(ip, port, url, type, token, macros.COAP_OBSERVE_DEREGISTER)
+
+    def sendObserve(self, ip, port, url, type, token, observe):
+        packet = CoapPacket()
+        packet.type = type
+        packet.method = macros.COAP_METHOD.COAP_GET
+        packet.token = token
+        packet.payload = None
+        randBytes = uos.urandom(2)
+        packet.messageid = (randBytes[0] << 8) | randBytes[1]
+
+        # options are written in the order they are added: Observe (6) goes
+        # between Uri-Host (3) and Uri-Path (11). The value is always sent as
+        # one byte, as empty options are skipped by the writer.
+        packet.setUriHost(ip)
+        packet.addOption(macros.COAP_OPTION_NUMBER.COAP_OBSERVE, bytearray([observe]))
+        packet.setUriPath(url)
+
+        return self.sendPacket(ip, port, packet)
+
+    def sendEmptyMessage(self, ip, port, type, messageid):
+        packet = CoapPacket()
+        packet.type = type
+        packet.method = macros.COAP_METHOD.COAP_EMPTY_MESSAGE
+        packet.token = None
+        packet.payload = None
+        packet.messageid = messageid
+
+        return self.sendPacket(ip, port, packet)
+
+    def getObserveValue(self, packet):
+        for opt in packet.options:
+            if opt.number == macros.COAP_OPTION_NUMBER.COAP_OBSERVE:
+                return int.from_bytes(opt.buffer, 'big')
+        return None
+
+    def handleNotification(self, packet, observe, remoteAddress):
+        observation = None
+        if packet.token is not None:
+            observation = self.observations.get(bytes(packet.token))
+
+        if observation is None:
+            # notifications of unknown or cancelled observations are rejected,
+            # so the server removes the observer (rfc7641 #3.6)
+            if packet.type == macros.COAP_TYPE.COAP_CON:
+                self.sendEmptyMessage(remoteAddress[0], remoteAddress[1], macros.COAP_TYPE.COAP_RESET, packet.messageid)
+            return False
+
+        if packet.type == macros.COAP_TYPE.COAP_CON:
+            self.sendEmptyMessage(remoteAddress[0], remoteAddress[1], macros.COAP_TYPE.COAP_ACK, packet.messageid)
+
+        # notifications older than the last one are dropped, unless the last one
+        # is too old to compare sequence numbers with, e.g. after PSM (rfc7641 #3.4)
+        last = observation[1]
+        now = time.ticks_ms()
+        if last >= 0 and not ((last < observe and observe - last < (1 << 23)) or\
+                              (last > observe and last - observe > (1 << 23)) or\
+                              time.ticks_diff(now, observation[2]) > macros.COAP_OBSERVE_FRESHNESS_MS):
+            self.log('Discarded reordered notification: ' + str(observe))
+            return False
+
+        observation[1] = observe
+        observation[2] = now
+        observation[0](packet, remoteAddress)
+        return True
+
     def handleIncomingRequest(self, requestPacket, sourceIp, sourcePort):
         url = ""
         for opt in requestPacket.options:
@@ -243,8 +323,11 @@ class Coap:
                     self.lastPacketStr = packet.toString()
             ####
 
+            observe = None if self.isServer else self.getObserveValue(packet)
             if self.isServer:
                 self.handleIncomingRequest(packet, remoteAddress[0], remoteAddress[1])
+            elif observe is not None:
+                return self.handleNotification(packet, observe, remoteAddress)
             else:
                 # To handle cases of Separate response (rfc7252 #5.2.2)
                 if packet.type == macros.COAP_TYPE.COAP_ACK and\
@@ -9,6 +9,7 @@
 import usocket as socket
 import ustruct as struct
 from ubinascii import hexlify
+import resolver
 
 class MQTTException(Exception):
     pass
@@ -20,7 +21,8 @@ class MQTTClient:
             port = 8883 if ssl else 1883
         self.client_id = client_id
         self.sock = None
-        self.addr = socket.getaddrinfo(server, port)[0][-1]
+        self.server = server
+        self.port = port
         self.ssl = ssl
         self.ssl_params = ssl_params
         self.pid = 0
@@ -60,7 +62,7 @@ class MQTTClient:
 
     def connect(self, clean_session=True):
         self.sock = socket.socket()
-        self.sock.connect(self.addr)
+        self.sock.connect(resolver.sockaddr(self.server, self.port))
         if self.ssl:
             import ussl
             self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
@@ -0,0 +1,77 @@
+# Process-wide DNS cache shared by microcoapy, the MQTT client and the NB-IoT
+# modem. A lookup costs a network round-trip (hundreds of ms on NB-IoT), so
+# resolved addresses are kept for DEFAULT_TTL seconds.
+import time
+import usocket as socket
+
+DEFAULT_TTL = 300
+
+def is_ip(host):
+    parts = host.split('.')
+    if len(parts) != 4:
+        return False
+    for part in parts:
+        if not part.isdigit() or int(part) > 255:
+            return False
+    return True
+
+def _getaddrinfo(host):
+    return socket.getaddrinfo(host, 0)[0][-1][0]
+
+class DNSCache:
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=16):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # host -> (expiry time, IP address)
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host, lookup=_getaddrinfo):
+        # IP address of host; lookup(host) runs on a miss and returns the address,
+        # or None when the name cannot be resolved (which is not cached)
+        if is_ip(host):
+            return host
+
+        entry = self.entries.get(host)
+        if entry is not None and entry[0] > time.time():
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        address = lookup(host)
+        if address is not None:
+            self.put(host, address)
+
+        return address
+
+    def put(self, host, address):
+        if host not in self.entries and len(self.entries) >= self.max_entries:
+            # drop the entry closest to expiry
+            oldest = min(self.entries, key=lambda h: self.entries[h][0])
+            del self.entries[oldest]
+        self.entries[host] = (time.time() + self.ttl, address)
+
+    def sockaddr(self, host, port):
+        return (self.resolve(host), port)
+
+    def clear(self):
+        self.entries = {}
+
+    def stats(self):
+        return {
+            'dns_hits': self.hits,
+            'dns_misses': self.misses,
+            'dns_entries': len(self.entries),
+        }
+
+cache = DNSCache()
+
+def resolve(host, lookup=_getaddrinfo):
+    return cache.resolve(host, lookup)
+
+def sockaddr(host, port):
+    return cache.sockaddr(host, port)
+
+def stats():
+    return cache.stats()
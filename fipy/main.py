@@ -1,12 +1,15 @@
 import machine
 import socket
 from time import sleep
-from comm import TimedStep, WLAN, LTE, NBIOT, NBIOTCoAPSocket, NBIOTTCPSocket, NBIOTMQTTClient, NBIOTUDPSocket, TimeoutError
+from comm import TimedStep, WLAN, LTE, NBIOT, NBIOTCoAPSocket, NBIOTTCPSocket, NBIOTTCPSocketError, NBIOTMQTTClient, NBIOTUDPSocket, NBIOTSocketPool, PowerManager, TimeoutError
 import microcoapy
 import logging
 from uping import ping
+import resolver
 # from uos import urandom
 import ucrypto as crypto
+import uzlib
+import uio
 from microcoapy.coap_macros import COAP_OPTION_NUMBER, COAP_TYPE, COAP_METHOD, COAP_CONTENT_FORMAT, CoapResponseCode
 from microcoapy.coap_packet import CoapPacket
 from mqtt import MQTTClient
@@ -31,6 +34,26 @@ MQTT_PASSWORD = 'password'
 # RTT measurements configuration
 REPEAT_TIMES = 5
 
+# number of paths whose ETag and body are kept for conditional GETs
+HTTP_CACHE_SIZE = 4
+
+# on NB-IoT the HTTP RTT requests reuse pooled modem sockets (HTTP/1.1 keep-alive),
+# so the socket setup is paid once per session instead of once per request
+HTTP_POOLED = True
+
+# at the end of the NB-IoT experiments the modem is left registered in PSM instead
+# of being powered down, so the next run wakes it up without a full attach
+NBIOT_PSM = True
+# requested PSM active time (T3324) and periodic TAU (T3412) in seconds, eDRX cycle or None
+PSM_ACTIVE_TIME = 60
+PSM_TAU = 3600
+PSM_EDRX = None
+
+# compressed payloads are inflated with a 2**COMPRESS_WBITS dictionary, matching the backend
+COMPRESS_WBITS = 10
+# experimental Content-Format used by the CoAP server for deflate coded payloads
+COAP_CONTENT_FORMAT_DEFLATE = 65000
+
 _logger = logging.getLogger("main", logging.INFO)
 
 MSG_TYPE={
@@ -61,12 +84,26 @@ def to_minimum_bytes(value):
 def get_bit_length(n):
         return len(bin(n)) - 2
 
+def inflate(data):
+    # DecompIO keeps only the 2**COMPRESS_WBITS dictionary besides the output
+    stream = uzlib.DecompIO(uio.BytesIO(data), COMPRESS_WBITS)
+    payload = bytearray()
+    while True:
+        chunk = stream.read(256)
+        if not chunk:
+            break
+        payload.extend(chunk)
+
+    return payload
+
 class CoAPMessageCallback:
     def __init__(self):
         self.current_packet = None
         self.packets = []
         self.blockwise = False
         self.blockwise_opt = None
+        self.payload = None
+        self.content_format = None
 
     def receivedMessage(self, packet, sender):
         self.current_packet = packet
@@ -83,6 +120,10 @@ class CoAPMessageCallback:
             if payload is not None and len(payload) > 0:
                 _logger.info('Total response size: {}'.format(len(payload)))
             # _logger.info(payload)
+            self.payload = payload
+            for option in packet.options:
+                if option.number == COAP_OPTION_NUMBER.COAP_CONTENT_FORMAT:
+                    self.content_format = int.from_bytes(option.buffer, 'big')
         
     def _handle_blockwise(self):
         for option in self.current_packet.options:
@@ -109,12 +150,133 @@ class MQTTMessageCallback:
         _logger.info('Total response size: {}'.format(len(payload)))
         _logger.info(payload)
 
-def send_http_data(url, custom_socket=None):
+# socket of the persistent HTTP/1.1 connection shared by keep-alive requests
+_http_socket = None
+
+def open_http_connection(addr, custom_socket=None, keep_alive=False):
+    global _http_socket
+    if isinstance(custom_socket, NBIOTSocketPool):
+        return custom_socket.get(addr)
+
+    if keep_alive and _http_socket is not None:
+        if not is_peer_closed(_http_socket):
+            return _http_socket, True
+        close_http_connection()
+
+    if custom_socket is not None:
+        s = custom_socket
+    else:
+        s = socket.socket()
+
+    s.connect(addr)
+    if keep_alive:
+        _http_socket = s
+
+    return s, False
+
+def is_peer_closed(s):
+    # On NB-IoT a server close arrives as +CSOERR, which recv() would only see
+    # after waiting out its timeout; a queued one is checked without asking the modem
+    if isinstance(s, NBIOTTCPSocket):
+        s.nb.poll_urcs()
+        return s.peer_closed or s.nb.has_urc('+CSOERR:', s.profile_id)
+
+    return False
+
+def close_http_connection(s=None):
+    global _http_socket
+    if s is None:
+        s = _http_socket
+    if s is None:
+        return
+
+    if s is _http_socket:
+        _http_socket = None
+    s.close()
+
+class HTTPResponse:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.status = None
+        self.headers = {}
+        self.body = bytearray()
+        self.size = 0
+
+def read_http_response(s, response):
+    # The end of the response is found from Content-Length, so the connection does
+    # not have to be closed by the server to know the body is complete. The response
+    # is filled in as data arrives, so a partial body survives a timeout.
+    data = b''
+    header_end = -1
+    while header_end < 0:
+        r_data = s.recv(1024)
+        if not r_data:
+            return False
+        data += r_data
+        header_end = data.find(b'\r\n\r\n')
+
+    lines = str(data[:header_end], 'utf8').split('\r\n')
+    response.status = int(lines[0].split(' ')[1])
+    for line in lines[1:]:
+        key, value = line.split(':', 1)
+        response.headers[key.strip().lower()] = value.strip()
+
+    response.body.extend(data[header_end + 4:])
+    response.size = len(data)
+    # 304 responses never carry a body, whatever the headers say
+    content_length = 0 if response.status == 304 else int(response.headers.get('content-length', -1))
+    while content_length < 0 or len(response.body) < content_length:
+        r_data = s.recv(1024)
+        if not r_data:
+            if content_length >= 0:
+                raise TimeoutError('HTTP response is incomplete!')
+            break
+        response.body.extend(r_data)
+        response.size += len(r_data)
+
+    return True
+
+def http_request(addr, request, custom_socket=None, keep_alive=False, response=None):
+    if response is None:
+        response = HTTPResponse()
+
+    while True:
+        s, reused = open_http_connection(addr, custom_socket, keep_alive)
+        try:
+            send_bytes = s.send(request)
+            received = read_http_response(s, response)
+        except TimeoutError:
+            close_http_connection(s)
+            raise
+        except (OSError, NBIOTTCPSocketError):
+            # on NB-IoT a connection the peer closed fails as NBIOTTCPSocketError
+            if not reused:
+                close_http_connection(s)
+                raise
+            received = False
+
+        if not received and reused:
+            # the server closed the idle persistent connection, retry on a new one
+            close_http_connection(s)
+            response.clear()
+            continue
+
+        if not received:
+            close_http_connection(s)
+            raise TimeoutError('No HTTP response!')
+
+        if not keep_alive or response.headers.get('connection', '').lower() == 'close':
+            close_http_connection(s)
+
+        return send_bytes, response
+
+def send_http_data(url, custom_socket=None, keep_alive=False):
     _, _, host, path = url.split('/', 3)
     addr = (SERVER_IP, TCP_PORT)
     data = MSG_TYPE[path]
     data_size = len(data)
-    response_data = ''
 
     try:
         data = '--------------------------627c1552744e7f41\r\n'\
@@ -123,82 +285,130 @@ def send_http_data(url, custom_socket=None):
             '%s\r\n'\
             '--------------------------627c1552744e7f41--\r\n' % data.decode()
 
-        header = 'POST /%s HTTP/1.0\r\n'\
+        header = 'POST /%s %s\r\n'\
             'Host: %s\r\nContent-Length: %d\r\n'\
             'Content-Type: multipart/form-data; boundary=------------------------627c1552744e7f41\r\n\r\n'
 
-        header = header % (path, host, len(data))
+        header = header % (path, 'HTTP/1.1' if keep_alive else 'HTTP/1.0', host, len(data))
         request = '{}{}'.format(header, data)
 
         request = bytes(request, 'utf8')
 
         with TimedStep('HTTP POST Request: {}'.format(url), logger=_logger):
-            if custom_socket is not None:
-                s = custom_socket
-            else:
-                s = socket.socket()
-
-            s.connect(addr)
-
-            send_bytes = s.send(request)
+            send_bytes, response = http_request(addr, request, custom_socket, keep_alive)
             _logger.info('Total sent size: {}B. Payload size: {}B'.format(send_bytes, data_size))
-            r_data = None
-            while True:
-                r_data = s.recv(1024)
-                if r_data:
-                    try:
-                        response_data += str(r_data, 'utf8')
-                    except UnicodeError:
-                        _logger.warning('UnicodeError for data:')
-                        _logger.warning(r_data)
-                else:
-                    break
-
-            s.close()
     except TimeoutError:
-        s.close()
         _logger.error('HTTP POST Request: {} timed out!'.format(url))
         return
 
-    if response_data.find('R_OK') < 0:
+    if response.status != 200 or bytes(response.body) != b'R_OK':
         _logger.error('HTTP POST Request: failed!')
         return
     
-    _logger.info('Total response size: {}B. Payload size: {}B'.format(len(response_data), len(response_data.split('\r\n\r\n')[1])))
-
-def get_http_data(url, custom_socket=None):
+    _logger.info('Total response size: {}B. Payload size: {}B'.format(response.size, len(response.body)))
+
+# path -> (ETag, body) of the last full response, used by conditional GETs
+_http_cache = {}
+# path -> (ETag, body received so far) of an interrupted download, used by resumable GETs
+_http_partial = {}
+
+def save_partial_http_data(path, response):
+    partial = _http_partial.get(path)
+    etag = response.headers.get('etag')
+    if response.status == 206 and partial is not None and etag == partial[0]:
+        partial[1].extend(response.body)
+    elif response.status == 200 and etag is not None and len(response.body) > 0:
+        _http_partial[path] = (etag, response.body)
+
+def get_http_data(url, custom_socket=None, keep_alive=False, conditional=False, resumable=False, compressed=False):
     _, _, host, path = url.split('/', 3)
 
     addr = (SERVER_IP, TCP_PORT)
-    all_data = ""
+    cached = _http_cache.get(path) if conditional else None
+    partial = _http_partial.get(path) if resumable else None
+    request = 'GET /%s %s\r\nHost: %s\r\n' % (path, 'HTTP/1.1' if keep_alive else 'HTTP/1.0', host)
+    if compressed:
+        request += 'Accept-Encoding: deflate\r\n'
+    if cached is not None:
+        request += 'If-None-Match: %s\r\n' % cached[0]
+    if partial is not None:
+        # If-Range makes the server send the whole body again if it changed meanwhile
+        request += 'Range: bytes=%d-\r\nIf-Range: %s\r\n' % (len(partial[1]), partial[0])
+    request = bytes(request + '\r\n', 'utf8')
+
+    response = HTTPResponse()
     try:
         with TimedStep('HTTP GET Request: {}'.format(url), logger=_logger):
-            if custom_socket is not None:
-                s = custom_socket
-            else:
-                s = socket.socket()
-
-            s.connect(addr)
-            s.send(bytes('GET /%s HTTP/1.0\r\nHost: %s\r\n\r\n' % (path, host), 'utf8'))
-            while True:
-                data = s.recv(1024)
-                if data:
-                    try:
-                        all_data += str(data, 'utf8')
-                    except UnicodeError:
-                        _logger.warning('UnicodeError for data:')
-                        _logger.warning(data)
-                else:
-                    break
-            
-            s.close()
+            _, response = http_request(addr, request, custom_socket, keep_alive, response)
     except TimeoutError:
-        s.close()
         _logger.error('HTTP GET Request: {} timed out!'.format(url))
+        if resumable:
+            save_partial_http_data(path, response)
+            # let repeat_until_succesfull() retry, only the missing bytes will be requested
+            raise
+        return
+
+    if response.status == 304 and cached is not None:
+        _logger.info('Total response size: {}B. Not modified, payload size: {}B (cached)'.format(response.size, len(cached[1])))
+        return cached[1]
+
+    body = response.body
+    if response.status == 206 and partial is not None:
+        try:
+            first = int(response.headers['content-range'].split(' ')[1].split('-')[0])
+        except (KeyError, IndexError, ValueError):
+            first = -1
+        if first != len(partial[1]):
+            _http_partial.pop(path, None)
+            _logger.error('HTTP GET Request: unexpected range, starts at {}B!'.format(first))
+            return
+        _logger.info('Resumed at {}B, received the remaining {}B'.format(first, len(body)))
+        partial[1].extend(body)
+        body = partial[1]
+    elif response.status != 200:
+        # e.g. 416 for a range past the end: the next attempt starts over without a Range
+        _http_partial.pop(path, None)
+        _logger.error('HTTP GET Request: failed with status {}!'.format(response.status))
         return
 
+    _http_partial.pop(path, None)
+    if response.headers.get('content-encoding') == 'deflate':
+        _logger.info('Inflating {}B payload'.format(len(body)))
+        body = inflate(body)
+
+    if conditional and 'etag' in response.headers:
+        if path not in _http_cache and len(_http_cache) >= HTTP_CACHE_SIZE:
+            del _http_cache[next(iter(_http_cache))]
+        _http_cache[path] = (response.headers['etag'], body)
+
+    _logger.info('Total response size: {}B. Payload size: {}B'.format(response.size, len(body)))
+    return body
+
+def measure_avg_ms(f, times=REPEAT_TIMES):
+    tschrono = machine.Timer.Chrono()
+    total = 0
+    for x in range(0, times):
+        tschrono.reset()
+        tschrono.start()
+        f()
+        total += tschrono.read_ms()
+        tschrono.stop()
+        sleep(1)
+
+    return total / times
+
+def report_keep_alive_savings(method, path, custom_socket=None):
+    url = 'http://{}/{}'.format(HOST, path)
+    f = get_http_data if method == 'GET' else send_http_data
+
+    new_ms = measure_avg_ms(lambda: f(url, custom_socket))
+    persistent_ms = measure_avg_ms(lambda: f(url, custom_socket, keep_alive=True))
+    if isinstance(custom_socket, NBIOTSocketPool):
+        custom_socket.close()
+    close_http_connection()
 
-    _logger.info('Total response size: {}B. Payload size: {}B'.format(len(all_data), len(all_data.split('\r\n\r\n')[1])))
+    _logger.info('HTTP {} {}: new connection {} ms, persistent connection {} ms, saved {} ms per request'.format(
+        method, url, new_ms, persistent_ms, new_ms - persistent_ms))
 
 def perform_tcp_handshake(custom_socket=None):
     with TimedStep('TCP time', logger=_logger):
@@ -210,7 +420,7 @@ def perform_tcp_handshake(custom_socket=None):
         s.connect(addr)
         s.close()
 
-def get_coap_data(url, coap_type=COAP_TYPE.COAP_CON, custom_socket=None):
+def get_coap_data(url, coap_type=COAP_TYPE.COAP_CON, custom_socket=None, compressed=False):
     def create_packet(ip, port, url, type, method, token, payload, content_format, query_option):
         packet = CoapPacket()
         packet.type = type
@@ -241,6 +451,8 @@ def get_coap_data(url, coap_type=COAP_TYPE.COAP_CON, custom_socket=None):
 
     with TimedStep('CoAP GET {} Request: {}'.format('NON' if coap_type == COAP_TYPE.COAP_NONCON else 'CON', url), logger=_logger):
         packet = create_packet(host, COAP_PORT, path, coap_type, COAP_METHOD.COAP_GET, token, None, COAP_CONTENT_FORMAT.COAP_NONE, None)
+        if compressed:
+            packet.addOption(COAP_OPTION_NUMBER.COAP_ACCEPT, to_minimum_bytes(COAP_CONTENT_FORMAT_DEFLATE))
         if custom_socket is not None:
             if custom_socket.__class__.__name__ == NBIOTUDPSocket.__name__:
                 # requests block size 256B (szx=4) instead of the default 1024B (szx=6)
@@ -283,6 +495,8 @@ def get_coap_data(url, coap_type=COAP_TYPE.COAP_CON, custom_socket=None):
             packet.messageid = 0xFFFF & (1 + last_packet.messageid)
             packet.setUriHost(host)
             packet.setUriPath(path)
+            if compressed:
+                packet.addOption(COAP_OPTION_NUMBER.COAP_ACCEPT, to_minimum_bytes(COAP_CONTENT_FORMAT_DEFLATE))
             block2_payload = ((response.blockwise_opt[0] + 1) << 4) + (False * 0x08) + response.blockwise_opt[2]
             block2_payload = to_minimum_bytes(block2_payload)
             packet.addOption(COAP_OPTION_NUMBER.COAP_BLOCK2, block2_payload)
@@ -295,6 +509,50 @@ def get_coap_data(url, coap_type=COAP_TYPE.COAP_CON, custom_socket=None):
 
     client.stop()
 
+    if response.content_format == COAP_CONTENT_FORMAT_DEFLATE and response.payload is not None:
+        payload = inflate(response.payload)
+        _logger.info('Inflated {}B payload to {}B'.format(len(response.payload), len(payload)))
+        return payload
+
+    return response.payload
+
+def observe_coap_data(url, notifications=REPEAT_TIMES, custom_socket=None, timeout=60000):
+    # One Observe registration replaces a stream of polling GETs: the server pushes
+    # the resource each time it changes (e.g. PUT by backend/coap/client.py).
+    # NBIOTCoAPSocket only returns the response to its own request, so on NB-IoT
+    # the notifications are received with NBIOTUDPSocket.
+    _, _, host, path = url.split('/', 3)
+
+    token = crypto.getrandbits(32)
+    client = microcoapy.Coap()
+    received = []
+
+    def on_notification(packet, sender):
+        received.append(packet.payload)
+        _logger.info('Notification {}: {}B'.format(len(received) - 1, 0 if packet.payload is None else len(packet.payload)))
+
+    if custom_socket is not None:
+        client.setCustomSocket(custom_socket)
+    else:
+        client.start()
+
+    with TimedStep('CoAP OBSERVE Request: {}'.format(url), logger=_logger):
+        client.observe(host, COAP_PORT, path, on_notification, token)
+
+        # the first notification is the response to the registration itself
+        while len(received) < notifications + 1:
+            if not client.poll(timeout):
+                client.cancelObserve(host, COAP_PORT, path, token)
+                client.stop()
+                raise TimeoutError('Expected notification did not arrive!')
+
+        client.cancelObserve(host, COAP_PORT, path, token)
+        client.poll(2000)
+
+    client.stop()
+
+    return received
+
 def send_coap_data(url, coap_type=COAP_TYPE.COAP_CON, custom_socket=None):
     ACK_TIMEOUT = 2
     ACK_RANDOM_FACTOR = 1.5
@@ -466,19 +724,32 @@ if __name__ == "__main__":
         for radio in radios:
             with TimedStep('Experiments with {}'.format(radio.type), logger=_logger):
                 _logger.info('#### {} START ####'.format(radio.type))
+                # every radio starts with an empty DNS cache and reports only its own lookups
+                resolver.cache.clear()
+                dns_start = resolver.stats()
                 radio.connect()
                 t_socket = None
                 cs_socket = None
                 cg_socket = None
+                h_pool = None
 
                 if radio.type == 'RADIO_NBIOT':
                     t_socket = NBIOTTCPSocket(radio)
+                    h_pool = NBIOTSocketPool(radio)
                     cg_socket = NBIOTCoAPSocket(radio, COAP_SERVER_IP, COAP_PORT, reusable=True)
                     cs_socket = NBIOTUDPSocket(radio)
                     m_client = NBIOTMQTTClient(radio, 'fipyra', MQTT_SERVER_IP, MQTT_PORT, MQTT_USER, MQTT_PASSWORD)
                 else:
                     m_client = MQTTClient('fipyra', MQTT_SERVER_IP, MQTT_PORT, MQTT_USER, MQTT_PASSWORD)
 
+                pm = None
+                if radio.type == 'RADIO_NBIOT' and NBIOT_PSM:
+                    # the experiments run in one wake window, afterwards the modem is left
+                    # registered in PSM instead of being powered down
+                    pm = PowerManager(radio, PSM_ACTIVE_TIME, PSM_TAU, PSM_EDRX)
+                    pm.configure()
+                    pm.start_traffic()
+
                 if radio.type == 'RADIO_NBIOT':
                     radio.ping(HOST)
                 else:
@@ -562,19 +833,60 @@ if __name__ == "__main__":
                 _logger.info('TCP HANDSHAKE END')
 
                 # HTTP RTT
+                pooled = HTTP_POOLED and h_pool is not None
+                http_socket = h_pool if pooled else t_socket
                 for path in ['short', 'middle', 'long']:
                     _logger.info('HTTP GET START: {}'.format(path))
                     for x in range(0, REPEAT_TIMES):
-                        get_http_data('http://{}/{}'.format(HOST, path), t_socket)
+                        get_http_data('http://{}/{}'.format(HOST, path), http_socket, keep_alive=pooled)
                         sleep(1)
                     _logger.info('HTTP GET END: {}'.format(path))
 
                     _logger.info('HTTP POST START: {}'.format(path))
                     for x in range(0, REPEAT_TIMES):
-                        send_http_data('http://{}/{}'.format(HOST, path), t_socket)
+                        send_http_data('http://{}/{}'.format(HOST, path), http_socket, keep_alive=pooled)
                         sleep(1)
                     _logger.info('HTTP POST END: {}'.format(path))
 
+                if pooled:
+                    h_pool.close()
+
+                # HTTP conditional GET, only the first request transfers the body
+                for path in ['short', 'middle', 'long']:
+                    _logger.info('HTTP CONDITIONAL GET START: {}'.format(path))
+                    for x in range(0, REPEAT_TIMES):
+                        get_http_data('http://{}/{}'.format(HOST, path), t_socket, conditional=True)
+                        sleep(1)
+                    _logger.info('HTTP CONDITIONAL GET END: {}'.format(path))
+
+                # HTTP and CoAP GET of the compressed variants
+                for path in ['middle', 'long']:
+                    _logger.info('HTTP COMPRESSED GET START: {}'.format(path))
+                    for x in range(0, REPEAT_TIMES):
+                        get_http_data('http://{}/{}'.format(HOST, path), t_socket, compressed=True)
+                        sleep(1)
+                    _logger.info('HTTP COMPRESSED GET END: {}'.format(path))
+
+                    _logger.info('CoAP GET CON COMPRESSED START: {}'.format(path))
+                    for x in range(0, REPEAT_TIMES):
+                        repeat_until_succesfull(lambda: get_coap_data('coap://{}/{}'.format(COAP_SERVER_IP, path), COAP_TYPE.COAP_CON, cg_socket, compressed=True))
+                        sleep(1)
+                    _logger.info('CoAP GET CON COMPRESSED END: {}'.format(path))
+
+                # HTTP GET resumed with Range requests after a timeout
+                _logger.info('HTTP RESUMABLE GET START: long')
+                for x in range(0, REPEAT_TIMES):
+                    repeat_until_succesfull(lambda: get_http_data('http://{}/long'.format(HOST), t_socket, resumable=True))
+                    sleep(1)
+                _logger.info('HTTP RESUMABLE GET END: long')
+
+                # HTTP keep-alive savings
+                for path in ['short', 'middle', 'long']:
+                    _logger.info('HTTP KEEP-ALIVE START: {}'.format(path))
+                    report_keep_alive_savings('GET', path, h_pool if h_pool is not None else t_socket)
+                    report_keep_alive_savings('POST', path, h_pool if h_pool is not None else t_socket)
+                    _logger.info('HTTP KEEP-ALIVE END: {}'.format(path))
+
                 # CoAP NON RTT
                 for path in ['short', 'middle', 'long']:
                     _logger.info('CoAP GET NON START: {}'.format(path))
@@ -617,6 +929,14 @@ if __name__ == "__main__":
                         sleep(1)
                     _logger.info('CoAP POST CON END: {}'.format(path))
 
+                # CoAP Observe, the resource has to be changed by PUTs meanwhile
+                _logger.info('CoAP OBSERVE START: short')
+                try:
+                    observe_coap_data('coap://{}/short'.format(COAP_SERVER_IP), REPEAT_TIMES, cs_socket)
+                except TimeoutError:
+                    _logger.warning('CoAP OBSERVE: no notifications received')
+                _logger.info('CoAP OBSERVE END: short')
+
                 # MQTT qos-0 RTT
                 for topic in ['short', 'middle', 'long']:
                     if topic == 'long' and radio.type == 'RADIO_NBIOT':
@@ -642,8 +962,18 @@ if __name__ == "__main__":
                 if cg_socket is not None:
                     cg_socket.reusable = False
                     cg_socket.close()
-
-                radio.deinit()
+                if pm is not None:
+                    pm.end_traffic()
+
+                dns_end = resolver.stats()
+                _logger.info('DNS cache: {} hits, {} misses, {} entries'.format(dns_end['dns_hits'] - dns_start['dns_hits'],
+                    dns_end['dns_misses'] - dns_start['dns_misses'], dns_end['dns_entries']))
+                if radio.type != 'RADIO_WLAN':
+                    _logger.info('Attach times: {}'.format(radio.attach_times.summary()))
+                if pm is not None:
+                    _logger.info('PSM: {}, next paging window in {}s'.format(pm.state(), pm.next_window()))
+                else:
+                    radio.deinit()
                 _logger.info('#### {} END ####'.format(radio.type))
 
     except Exception as e: